@@ -16,6 +16,13 @@ from car_wash_management.car_wash_management.doctype.car_wash_appointment.car_wa
 	CarWashAppointmentManager
 from car_wash_management.car_wash_management.doctype.car_wash_appointment.car_wash_scheduler import \
 	CarWashScheduler
+from car_wash_management.car_wash_management.doctype.car_wash_appointment.availability_bitmap import \
+	get_cached_free_slots
+from car_wash_management.car_wash_management.doctype.car_wash.working_schedule import describe_day
+from car_wash_management.car_wash_management.doctype.car_wash_appointment.box_assignment import CONTRACT_PAYMENT_TYPE
+from car_wash_management.car_wash_management.doctype.car_wash_booking import slot_holds
+from car_wash_management.car_wash_management.doctype.car_wash_booking.booking_price_and_duration.single_flight import \
+	flight_key, single_flight
 
 import json, hmac, hashlib, requests
 import frappe
@@ -50,6 +57,17 @@ def get_working_hours(wash_id):
 	return hours
 
 
+@frappe.whitelist()
+def get_working_schedule(car_wash: str, date: Optional[str] = None):
+	"""
+	Working intervals of the day (holiday/special-hours exceptions applied) and whether the car wash is open now.
+	Returns {"car_wash", "date", "is_open_now", "intervals": [{"start", "end"}]}.
+	"""
+	if not car_wash:
+		frappe.throw(_("Car wash is required"))
+	return describe_day(car_wash, date)
+
+
 # http://localhost:8001/api/method/car_wash_management.api.get_time_intervals?wash_id=8213lrjkg7
 @frappe.whitelist()
 def get_time_intervals(wash_id, day_of_week):
@@ -92,17 +110,118 @@ def get_free_slots(
 	  frappe.call('path.to.get_free_slots', { car_wash: 'CW-0001', date_str: '2025-08-09', step_minutes: 15 })
 
 	- If date_str is None, uses today.
+	- With the queue respected (default) slots come from the cached availability bitmaps.
+	- Identical concurrent calls are computed once (single flight) and share the result.
 	"""
 	date_ = datetime.strptime(date_str, "%Y-%m-%d") if date_str else datetime.today()
+
+	def compute():
+		if int(respect_queue):
+			free_by_day = get_cached_free_slots(
+				car_wash, date_.date(), date_.date(),
+				step_minutes=int(step_minutes),
+				max_results=int(max_results) if max_results else None,
+				include_capacity=bool(int(include_capacity)),
+			)
+			return free_by_day.get(str(date_.date()), [])
+
+		scheduler = CarWashScheduler(car_wash)
+		return scheduler.get_free_slots_for_date(
+			date_=date_,
+			step_minutes=int(step_minutes),
+			max_results=int(max_results) if max_results else None,
+			include_capacity=bool(int(include_capacity)),
+			respect_queue=bool(int(respect_queue)),
+		)
+
+	key = flight_key(
+		"get_free_slots", car_wash, str(date_.date()), int(step_minutes),
+		int(max_results) if max_results else None, int(include_capacity), int(respect_queue),
+	)
+	return single_flight(key, compute)
+
+
+FREE_SLOTS_MAX_RANGE_DAYS = 31
+
+
+@frappe.whitelist()
+def get_free_slots_range(
+	car_wash: str,
+	start_date: str,
+	end_date: str,
+	step_minutes: int = 15,
+	max_results: Optional[int] = None,
+	include_capacity: int = 0,
+	respect_queue: int = 1,
+):
+	"""
+	Free slots for every day of [start_date, end_date] in one call (for the booking calendar).
+	Returns {"YYYY-MM-DD": [{"start", "end", "capacity"?}, ...]}; max_results applies per day.
+	"""
+	from datetime import datetime
+	start = datetime.strptime(start_date, "%Y-%m-%d")
+	end = datetime.strptime(end_date, "%Y-%m-%d")
+	if end < start:
+		frappe.throw(_("'end_date' must not be before 'start_date'."))
+	if (end - start).days + 1 > FREE_SLOTS_MAX_RANGE_DAYS:
+		frappe.throw(_("Range can not be longer than {0} days.").format(FREE_SLOTS_MAX_RANGE_DAYS))
+
+	if int(respect_queue):
+		return get_cached_free_slots(
+			car_wash, start.date(), end.date(),
+			step_minutes=int(step_minutes),
+			max_results=int(max_results) if max_results else None,
+			include_capacity=bool(int(include_capacity)),
+		)
+
 	scheduler = CarWashScheduler(car_wash)
-	free = scheduler.get_free_slots_for_date(
-		date_=date_,
+	return scheduler.get_free_slots_for_range(
+		start,
+		end,
 		step_minutes=int(step_minutes),
 		max_results=int(max_results) if max_results else None,
 		include_capacity=bool(int(include_capacity)),
 		respect_queue=bool(int(respect_queue)),
 	)
-	return free
+
+
+@frappe.whitelist()
+def suggest_box(car_wash: str, starts_on: str, duration_minutes: Optional[int] = None, payment_type: Optional[str] = None):
+	"""
+	Box for a new job starting at starts_on, after boxless appointments and the queue of that day are placed.
+	Returns {"box": name or None}.
+	"""
+	if not car_wash:
+		frappe.throw(_("Car wash is required"))
+	start = frappe.utils.get_datetime(starts_on)
+	box = CarWashScheduler(car_wash).suggest_box(
+		start,
+		duration_seconds=int(duration_minutes) * 60 if duration_minutes else None,
+		contract=payment_type == CONTRACT_PAYMENT_TYPE,
+	)
+	return {"box": box}
+
+
+@frappe.whitelist()
+def hold_slot(car_wash: str, desired_time: str, hold: Optional[str] = None):
+	"""
+	Reserve capacity of the slot at desired_time for a few minutes, until the booking is created.
+	Pass the returned hold as `slot_hold` when creating the Car wash booking; calling again with
+	the same hold extends it. Returns {"hold", "slot", "expires_at", "capacity_left"}, or None for
+	a slot that has already started. Throws when the slot has no free capacity left.
+	"""
+	if not car_wash:
+		frappe.throw(_("Car wash is required"))
+	if not desired_time:
+		frappe.throw(_("Desired time is required"))
+	return slot_holds.hold_slot(car_wash, desired_time, hold)
+
+
+@frappe.whitelist()
+def release_slot_hold(car_wash: str, desired_time: str, hold: str):
+	"""Give the held capacity back right away (the client picked another slot)."""
+	slot_holds.release_slot_hold(car_wash, desired_time, hold)
+	return {"released": True}
 
 
 @frappe.whitelist()
@@ -5,6 +5,9 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import today, getdate
 
+from ..car_wash_appointment.availability_bitmap import invalidate_car_wash
+from .working_schedule import invalidate_working_schedule
+
 
 class Carwash(Document):
 	@frappe.whitelist()
@@ -171,3 +174,6 @@ class Carwash(Document):
 		Clear cache when car wash is updated
 		"""
 		self.clear_feature_cache()
+		# Рабочие часы и boxes_count — основа битовых карт свободных слотов
+		invalidate_car_wash(self.name)
+		invalidate_working_schedule(self.name)
@@ -0,0 +1,242 @@
+# car_wash/working_schedule.py
+"""
+Скомпилированный график работы мойки: минуты открытия по дням недели плюс
+исключения на даты (праздники, особые часы — таблица working_hours_exceptions).
+
+Строки обеих таблиц лежат в Redis под версией мойки (versioning), график
+собирается из них в процессе и держится до смены версии: поиск интервалов дня,
+"открыто ли сейчас" и число рабочих секунд за период не обращаются к БД.
+Версию сбрасывает Car wash.on_update (дочерние таблицы сохраняются вместе с мойкой).
+
+Правила (как раньше в CarWashScheduler):
+  - нет строк рабочих часов — мойка работает круглосуточно;
+  - интервал с концом раньше начала идёт через полночь: хвост — утро следующего дня;
+  - исключение заменяет строки своего дня недели на эту дату (хвост прошлого дня сохраняется);
+    исключение с non_working — выходной.
+"""
+
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import frappe
+from frappe.utils import getdate, now_datetime
+
+from ..car_wash_booking.booking_price_and_duration.versioning import bump_version_now_and_after_commit, get_version
+
+VERSION_NAMESPACE = "car_wash_schedule"
+PAYLOAD_TTL_SEC = 24 * 3600
+DAY_MINUTES = 24 * 60
+WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+
+DOCTYPE_WORKING_HOURS = "Car wash working hours"
+DOCTYPE_EXCEPTION = "Car wash working hours exception"
+
+Minutes = Tuple[int, int]
+
+# (site, car_wash) -> (version, WorkingSchedule)
+_schedules: Dict[Tuple[str, str], Tuple[str, "WorkingSchedule"]] = {}
+
+
+def weekday_index(value) -> Optional[int]:
+	"""day_of_week строки рабочих часов — Select с названием дня (или число 0..6)."""
+	if isinstance(value, int):
+		return value
+	if isinstance(value, str):
+		if value.isdigit():
+			return int(value)
+		if value in WEEKDAYS:
+			return WEEKDAYS.index(value)
+	return None
+
+
+def minute_of_day(value, default: int, round_up: bool = False) -> int:
+	"""Поле Time (из БД — timedelta, из формы — строка) в минуты от полуночи."""
+	if value is None or value == "":
+		return default
+	if isinstance(value, time):
+		seconds = value.hour * 3600 + value.minute * 60 + value.second
+	elif isinstance(value, timedelta):
+		seconds = int(value.total_seconds()) % (24 * 60 * 60)
+	else:
+		parts = [int(float(p)) for p in str(value).split(":")] + [0, 0]
+		seconds = (parts[0] % 24) * 3600 + parts[1] * 60 + parts[2]
+	# 23:59:59 как конец дня — это полночь
+	return -(-seconds // 60) if round_up else seconds // 60
+
+
+def _row_minutes(row) -> Tuple[bool, int, int]:
+	return (
+		bool(row.get("non_working")),
+		minute_of_day(row.get("start_time"), 0),
+		minute_of_day(row.get("end_time"), DAY_MINUTES, round_up=True),
+	)
+
+
+def _merge(intervals: Iterable[Minutes]) -> List[Minutes]:
+	merged: List[Minutes] = []
+	for start, end in sorted(intervals):
+		if start >= end:
+			continue
+		if merged and start <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+		else:
+			merged.append((start, end))
+	return merged
+
+
+class WorkingSchedule:
+	"""
+	Минутные интервалы работы. weekly — строки (weekday, non_working, start, end),
+	exceptions — строки (date, non_working, start, end); время — минуты от полуночи.
+	"""
+
+	__slots__ = ("always_open", "_own", "_spill", "_exception_own", "_exception_spill", "_days")
+
+	def __init__(self, weekly: Sequence[tuple] = (), exceptions: Sequence[tuple] = ()):
+		self.always_open = not weekly
+		self._own: List[List[Minutes]] = [[(0, DAY_MINUTES)] if self.always_open else [] for _ in range(7)]
+		self._spill: List[List[Minutes]] = [[] for _ in range(7)]
+		for weekday, non_working, start, end in weekly:
+			if weekday is None or non_working:
+				continue
+			self._add(self._own[weekday], self._spill[weekday], start, end)
+
+		self._exception_own: Dict[date, List[Minutes]] = {}
+		self._exception_spill: Dict[date, List[Minutes]] = {}
+		for day, non_working, start, end in exceptions:
+			own = self._exception_own.setdefault(day, [])
+			spill = self._exception_spill.setdefault(day, [])
+			if not non_working:
+				self._add(own, spill, start, end)
+		self._days: Dict[date, List[Minutes]] = {}
+
+	@classmethod
+	def from_rows(cls, working_hours: Iterable = (), exceptions: Iterable = ()) -> "WorkingSchedule":
+		"""Из строк дочерних таблиц (документ или get_all)."""
+		weekly = [(weekday_index(r.get("day_of_week")), *_row_minutes(r)) for r in working_hours]
+		return cls(weekly, [(getdate(r.get("date")), *_row_minutes(r)) for r in exceptions if r.get("date")])
+
+	@staticmethod
+	def _add(own: List[Minutes], spill: List[Minutes], start: int, end: int) -> None:
+		if start < end:
+			own.append((start, end))
+		elif start > end:
+			# через полночь: до конца суток и утро следующего дня
+			own.append((start, DAY_MINUTES))
+			spill.append((0, end))
+
+	def minutes_for(self, day: date) -> List[Minutes]:
+		"""Слитые интервалы работы в минутах от начала суток day."""
+		cached = self._days.get(day)
+		if cached is None:
+			previous = day - timedelta(days=1)
+			own = self._exception_own.get(day, self._own[day.weekday()])
+			spill = self._exception_spill.get(previous, self._spill[previous.weekday()])
+			cached = self._days[day] = _merge(own + spill)
+		return cached
+
+	def intervals_for(self, day: date) -> List[Tuple[datetime, datetime]]:
+		day_start = datetime.combine(day, time(0, 0, 0))
+		return [(day_start + timedelta(minutes=s), day_start + timedelta(minutes=e)) for s, e in self.minutes_for(day)]
+
+	def is_open(self, at: datetime) -> bool:
+		minute = at.hour * 60 + at.minute
+		return any(start <= minute < end for start, end in self.minutes_for(at.date()))
+
+	def open_seconds(self, start: datetime, end: datetime) -> float:
+		"""Рабочие секунды в [start, end)."""
+		total = 0.0
+		day = start.date()
+		while datetime.combine(day, time(0, 0, 0)) < end:
+			for st, et in self.intervals_for(day):
+				overlap = (min(et, end) - max(st, start)).total_seconds()
+				if overlap > 0:
+					total += overlap
+			day += timedelta(days=1)
+		return total
+
+
+# ---- загрузка и кэш ----
+
+def _payload_key(car_wash: str, version: str) -> str:
+	return f"{VERSION_NAMESPACE}:{car_wash}:{version}"
+
+
+def _load_payloads(car_washes: List[str]) -> Dict[str, Dict[str, List[tuple]]]:
+	"""Строки графика нескольких моек — два запроса на все мойки."""
+	payloads = {name: {"weekly": [], "exceptions": []} for name in car_washes}
+	for row in frappe.get_all(
+		DOCTYPE_WORKING_HOURS,
+		filters={"parenttype": "Car wash", "parent": ["in", car_washes]},
+		fields=["parent", "day_of_week", "non_working", "start_time", "end_time"],
+		order_by="idx asc",
+		limit_page_length=0,
+	):
+		payloads[row.parent]["weekly"].append((weekday_index(row.day_of_week), *_row_minutes(row)))
+	for row in frappe.get_all(
+		DOCTYPE_EXCEPTION,
+		filters={"parenttype": "Car wash", "parent": ["in", car_washes]},
+		fields=["parent", "date", "non_working", "start_time", "end_time"],
+		order_by="idx asc",
+		limit_page_length=0,
+	):
+		if row.date:
+			payloads[row.parent]["exceptions"].append((getdate(row.date), *_row_minutes(row)))
+	return payloads
+
+
+def get_working_schedules(car_washes: Iterable[str]) -> Dict[str, WorkingSchedule]:
+	"""Графики нескольких моек; мойки без актуального кэша загружаются вместе."""
+	site = getattr(frappe.local, "site", None) or ""
+	cache = frappe.cache()
+	result: Dict[str, WorkingSchedule] = {}
+	missing: Dict[str, str] = {}
+	for car_wash in car_washes:
+		version = get_version(VERSION_NAMESPACE, car_wash)
+		cached = _schedules.get((site, car_wash))
+		if cached is not None and cached[0] == version:
+			result[car_wash] = cached[1]
+			continue
+		payload = cache.get_value(_payload_key(car_wash, version))
+		if payload is None:
+			missing[car_wash] = version
+			continue
+		result[car_wash] = WorkingSchedule(payload["weekly"], payload["exceptions"])
+		_schedules[(site, car_wash)] = (version, result[car_wash])
+
+	if missing:
+		for car_wash, payload in _load_payloads(list(missing)).items():
+			cache.set_value(_payload_key(car_wash, missing[car_wash]), payload, expires_in_sec=PAYLOAD_TTL_SEC)
+			result[car_wash] = WorkingSchedule(payload["weekly"], payload["exceptions"])
+			_schedules[(site, car_wash)] = (missing[car_wash], result[car_wash])
+	return result
+
+
+def get_working_schedule(car_wash: str) -> WorkingSchedule:
+	return get_working_schedules([car_wash])[car_wash]
+
+
+def invalidate_working_schedule(car_wash: str) -> None:
+	if car_wash:
+		bump_version_now_and_after_commit(VERSION_NAMESPACE, car_wash)
+
+
+def is_open(car_wash: str, at: Optional[datetime] = None) -> bool:
+	"""Работает ли мойка в момент at (по умолчанию — сейчас)."""
+	return get_working_schedule(car_wash).is_open(at or now_datetime())
+
+
+def describe_day(car_wash: str, day=None) -> Dict[str, Any]:
+	"""Интервалы работы на день и открыта ли мойка сейчас."""
+	now = now_datetime()
+	schedule = get_working_schedule(car_wash)
+	day = getdate(day) if day else now.date()
+	return {
+		"car_wash": car_wash,
+		"date": str(day),
+		"is_open_now": schedule.is_open(now),
+		"intervals": [
+			{"start": st.strftime("%Y-%m-%d %H:%M:%S"), "end": et.strftime("%Y-%m-%d %H:%M:%S")}
+			for st, et in schedule.intervals_for(day)
+		],
+	}
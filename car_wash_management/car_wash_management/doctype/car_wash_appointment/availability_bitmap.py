@@ -0,0 +1,444 @@
+# car_wash/availability_bitmap.py
+"""
+Битовые карты свободных слотов по (мойка, дата, шаг) в Redis.
+
+Запись кэша дня: {"versions", "first", "bits", "capacity", "base", "queue"}:
+  - bits — int, бит i установлен, если слот first + i (от начала суток) свободен;
+  - capacity — array('H') вместимости тех же слотов (для include_capacity);
+  - first — первый слот, который ещё можно предложить (для сегодняшнего дня
+    двигается вместе со временем: запись пересобирается раз в шаг);
+  - base — array('H') вместимости до очереди (график, мойщики, записи);
+  - queue — бронь очереди -> слот дня (от начала суток), с которого она ищет место.
+
+Запрос свободных слотов — это чтение записи и проход по установленным битам,
+без обращений к БД. Актуальность держится версиями (см. versioning):
+  - версия дня (мойка, дата) — записи Car wash appointment: при изменении
+    полей расписания версии затронутых дней сбрасываются, и после коммита
+    эти дни (шаг DEFAULT_STEP_MINUTES) пересобираются сразу, остальные дни не трогаются;
+  - версия мойки — Car wash (рабочие часы, boxes_count), Car wash box,
+    смены и отметки мойщиков: сбрасывает все дни мойки.
+
+Бронь очереди занимает первый свободный слот не раньше desired_time в каждом дне,
+начиная со своего (как в CarWashScheduler). Размещение "первый свободный слот не
+раньше" не зависит от порядка броней, поэтому после коммита изменения брони
+закэшированные дни мойки, которые она задевает, обновляются на месте: бронь
+убирается из queue / добавляется в неё, capacity и bits пересчитываются из base
+без БД, и версия дня атомарно меняется вместе с записью (swap_version). Дни,
+которые она не задевает, и другие мойки не трогаются. Закэшированные дни мойки
+перечислены в наборе {NAMESPACE}:days:{car_wash}; день попадает в него до начала
+пересборки, так что пересборка, идущая во время изменения, окажется устаревшей.
+
+reconcile_availability_bitmaps (ежечасно) сверяет записи ближайших дней с полным
+пересчётом CarWashScheduler, перезаписывает разошедшиеся и пишет расхождение в Error Log.
+"""
+
+from array import array
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import frappe
+from frappe.utils import add_days, get_datetime, getdate, now_datetime
+
+from ..car_wash_booking.availiability import is_in_queue
+from ..car_wash_booking.booking_price_and_duration.versioning import (
+	bump_version,
+	bump_version_now_and_after_commit,
+	get_version,
+	swap_version,
+)
+from .car_wash_scheduler import CarWashScheduler
+from .slot_timeline import SlotTimeline
+
+NAMESPACE = "car_wash_availability"
+DAY_NAMESPACE = "car_wash_availability_day"
+DEFAULT_STEP_MINUTES = 15
+ENTRY_TTL_SEC = 6 * 60 * 60
+RECONCILE_DAYS = 7
+
+APPOINTMENT_SCHEDULE_FIELDS = (
+	"car_wash", "starts_on", "ends_on", "duration_total", "work_started_on", "work_ended_on", "box", "is_deleted",
+)
+BOOKING_QUEUE_FIELDS = ("car_wash", "desired_time", "is_deleted", "is_cancelled", "has_appointment")
+
+
+def _entry_key(car_wash: str, day: date, step_minutes: int) -> str:
+	return f"{NAMESPACE}:{car_wash}:{day}:{step_minutes}"
+
+
+def _days_key(car_wash: str) -> str:
+	return f"{NAMESPACE}:days:{car_wash}"
+
+
+def _register_days(car_wash: str, days: Iterable[date], step_minutes: int) -> None:
+	"""Отметить дни мойки как закэшированные (до чтения версий и данных пересборки)."""
+	cache = frappe.cache()
+	key = cache.make_key(_days_key(car_wash))
+	pipe = cache.pipeline(transaction=False)
+	pipe.sadd(key, *(f"{day}|{step_minutes}" for day in days))
+	pipe.expire(key, ENTRY_TTL_SEC)
+	pipe.execute()
+
+
+def _registered_days(car_wash: str, today: date) -> Dict[date, List[int]]:
+	"""Закэшированные дни мойки (с сегодняшнего) -> шаги; прошедшие дни убираются из набора."""
+	cache = frappe.cache()
+	# Ключ уже с префиксом сайта: через pipeline, минуя smembers/srem RedisWrapper (они добавляют префикс сами)
+	key = cache.make_key(_days_key(car_wash))
+	pipe = cache.pipeline(transaction=False)
+	pipe.smembers(key)
+	days: Dict[date, List[int]] = {}
+	past = []
+	for member in pipe.execute()[0] or ():
+		member = member.decode() if isinstance(member, bytes) else member
+		day_str, step = member.split("|")
+		day = getdate(day_str)
+		if day < today:
+			past.append(member)
+		else:
+			days.setdefault(day, []).append(int(step))
+	if past:
+		pipe = cache.pipeline(transaction=False)
+		pipe.srem(key, *past)
+		pipe.execute()
+	return days
+
+
+def _versions(car_wash: str, day: date) -> tuple:
+	return get_version(NAMESPACE, car_wash), get_version(DAY_NAMESPACE, f"{car_wash}:{day}")
+
+
+def _first_slot(day: date, now: datetime, step_minutes: int) -> Optional[int]:
+	"""Первый слот дня, который ещё можно предложить (как в CarWashScheduler); None — день прошёл."""
+	if day < now.date():
+		return None
+	if day > now.date():
+		return 0
+	day_start = datetime.combine(day, time(0, 0, 0))
+	min_slot_start = CarWashScheduler._ceil_dt(max(now, day_start), step_minutes)
+	if min_slot_start >= day_start + timedelta(days=1):
+		return None
+	return int((min_slot_start - day_start).total_seconds()) // (step_minutes * 60)
+
+
+def _queue_slot(desired, day: date, first: int, step_minutes: int) -> Optional[int]:
+	"""Слот дня (от начала суток), с которого бронь ищет место; None — в этот день она не встаёт."""
+	day_start = datetime.combine(day, time(0, 0, 0))
+	window_start = day_start + timedelta(minutes=first * step_minutes)
+	desired = get_datetime(desired) if desired else None
+	earliest = CarWashScheduler._ceil_dt(desired if desired and desired > window_start else window_start, step_minutes)
+	if earliest >= day_start + timedelta(days=1):
+		return None
+	return int((earliest - day_start).total_seconds()) // (step_minutes * 60)
+
+
+def _make_entry(base: SlotTimeline, day: date, versions: tuple, queue: Dict[str, int]) -> Dict[str, Any]:
+	"""Запись дня: base — таймлайн до очереди, queue — бронь -> слот дня, с которого она ищет место."""
+	day_start = datetime.combine(day, time(0, 0, 0))
+	first = int((base.start - day_start).total_seconds()) // base.step_seconds
+	timeline = SlotTimeline.from_capacity(base.start, base.step_seconds // 60, base.capacity)
+	# Первый свободный слот не раньше своего — результат не зависит от порядка броней
+	for slot in sorted(queue.values()):
+		timeline.take(timeline.next_free(slot - first))
+	return {
+		"versions": versions,
+		"first": first,
+		"bits": timeline.free_bits(),
+		"capacity": array("H", timeline.capacity).tobytes(),
+		"base": array("H", base.capacity).tobytes(),
+		"queue": queue,
+	}
+
+
+def _slots_from_entry(
+	entry: Dict[str, Any], day: date, step_minutes: int, max_results: Optional[int], include_capacity: bool,
+) -> List[Dict]:
+	step = timedelta(minutes=step_minutes)
+	window_start = datetime.combine(day, time(0, 0, 0)) + entry["first"] * step
+	capacity = None
+	if include_capacity:
+		capacity = array("H")
+		capacity.frombytes(entry["capacity"])
+
+	free = []
+	bits = entry["bits"]
+	while bits:
+		low = bits & -bits
+		idx = low.bit_length() - 1
+		bits ^= low
+		slot_start = window_start + idx * step
+		item = {
+			"start": slot_start.strftime("%Y-%m-%d %H:%M:%S"),
+			"end": (slot_start + step).strftime("%Y-%m-%d %H:%M:%S"),
+		}
+		if capacity is not None:
+			item["capacity"] = capacity[idx]
+		free.append(item)
+		if max_results and len(free) >= max_results:
+			break
+	return free
+
+
+def _build_entries(car_wash: str, days: List[date], step_minutes: int, now: datetime) -> Dict[date, Optional[Dict[str, Any]]]:
+	"""Пересчитать дни одним проходом планировщика и положить записи в кэш."""
+	# Дни отмечаются и версии читаются до пересчёта: изменение во время пересчёта сделает запись устаревшей
+	_register_days(car_wash, days, step_minutes)
+	versions = {day: _versions(car_wash, day) for day in days}
+	scheduler = CarWashScheduler(car_wash)
+	# Очередь раскладывается здесь же, поверх сохраняемой вместимости до очереди
+	timelines = scheduler.build_capacity_timelines(min(days), max(days), step_minutes, respect_queue=False, now=now)
+	bookings = scheduler._get_queue_bookings() if any(timelines.values()) else []
+	cache = frappe.cache()
+	entries: Dict[date, Optional[Dict[str, Any]]] = {}
+	for day in days:
+		timeline = timelines.get(day)
+		if timeline is None:
+			entries[day] = None
+			continue
+		first = int((timeline.start - datetime.combine(day, time(0, 0, 0))).total_seconds()) // timeline.step_seconds
+		queue = {}
+		for booking in bookings:
+			slot = _queue_slot(booking.get("desired_time"), day, first, step_minutes)
+			if slot is not None:
+				queue[booking.name] = slot
+		entries[day] = _make_entry(timeline, day, versions[day], queue)
+		cache.set_value(_entry_key(car_wash, day, step_minutes), entries[day], expires_in_sec=ENTRY_TTL_SEC)
+	return entries
+
+
+def _get_entries(car_wash: str, first_day: date, last_day: date, step_minutes: int, now: datetime) -> Dict[date, Optional[Dict[str, Any]]]:
+	"""Записи дней [first_day, last_day]; дни без актуальной записи пересчитываются одним вызовом планировщика."""
+	cache = frappe.cache()
+	entries: Dict[date, Optional[Dict[str, Any]]] = {}
+	missing: List[date] = []
+	day = first_day
+	while day <= last_day:
+		first = _first_slot(day, now, step_minutes)
+		if first is None:
+			entries[day] = None
+		else:
+			entry = cache.get_value(_entry_key(car_wash, day, step_minutes))
+			if entry and entry["first"] == first and entry["versions"] == _versions(car_wash, day):
+				entries[day] = entry
+			else:
+				missing.append(day)
+		day += timedelta(days=1)
+
+	if missing:
+		entries.update(_build_entries(car_wash, missing, step_minutes, now))
+	return entries
+
+
+def get_cached_free_slots(
+	car_wash: str,
+	start_date,
+	end_date,
+	step_minutes: int = DEFAULT_STEP_MINUTES,
+	max_results: Optional[int] = None,
+	include_capacity: bool = False,
+) -> Dict[str, List[Dict]]:
+	"""
+	То же, что CarWashScheduler.get_free_slots_for_range(respect_queue=True), но из битовых карт.
+	Дни без актуальной записи пересчитываются одним вызовом планировщика.
+	"""
+	step_minutes = int(step_minutes)
+	entries = _get_entries(car_wash, getdate(start_date), getdate(end_date), step_minutes, now_datetime())
+	return {
+		str(day): _slots_from_entry(entry, day, step_minutes, max_results, include_capacity) if entry else []
+		for day, entry in sorted(entries.items())
+	}
+
+
+def get_slot_capacity(car_wash: str, slot_start: datetime, step_minutes: int = DEFAULT_STEP_MINUTES) -> Optional[int]:
+	"""
+	Свободная вместимость слота, который начинается в slot_start (из битовой карты дня).
+	None — слот уже нельзя предложить (прошёл или начался), 0 — слот занят.
+	"""
+	day = slot_start.date()
+	entry = _get_entries(car_wash, day, day, step_minutes, now_datetime()).get(day)
+	if not entry:
+		return None
+	idx = int((slot_start - datetime.combine(day, time(0, 0, 0))).total_seconds()) // (step_minutes * 60) - entry["first"]
+	if idx < 0:
+		return None
+	if not (entry["bits"] >> idx) & 1:
+		return 0
+	capacity = array("H")
+	capacity.frombytes(entry["capacity"])
+	return capacity[idx]
+
+
+# ---- инвалидация из контроллеров ----
+
+def _as_row(doc) -> Dict[str, Any]:
+	row = {field: doc.get(field) for field in APPOINTMENT_SCHEDULE_FIELDS}
+	for field in ("starts_on", "ends_on", "work_started_on", "work_ended_on"):
+		row[field] = get_datetime(row[field]) if row[field] else None
+	return row
+
+
+def _appointment_days(doc) -> Set[date]:
+	"""Дни, которые запись занимает (или занимала)."""
+	if not doc or not doc.get("car_wash"):
+		return set()
+	interval = CarWashScheduler.appointment_interval(
+		_as_row(doc), now_datetime(), timedelta(minutes=DEFAULT_STEP_MINUTES))
+	if not interval:
+		return set()
+	start, end = interval
+	days = set()
+	day = start.date()
+	while datetime.combine(day, time(0, 0, 0)) < end:
+		days.add(day)
+		day += timedelta(days=1)
+	return days
+
+
+def _schedule_changed(before, doc, fields: Iterable[str]) -> bool:
+	if before is None or doc is None:
+		return True
+	return any(str(before.get(field) or "") != str(doc.get(field) or "") for field in fields)
+
+
+def on_appointment_change(before, doc) -> None:
+	"""
+	Car wash appointment сохранена (before — прежнее состояние) или удалена (doc=None).
+	Сбрасываются и после коммита пересобираются только дни старого и нового интервала.
+	"""
+	if not _schedule_changed(before, doc, APPOINTMENT_SCHEDULE_FIELDS):
+		return
+	days_by_car_wash: Dict[str, Set[date]] = {}
+	for state in (before, doc):
+		if state is not None and state.get("car_wash"):
+			days_by_car_wash.setdefault(state.get("car_wash"), set()).update(_appointment_days(state))
+
+	for car_wash, days in days_by_car_wash.items():
+		for day in days:
+			bump_version_now_and_after_commit(DAY_NAMESPACE, f"{car_wash}:{day}")
+		frappe.db.after_commit(lambda car_wash=car_wash, days=days: _rebuild_after_commit(car_wash, days))
+
+
+def on_booking_change(before, doc) -> None:
+	"""
+	Бронь сохранена (before — прежнее состояние) или удалена (doc=None): после коммита она
+	убирается из очереди / встаёт в очередь закэшированных дней мойки, которые задевает.
+	"""
+	if not _schedule_changed(before, doc, BOOKING_QUEUE_FIELDS):
+		return
+	# мойка -> {"name", "before"/"after": desired_time, если бронь была / стала в очереди}
+	changes: Dict[str, Dict[str, Any]] = {}
+	for side, state in (("before", before), ("after", doc)):
+		if is_in_queue(state):
+			change = changes.setdefault(state.get("car_wash"), {"name": state.name})
+			change[side] = state.get("desired_time")
+
+	for car_wash, change in changes.items():
+		frappe.db.after_commit(lambda car_wash=car_wash, change=change: _apply_queue_change_after_commit(car_wash, change))
+
+
+def _touches_day(change: Dict[str, Any], day: date) -> bool:
+	"""Бронь стоит (стояла) в очереди дня: без desired_time — в каждом дне, иначе начиная с её дня."""
+	return any(
+		not change[side] or get_datetime(change[side]).date() <= day
+		for side in ("before", "after")
+		if side in change
+	)
+
+
+def _with_queue_change(entry: Dict[str, Any], day: date, step_minutes: int, change: Dict[str, Any], versions: tuple) -> Dict[str, Any]:
+	"""Запись дня с бронью, убранной из очереди и (если она осталась в очереди) поставленной заново."""
+	queue = dict(entry["queue"])
+	queue.pop(change["name"], None)
+	if "after" in change:
+		slot = _queue_slot(change["after"], day, entry["first"], step_minutes)
+		if slot is not None:
+			queue[change["name"]] = slot
+	base = array("H")
+	base.frombytes(entry["base"])
+	window_start = datetime.combine(day, time(0, 0, 0)) + timedelta(minutes=entry["first"] * step_minutes)
+	return _make_entry(SlotTimeline.from_capacity(window_start, step_minutes, base), day, versions, queue)
+
+
+def _apply_queue_change(car_wash: str, change: Dict[str, Any], now: datetime) -> None:
+	cache = frappe.cache()
+	for day, steps in sorted(_registered_days(car_wash, now.date()).items()):
+		if not _touches_day(change, day):
+			continue
+		versions = _versions(car_wash, day)
+		fresh = {}
+		for step_minutes in steps:
+			entry = cache.get_value(_entry_key(car_wash, day, step_minutes))
+			if entry and "queue" in entry and entry["versions"] == versions and entry["first"] == _first_slot(day, now, step_minutes):
+				fresh[step_minutes] = entry
+
+		# Версия дня меняется в любом случае: устаревшие и пересобираемые сейчас записи перестают быть актуальными
+		def build(version, day=day, fresh=fresh):
+			return {
+				_entry_key(car_wash, day, step_minutes): _with_queue_change(entry, day, step_minutes, change, (versions[0], version))
+				for step_minutes, entry in fresh.items()
+			}
+
+		if swap_version(DAY_NAMESPACE, f"{car_wash}:{day}", versions[1], build, ENTRY_TTL_SEC) is None:
+			# День изменили параллельно — пересоберётся при чтении
+			bump_version(DAY_NAMESPACE, f"{car_wash}:{day}")
+
+
+def _apply_queue_change_after_commit(car_wash: str, change: Dict[str, Any]) -> None:
+	try:
+		_apply_queue_change(car_wash, change, now_datetime())
+	except Exception:
+		# Записи могли остаться со старой очередью — все дни мойки пересоберутся при чтении
+		frappe.log_error(frappe.get_traceback(), "Availability bitmap queue update failed")
+		bump_version(NAMESPACE, car_wash)
+
+
+def invalidate_car_wash(car_wash: str) -> None:
+	"""Рабочие часы, боксы или очередь мойки изменились — все её дни пересобираются при чтении."""
+	if car_wash:
+		bump_version_now_and_after_commit(NAMESPACE, car_wash)
+
+
+def _rebuild_after_commit(car_wash: str, days: Iterable[date]) -> None:
+	now = now_datetime()
+	days = sorted(day for day in days if day >= now.date())
+	if not days:
+		return
+	try:
+		_build_entries(car_wash, days, DEFAULT_STEP_MINUTES, now)
+	except Exception:
+		# Не критично: день пересоберётся при следующем чтении
+		frappe.log_error(frappe.get_traceback(), "Availability bitmap rebuild failed")
+
+
+# ---- сверка ----
+
+def reconcile_availability_bitmaps(days: int = RECONCILE_DAYS) -> Dict[str, Any]:
+	"""
+	Сравнить записи ближайших дней (шаг DEFAULT_STEP_MINUTES) с полным пересчётом и перезаписать разошедшиеся.
+	Записи, которых нет или которые устарели по версии, просто перестраиваются (это не расхождение).
+	"""
+	now = now_datetime()
+	cache = frappe.cache()
+	today = now.date()
+	dates = [getdate(add_days(today, offset)) for offset in range(int(days))]
+	checked = repaired = 0
+	for car_wash in frappe.get_all("Car wash", pluck="name"):
+		try:
+			cached = {day: cache.get_value(_entry_key(car_wash, day, DEFAULT_STEP_MINUTES)) for day in dates}
+			versions = {day: _versions(car_wash, day) for day in dates}
+			fresh = _build_entries(car_wash, dates, DEFAULT_STEP_MINUTES, now)
+			drifted = []
+			for day in dates:
+				entry = cached[day]
+				if not entry or not fresh[day] or entry["versions"] != versions[day] or entry["first"] != fresh[day]["first"]:
+					continue
+				checked += 1
+				if entry["bits"] != fresh[day]["bits"] or entry["capacity"] != fresh[day]["capacity"]:
+					drifted.append(str(day))
+			if drifted:
+				# Свежие записи уже записаны поверх разошедшихся (_build_entries); Error Log — для алерта
+				repaired += len(drifted)
+				frappe.log_error(f"days={', '.join(drifted)}", f"Availability bitmap drift: {car_wash}")
+		except Exception:
+			frappe.log_error(frappe.get_traceback(), f"Availability bitmap reconcile failed: {car_wash}")
+
+	return {"checked": checked, "repaired": repaired}
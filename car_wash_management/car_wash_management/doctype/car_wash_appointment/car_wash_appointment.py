@@ -15,6 +15,11 @@ from ..car_wash_booking.booking_price_and_duration.workflow_helpers import (
 	refresh_usage,
 	apply_usage,
 )
+from ..car_wash_booking import queue_model
+from ..car_wash_booking.booking_price_and_duration.quote_memo import bump_customer_stats_version
+from ..car_wash_client.client_stats import apply_appointment_stats_delta
+from .availability_bitmap import on_appointment_change
+from .reports.section_cache import invalidate_appointment_weeks
 from .excel.export_services_to_excel import export_services_to_excel
 from .excel.export_workers_to_excel import export_workers_to_xls
 
@@ -29,9 +34,11 @@ class Carwashappointment(Document):
 	    recorded auto-discounts, then recalc products and timings.
 	  - also sync payment timestamp and propagate status to linked booking.
 	- after_insert: enqueue push and record snapshot of auto-discount usage.
-	- on_update: enqueue push, sync worker earnings, stock issue/revert by payment status,
-	  reconcile items if changed while paid, handle soft-delete (revert stock + delete usage).
-	- on_trash/on_cancel: revert stock and delete usage.
+	- on_update: enqueue push, sync worker earnings, apply client stats delta and bump its version, refresh availability
+	  bitmaps of the touched days, occupy/free the box in the live queue model on work start/end, reset cached
+	  weekly report sections of the touched weeks, stock issue/revert by payment status, reconcile items if changed while paid,
+	  handle soft-delete (revert stock + delete usage).
+	- on_trash: remove the client stats contribution and availability; on_trash/on_cancel: revert stock and delete usage.
 	Rationale: shared helpers keep pricing/discount application consistent across doctypes.
 	"""
 	
@@ -228,10 +235,26 @@ class Carwashappointment(Document):
 		self._schedule_push_if_changed(created=True)
 		self._ensure_usage_recorded_after_insert()
 
+	def _bump_customer_stats(self) -> None:
+		# Статистика клиента (и расчёты скидок по ней) устарела
+		bump_customer_stats_version(self.customer)
+		before = self.get_doc_before_save()
+		if before and before.customer != self.customer:
+			bump_customer_stats_version(before.customer)
+
+	def _update_customer_stats(self) -> None:
+		# Дельта в `Car wash client stats`: убрать прежний вклад записи и добавить новый
+		apply_appointment_stats_delta(self.get_doc_before_save(), self)
+		self._bump_customer_stats()
+
 	def on_update(self):
 		# На любое сохранение шлём только если важные поля реально изменились
 		self._schedule_push_if_changed()
 		try_sync_worker_earning(self)
+		self._update_customer_stats()
+		on_appointment_change(self.get_doc_before_save(), self)
+		queue_model.on_appointment_change(self.get_doc_before_save(), self)
+		invalidate_appointment_weeks(self.get_doc_before_save(), self)
 
 		# Автоматическое списание/возврат товаров по изменению статуса оплаты (только если есть фича shop)
 		try:
@@ -301,6 +324,12 @@ class Carwashappointment(Document):
 		frappe.db.after_commit(_after_commit)
 
 	def on_trash(self):
+		apply_appointment_stats_delta(self, None)
+		self._bump_customer_stats()
+		on_appointment_change(self, None)
+		queue_model.on_appointment_change(self, None)
+		invalidate_appointment_weeks(self, None)
+
 		# Fix for Issue #7: Cancel worker earnings before deletion
 		try:
 			# Set is_deleted to trigger earning cleanup
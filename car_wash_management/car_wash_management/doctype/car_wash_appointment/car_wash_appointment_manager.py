@@ -1,6 +1,8 @@
 import frappe
 from datetime import datetime, timedelta
 
+from .car_wash_scheduler import CarWashScheduler
+
 
 class CarWashAppointmentManager:
 	def __init__(self, car_wash_name=None):
@@ -37,7 +39,8 @@ class CarWashAppointmentManager:
 			filters['car'] = car_name
 
 		appointments = frappe.get_list('Car wash appointment',
-									   fields=['name', 'starts_on', 'ends_on', 'worker', 'car'],
+									   fields=['name', 'starts_on', 'ends_on', 'duration_total', 'work_started_on',
+											   'work_ended_on', 'worker', 'car'],
 									   order_by='starts_on asc',
 									   limit=5,
 									   filters=filters)
@@ -78,6 +81,14 @@ class CarWashAppointmentManager:
 			'end_time']
 
 		appointments = self.get_appointments(box_name=box_name, worker_name=worker_name)
+		# Реальная длительность записи (work_* / duration_total / ends_on), а не фиксированный час
+		now = datetime.now()
+		intervals = [
+			interval for interval in (
+				CarWashScheduler.appointment_interval(appointment, now, timedelta(hours=1))
+				for appointment in appointments
+			) if interval
+		]
 		free_slots = []
 		current_time = start_of_day
 
@@ -85,10 +96,7 @@ class CarWashAppointmentManager:
 			next_time = current_time + timedelta(minutes=15)
 			is_free = True
 
-			for appointment in appointments:
-				appointment_start = appointment['starts_on']
-				appointment_end = appointment_start + timedelta(hours=1)
-
+			for appointment_start, appointment_end in intervals:
 				if not (next_time <= appointment_start or current_time >= appointment_end):
 					is_free = False
 					break
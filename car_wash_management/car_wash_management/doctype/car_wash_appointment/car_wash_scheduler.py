@@ -1,14 +1,23 @@
 import frappe
-from datetime import datetime, timedelta, time
-from typing import List, Dict, Optional
+from datetime import date, datetime, timedelta, time
+from typing import Any, List, Dict, Optional
+
+from ..car_wash.working_schedule import WorkingSchedule, get_working_schedule
+from ..work_shift_schedule.staffing import get_staffing
+from .slot_timeline import SlotTimeline
 
 
 class CarWashScheduler:
 	"""
 	Считает свободные слоты:
-	  - Нет рабочих часов -> 24/7
-	  - Вместимость = число доступных боксов
-	  - Записи (appointments) занимают ТОЛЬКО стартовый слот
+	  - Рабочие часы и исключения на даты — скомпилированный график мойки
+		(car_wash/working_schedule.py); нет рабочих часов -> 24/7
+	  - Вместимость = число доступных боксов, но не больше мойщиков на смене
+		(work_shift_schedule/staffing.py — там, где есть отметки смены)
+	  - Записи (appointments) занимают бокс на всю длительность:
+		  * [work_started_on, work_ended_on], если работа уже шла
+		  * иначе [starts_on, starts_on + duration_total] (или ends_on)
+		  * слот свободен, если хотя бы один бокс свободен весь слот
 	  - Очередь (Car wash booking):
 		  * Каждая машина = 1 списание слота
 		  * Если есть desired_time (на строке или родителе), нельзя раньше него
@@ -19,12 +28,19 @@ class CarWashScheduler:
 	DOCTYPE_APPOINTMENT = "Car wash appointment"
 	DOCTYPE_BOOKING = "Car wash booking"
 
-	FIELD_WORKING_HOURS = "working_hours"  # child table: day_of_week, non_working, start_time, end_time
 	FIELD_BOX_DISABLED = "is_disabled"
 	FIELD_BOX_DELETED = "is_deleted"
 	FIELD_APPT_START = "starts_on"
-	FIELD_APPT_END = "ends_on"  # для справки
+	FIELD_APPT_END = "ends_on"
 	FIELD_APPT_BOX = "box"
+	FIELD_APPT_DURATION = "duration_total"  # секунды
+	FIELD_APPT_WORK_STARTED = "work_started_on"
+	FIELD_APPT_WORK_ENDED = "work_ended_on"
+
+	# Записи, начавшиеся раньше окна, могут ещё занимать бокс
+	APPOINTMENT_LOOKBACK = timedelta(hours=12)
+	# Длительность работы без duration_total при подборе бокса
+	APPOINTMENT_DEFAULT_DURATION = timedelta(minutes=30)
 
 	FIELD_BOOKING_DESIRED_TIME = "desired_time"  # опционально
 
@@ -34,6 +50,45 @@ class CarWashScheduler:
 		if not car_wash_name:
 			raise ValueError("car_wash_name is required")
 		self.car_wash_name = car_wash_name
+		self._car_wash_doc = None
+		self._boxes_count: Optional[int] = None
+		self._working_hours = None
+		self._schedule: Optional[WorkingSchedule] = None
+		self._appointments = None
+		self._queue_bookings = None
+		self._box_plans: Dict[date, Any] = {}
+		self._staffing: Dict[date, list] = {}
+		self._staffing_preloaded = False
+
+	def preload(
+		self,
+		working_hours=None,
+		boxes_count: Optional[int] = None,
+		appointments=None,
+		queue_bookings=None,
+		schedule: Optional[WorkingSchedule] = None,
+		staffing: Optional[Dict[date, list]] = None,
+	):
+		"""
+		Данные, загруженные пакетно сразу для многих моек (см. city_search): переданное
+		не запрашивается. appointments должны покрывать окно расчёта (с APPOINTMENT_LOOKBACK).
+		working_hours — строки рабочих часов без исключений; schedule — готовый график;
+		staffing — сегменты мойщиков по дням окна (см. staffing.get_staffing_many): дня нет — нет ограничения.
+		"""
+		if working_hours is not None:
+			self._working_hours = working_hours
+		if schedule is not None:
+			self._schedule = schedule
+		if staffing is not None:
+			self._staffing = dict(staffing)
+			self._staffing_preloaded = True
+		if boxes_count is not None:
+			self._boxes_count = boxes_count
+		if appointments is not None:
+			self._appointments = appointments
+		if queue_bookings is not None:
+			self._queue_bookings = queue_bookings
+		return self
 
 	# ---------- Public API ----------
 
@@ -45,125 +100,149 @@ class CarWashScheduler:
 		include_capacity: bool = False,
 		respect_queue: bool = True,
 	) -> List[Dict]:
-		try:
-			from frappe.utils import now_datetime
-			now = now_datetime()
-		except Exception:
-			now = datetime.now()
-
-		day_start = datetime.combine(date_.date(), time(0, 0, 0))
-		day_end = day_start + timedelta(days=1)
-
-		if now.date() > date_.date():
-			return []
-
-		min_slot_start = day_start if date_.date() > now.date() else self._ceil_dt(
-			max(now, day_start), step_minutes)
-		if min_slot_start >= day_end:
-			return []
-
-		capacity_timeline = self._build_capacity_timeline(min_slot_start, day_end, step_minutes)
-
-		appointments = self._get_appointments(min_slot_start, day_end)
-		self._apply_appointments(capacity_timeline, appointments, step_minutes)
+		free_by_day = self.get_free_slots_for_range(
+			date_, date_,
+			step_minutes=step_minutes,
+			max_results=max_results,
+			include_capacity=include_capacity,
+			respect_queue=respect_queue,
+		)
+		return free_by_day.get(str(self._as_date(date_)), [])
 
-		if respect_queue:
-			queue_items = self._get_queue_items(min_slot_start, day_end, step_minutes)
-			self._apply_queue(capacity_timeline, queue_items, step_minutes)
+	def get_free_slots_for_range(
+		self,
+		start_date,
+		end_date,
+		step_minutes: int = 15,
+		max_results: Optional[int] = None,
+		include_capacity: bool = False,
+		respect_queue: bool = True,
+	) -> Dict[str, List[Dict]]:
+		"""
+		Свободные слоты по дням [start_date, end_date] за один проход:
+		  - рабочие часы и боксы читаются один раз на все дни
+		  - записи за весь диапазон — одним запросом, очередь — одним запросом
+		Ответ: {"YYYY-MM-DD": [...]} для каждого дня диапазона, max_results — на день.
+		"""
+		timelines = self.build_capacity_timelines(start_date, end_date, step_minutes, respect_queue=respect_queue)
+		return {
+			str(day): timeline.free_slots(max_results=max_results, include_capacity=include_capacity) if timeline else []
+			for day, timeline in timelines.items()
+		}
 
-		free = []
-		for slot_start, capacity in capacity_timeline:
-			if capacity > 0:
-				slot_end = slot_start + timedelta(minutes=step_minutes)
-				item = {
-					"start": slot_start.strftime("%Y-%m-%d %H:%M:%S"),
-					"end": slot_end.strftime("%Y-%m-%d %H:%M:%S"),
-				}
-				if include_capacity:
-					item["capacity"] = capacity
-				free.append(item)
-				if max_results and len(free) >= max_results:
-					break
+	def build_capacity_timelines(
+		self,
+		start_date,
+		end_date,
+		step_minutes: int = 15,
+		respect_queue: bool = True,
+		now: Optional[datetime] = None,
+	) -> Dict[date, Optional[SlotTimeline]]:
+		"""
+		Таймлайны вместимости по дням [start_date, end_date] (None — день прошёл).
+		Сегодняшний таймлайн начинается с первого слота после now.
+		"""
+		if now is None:
+			try:
+				from frappe.utils import now_datetime
+				now = now_datetime()
+			except Exception:
+				now = datetime.now()
+
+		# (дата, первый слот, конец суток) — прошедшие дни и прошедшее время сегодня отбрасываются
+		windows = []
+		timelines: Dict[date, Optional[SlotTimeline]] = {}
+		day, last_day = self._as_date(start_date), self._as_date(end_date)
+		while day <= last_day:
+			timelines[day] = None
+			day_start = datetime.combine(day, time(0, 0, 0))
+			day_end = day_start + timedelta(days=1)
+			if day >= now.date():
+				min_slot_start = day_start if day > now.date() else self._ceil_dt(max(now, day_start), step_minutes)
+				if min_slot_start < day_end:
+					windows.append((day_start, min_slot_start, day_end))
+			day += timedelta(days=1)
+		if not windows:
+			return timelines
+
+		# Интервалы занятости раскладываются по всем дням, которые они задевают
+		occupancy_by_day: Dict = {}
+		appointments = self._get_appointments(windows[0][1] - self.APPOINTMENT_LOOKBACK, windows[-1][2])
+		for occupancy in self._appointment_occupancies(appointments, now, step_minutes):
+			day = occupancy[1].date()
+			while datetime.combine(day, time(0, 0, 0)) < occupancy[2]:
+				occupancy_by_day.setdefault(day, []).append(occupancy)
+				day += timedelta(days=1)
+		bookings = self._get_queue_bookings() if respect_queue else []
+
+		for day_start, min_slot_start, day_end in windows:
+			capacity_timeline = self._build_capacity_timeline(day_start, min_slot_start, day_end, step_minutes)
+			self._apply_appointments(capacity_timeline, occupancy_by_day.get(day_start.date(), []), step_minutes)
+			if respect_queue:
+				queue_items = self._get_queue_items(bookings, min_slot_start, day_end, step_minutes)
+				self._apply_queue(capacity_timeline, queue_items, step_minutes)
+			timelines[day_start.date()] = capacity_timeline
+
+		return timelines
+
+	def suggest_box(self, start: datetime, duration_seconds: Optional[int] = None, contract: bool = False) -> Optional[str]:
+		"""
+		Какой бокс взять под новую работу со start: план дня (записи без бокса и очередь
+		уже разложены, см. box_assignment) строится один раз на экземпляр и день.
+		None — совместимого свободного бокса нет.
+		"""
+		from .box_assignment import plan_day, suggest_box
 
-		return free
+		day = start.date()
+		if day not in self._box_plans:
+			self._box_plans[day] = plan_day(self.car_wash_name, day)
+		day_start = datetime.combine(day, time(0, 0, 0))
+		duration = int(duration_seconds or 0) or int(self.APPOINTMENT_DEFAULT_DURATION.total_seconds())
+		return suggest_box(self._box_plans[day], int((start - day_start).total_seconds()), duration, contract)
 
 	# ---------- Internals ----------
 
-	def _build_capacity_timeline(self, start_dt: datetime, end_dt: datetime, step_minutes: int):
+	def _build_capacity_timeline(self, day_start: datetime, start_dt: datetime, end_dt: datetime,
+								 step_minutes: int) -> SlotTimeline:
 		boxes_count = self._get_boxes_count()
-		intervals = self._get_working_dt_intervals_for_day(start_dt, end_dt)
+		# Интервалы считаются от начала суток, окно таймлайна может начинаться позже (сегодня)
+		intervals = self._get_working_dt_intervals_for_day(day_start)
 
-		timeline = []
-		cur = start_dt
-		step = timedelta(minutes=step_minutes)
-		while cur < end_dt:
-			in_work = any(st <= cur < et for st, et in intervals)
-			capacity = boxes_count if in_work else 0
-			timeline.append((cur, capacity))
-			cur += step
+		timeline = SlotTimeline(start_dt, end_dt, step_minutes)
+		timeline.fill_intervals(intervals, boxes_count)
+		# До записей: запись занимает и бокс, и мойщика
+		timeline.limit(self._get_staffing(day_start.date()))
 		return timeline
 
-	def _get_working_dt_intervals_for_day(self, day_start: datetime, day_end: datetime) -> List[
-		tuple]:
-		car_wash = frappe.get_doc(self.DOCTYPE_CAR_WASH, self.car_wash_name)
-		rows = getattr(car_wash, self.FIELD_WORKING_HOURS, None) or []
-
-		if not rows:
-			return [(day_start, day_end)]  # 24/7
-
-		W = day_start.weekday()
-		W_prev = (W - 1) % 7
-
-		intervals: List[tuple] = []
-
-		# текущий день
-		for r in rows:
-			if r.get("non_working"):
-				continue
-			if r.get("day_of_week") != W:
-				continue
-			st_t = r.get("start_time") or time(0, 0, 0)
-			et_t = r.get("end_time") or time(23, 59, 59)
-
-			if st_t <= et_t:
-				intervals.append((
-					day_start + timedelta(hours=st_t.hour, minutes=st_t.minute,
-										  seconds=st_t.second),
-					day_start + timedelta(hours=et_t.hour, minutes=et_t.minute,
-										  seconds=et_t.second),
-				))
-			else:
-				# через полночь: хвост до конца суток
-				intervals.append((
-					day_start + timedelta(hours=st_t.hour, minutes=st_t.minute,
-										  seconds=st_t.second),
-					day_end,
-				))
-
-		# хвост прошлого дня, если там интервал через полночь
-		for r in rows:
-			if r.get("non_working"):
-				continue
-			if r.get("day_of_week") != W_prev:
-				continue
-			st_t = r.get("start_time") or time(0, 0, 0)
-			et_t = r.get("end_time") or time(23, 59, 59)
-			if st_t > et_t:
-				intervals.append((day_start,
-								  day_start + timedelta(hours=et_t.hour, minutes=et_t.minute,
-														seconds=et_t.second)))
-
-		# merge
-		intervals.sort(key=lambda x: x[0])
-		merged: List[tuple] = []
-		for st, et in intervals:
-			if not merged or st > merged[-1][1]:
-				merged.append((st, et))
+	def _get_staffing(self, day: date) -> list:
+		if day not in self._staffing:
+			self._staffing[day] = [] if self._staffing_preloaded else get_staffing(self.car_wash_name, day)
+		return self._staffing[day]
+
+	def _get_car_wash(self):
+		# Один get_doc на экземпляр: диапазон дней переиспользует рабочие часы и boxes_count
+		if self._car_wash_doc is None:
+			self._car_wash_doc = frappe.get_doc(self.DOCTYPE_CAR_WASH, self.car_wash_name)
+		return self._car_wash_doc
+
+	def _get_schedule(self) -> WorkingSchedule:
+		# Скомпилированный график (кэш по версии мойки) — без get_doc и без запросов при тёплом кэше
+		if self._schedule is None:
+			if self._working_hours is not None:
+				self._schedule = WorkingSchedule.from_rows(self._working_hours)
 			else:
-				merged[-1] = (merged[-1][0], max(merged[-1][1], et))
-		return merged
+				self._schedule = get_working_schedule(self.car_wash_name)
+		return self._schedule
+
+	def _get_working_dt_intervals_for_day(self, day_start: datetime) -> List[tuple]:
+		return self._get_schedule().intervals_for(day_start.date())
 
 	def _get_boxes_count(self) -> int:
+		if self._boxes_count is None:
+			self._boxes_count = self._load_boxes_count()
+		return self._boxes_count
+
+	def _load_boxes_count(self) -> int:
 		# 1) нет Doctype боксов
 		if not self.DOCTYPE_BOX:
 			return self._boxes_from_car_wash_or_fallback()
@@ -194,7 +273,7 @@ class CarWashScheduler:
 
 	def _boxes_from_car_wash_or_fallback(self) -> int:
 		try:
-			cw = frappe.get_doc(self.DOCTYPE_CAR_WASH, self.car_wash_name)
+			cw = self._get_car_wash()
 			if hasattr(cw, "boxes_count") and cw.boxes_count:
 				return int(cw.boxes_count)
 		except Exception:
@@ -202,25 +281,35 @@ class CarWashScheduler:
 		return self.BOX_COUNT_FALLBACK
 
 	def _get_appointments(self, earliest_dt: datetime, day_end: datetime):
+		if self._appointments is not None:
+			return [
+				a for a in self._appointments
+				if isinstance(a.get(self.FIELD_APPT_START), datetime) and earliest_dt <= a.get(self.FIELD_APPT_START) < day_end
+			]
 		return frappe.get_all(
 			self.DOCTYPE_APPOINTMENT,
 			filters=[
 				["Car wash appointment", "car_wash", "=", self.car_wash_name],
 				[self.FIELD_APPT_START, ">=", earliest_dt],
 				[self.FIELD_APPT_START, "<", day_end],
+				["is_deleted", "=", 0],
+			],
+			fields=[
+				"name", self.FIELD_APPT_START, self.FIELD_APPT_END, self.FIELD_APPT_BOX, self.FIELD_APPT_DURATION,
+				self.FIELD_APPT_WORK_STARTED, self.FIELD_APPT_WORK_ENDED,
 			],
-			fields=["name", self.FIELD_APPT_START, self.FIELD_APPT_END, self.FIELD_APPT_BOX],
 			order_by=f"{self.FIELD_APPT_START} asc",
 		)
 
 	# ---- NEW: robust queue expand ----
-	def _get_queue_items(self, min_slot_start: datetime, day_end: datetime, step_minutes: int):
+	def _get_queue_bookings(self):
 		"""
-		Возвращает список элементов очереди вида:
-		  { "earliest_dt": datetime }
-		1 бронь = 1 машина (т.к. в твоём Doctype нет отдельной child-таблицы машин).
-		Берём только активные брони без назначенного апоинтмента.
+		Активные брони без назначенного апоинтмента (1 бронь = 1 машина,
+		т.к. в твоём Doctype нет отдельной child-таблицы машин).
+		Одна выборка на весь диапазон дней.
 		"""
+		if self._queue_bookings is not None:
+			return self._queue_bookings
 		# Найдём реальное линк-поле на Car wash в Booking
 		booking_filters = self._booking_filters_for_car_wash()
 		# Добавим статусы/флаги
@@ -230,7 +319,7 @@ class CarWashScheduler:
 			"has_appointment": ["in", [0, False]],
 		})
 
-		bookings = frappe.get_all(
+		return frappe.get_all(
 			self.DOCTYPE_BOOKING,
 			filters=booking_filters,
 			fields=["name", self.FIELD_BOOKING_DESIRED_TIME, "creation"],
@@ -238,6 +327,11 @@ class CarWashScheduler:
 			limit_page_length=1000,
 		)
 
+	def _get_queue_items(self, bookings, min_slot_start: datetime, day_end: datetime, step_minutes: int):
+		"""
+		Возвращает список элементов очереди одного дня вида:
+		  { "earliest_dt": datetime }
+		"""
 		items = []
 		for b in bookings:
 			desired = b.get(self.FIELD_BOOKING_DESIRED_TIME)
@@ -266,41 +360,60 @@ class CarWashScheduler:
 			pass
 		return {"car_wash": self.car_wash_name}
 
-	def _apply_appointments(self, timeline, appointments, step_minutes: int):
+	def _appointment_occupancies(self, appointments, now: datetime, step_minutes: int):
+		"""(box, start, end) для каждой записи; без длительности запись занимает один шаг."""
+		occupancies = []
 		for appt in appointments:
-			ap_s = appt.get(self.FIELD_APPT_START)
-			if not isinstance(ap_s, datetime):
-				continue
-			slot_time = self._floor_dt(ap_s, step_minutes)
-			idx = self._find_slot_index(timeline, slot_time, timedelta(minutes=step_minutes))
-			if idx < len(timeline) and timeline[idx][0] == slot_time:
-				slot_start, cap = timeline[idx]
-				timeline[idx] = (slot_start, max(0, cap - 1))
-
-	def _apply_queue(self, timeline, queue_items, step_minutes: int):
+			interval = self.appointment_interval(appt, now, timedelta(minutes=step_minutes))
+			if interval:
+				occupancies.append((appt.get(self.FIELD_APPT_BOX) or None, *interval))
+		return occupancies
+
+	def _apply_appointments(self, timeline: SlotTimeline, occupancies, step_minutes: int):
+		timeline.occupy(occupancies)
+
+	def _apply_queue(self, timeline: SlotTimeline, queue_items, step_minutes: int):
 		queue_items.sort(key=lambda x: x["earliest_dt"])
 		for q in queue_items:
-			earliest = q["earliest_dt"]
-			idx = self._find_slot_index(timeline, earliest, timedelta(minutes=step_minutes))
-			while idx < len(timeline):
-				slot_start, cap = timeline[idx]
-				if cap > 0:
-					timeline[idx] = (slot_start, cap - 1)
-					break
-				idx += 1
+			timeline.take_first_free(q["earliest_dt"])
 
 	# ---------- Helpers ----------
 
+	@classmethod
+	def appointment_interval(cls, appt, now: datetime, fallback: timedelta) -> Optional[tuple]:
+		"""
+		Реальная занятость бокса записью: (start, end) или None.
+		  - работа закончена: [work_started_on, work_ended_on]
+		  - работа идёт: от work_started_on до плановой длительности, но не раньше now
+		  - не начата: [starts_on, starts_on + duration_total], иначе ends_on, иначе fallback
+		"""
+		starts_on = appt.get(cls.FIELD_APPT_START)
+		if not isinstance(starts_on, datetime):
+			return None
+		duration = int(appt.get(cls.FIELD_APPT_DURATION) or 0)
+		ends_on = appt.get(cls.FIELD_APPT_END)
+		if duration > 0:
+			planned = timedelta(seconds=duration)
+		elif isinstance(ends_on, datetime) and ends_on > starts_on:
+			planned = ends_on - starts_on
+		else:
+			planned = fallback
+
+		work_started = appt.get(cls.FIELD_APPT_WORK_STARTED)
+		if not isinstance(work_started, datetime):
+			return starts_on, starts_on + planned
+		work_ended = appt.get(cls.FIELD_APPT_WORK_ENDED)
+		if isinstance(work_ended, datetime) and work_ended > work_started:
+			return work_started, work_ended
+		return work_started, max(work_started + planned, now)
+
 	@staticmethod
-	def _find_slot_index(timeline, when: datetime, step: timedelta) -> int:
-		if not timeline:
-			return 0
-		if when <= timeline[0][0]:
-			return 0
-		for i, (slot_start, _) in enumerate(timeline):
-			if slot_start >= when:
-				return i
-		return len(timeline)
+	def _as_date(value) -> date:
+		if isinstance(value, datetime):
+			return value.date()
+		if isinstance(value, date):
+			return value
+		return datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
 
 	@staticmethod
 	def _ceil_dt(dt_: datetime, step_minutes: int) -> datetime:
@@ -0,0 +1,226 @@
+# car_wash/city_search.py
+"""
+Поиск ближайших свободных слотов по всем мойкам города.
+
+Вместо вызова get_free_slots на каждую мойку данные всех моек города
+загружаются пакетно — постоянное число запросов (мойки, боксы, записи окна,
+очередь; графики работы и мойщики на смене — из кэша, см. working_schedule
+и staffing), затем для каждой мойки строится CarWashScheduler с
+предзагруженными данными (см. CarWashScheduler.preload).
+
+Дни окна обходятся по порядку: как только набрано `limit` пар (мойка, слот) и
+все они раньше начала следующего дня, следующие дни не считаются.
+"""
+
+import math
+from datetime import datetime, time, timedelta
+from typing import Any, Dict, List, Optional
+
+import frappe
+from frappe import _
+from frappe.utils import flt, now_datetime
+
+from ..car_wash.working_schedule import get_working_schedules
+from ..work_shift_schedule.staffing import get_staffing_many
+from .car_wash_scheduler import CarWashScheduler
+
+MAX_SEARCH_HOURS = 72
+MAX_QUEUE_PER_CAR_WASH = 1000  # как limit_page_length в CarWashScheduler._get_queue_bookings
+
+
+def _distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+	"""Расстояние по большому кругу (haversine)."""
+	lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+	return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+
+def load_city_data(city: str, window_start: datetime, window_end: datetime) -> List[Dict[str, Any]]:
+	"""
+	Всё, что нужно планировщику, для всех моек города — четыре запроса независимо от числа моек
+	(плюс по два на графики и на мойщиков каждого дня окна, которых нет в кэше).
+	Возвращает [{"name", "title", "lat", "lon", "schedule", "staffing", "boxes_count", "appointments", "queue_bookings"}].
+	"""
+	car_washes = frappe.get_all("Car wash", filters={"city": city}, fields=["name", "title", "lat", "lon"])
+	if not car_washes:
+		return []
+	names = [cw.name for cw in car_washes]
+	schedules = get_working_schedules(names)
+	staffing: Dict[str, Dict] = {name: {} for name in names}
+	day = window_start.date()
+	while day <= window_end.date():
+		for name, segments in get_staffing_many(names, day).items():
+			staffing[name][day] = segments
+		day += timedelta(days=1)
+	by_name = {
+		cw.name: {
+			"name": cw.name,
+			"title": cw.title,
+			"lat": cw.lat,
+			"lon": cw.lon,
+			"schedule": schedules[cw.name],
+			"staffing": staffing[cw.name],
+			"boxes": {"active": 0, "all": 0},
+			"appointments": [],
+			"queue_bookings": [],
+		}
+		for cw in car_washes
+	}
+
+	for row in frappe.get_all(
+		"Car wash box",
+		filters={"car_wash": ["in", names]},
+		fields=["car_wash", "is_deleted", "is_disabled"],
+		limit_page_length=0,
+	):
+		boxes = by_name[row.car_wash]["boxes"]
+		boxes["all"] += 1
+		if not row.is_deleted and not row.is_disabled:
+			boxes["active"] += 1
+
+	for row in frappe.get_all(
+		"Car wash appointment",
+		filters=[
+			["car_wash", "in", names],
+			["starts_on", ">=", window_start - CarWashScheduler.APPOINTMENT_LOOKBACK],
+			["starts_on", "<", window_end],
+			["is_deleted", "=", 0],
+		],
+		fields=[
+			"name", "car_wash", "starts_on", "ends_on", "box", "duration_total", "work_started_on", "work_ended_on",
+		],
+		order_by="starts_on asc",
+		limit_page_length=0,
+	):
+		by_name[row.car_wash]["appointments"].append(row)
+
+	for row in frappe.get_all(
+		"Car wash booking",
+		filters={
+			"car_wash": ["in", names],
+			"is_deleted": ["in", [0, False]],
+			"is_cancelled": ["in", [0, False]],
+			"has_appointment": ["in", [0, False]],
+		},
+		fields=["name", "car_wash", "desired_time", "creation"],
+		order_by="desired_time asc, creation asc",
+		limit_page_length=0,
+	):
+		queue = by_name[row.car_wash]["queue_bookings"]
+		if len(queue) < MAX_QUEUE_PER_CAR_WASH:
+			queue.append(row)
+
+	for data in by_name.values():
+		# Как CarWashScheduler._get_boxes_count: активные боксы, иначе все, иначе 1
+		boxes = data.pop("boxes")
+		data["boxes_count"] = boxes["active"] or boxes["all"] or CarWashScheduler.BOX_COUNT_FALLBACK
+	return list(by_name.values())
+
+
+def rank_city_slots(
+	car_washes: List[Dict[str, Any]],
+	now: datetime,
+	hours: float,
+	limit: int = 10,
+	step_minutes: int = 15,
+	per_car_wash: int = 1,
+	lat: Optional[float] = None,
+	lon: Optional[float] = None,
+) -> Dict[str, Any]:
+	"""
+	Первые `limit` пар (мойка, слот) со стартом в [now, now + hours), по времени старта,
+	затем по расстоянию до (lat, lon), если оно задано. Не больше per_car_wash слотов на мойку.
+	"""
+	window_end = now + timedelta(hours=hours)
+	step = timedelta(minutes=step_minutes)
+	schedulers = {
+		data["name"]: CarWashScheduler(data["name"]).preload(
+			schedule=data["schedule"],
+			staffing=data["staffing"],
+			boxes_count=data["boxes_count"],
+			appointments=data["appointments"],
+			queue_bookings=data["queue_bookings"],
+		)
+		for data in car_washes
+	}
+	distances = {}
+	if lat is not None and lon is not None:
+		for data in car_washes:
+			if data.get("lat") and data.get("lon"):
+				distances[data["name"]] = _distance_km(flt(lat), flt(lon), flt(data["lat"]), flt(data["lon"]))
+
+	found: List[Dict[str, Any]] = []
+	taken = {data["name"]: 0 for data in car_washes}
+	day = now.date()
+	days_computed = 0
+	while datetime.combine(day, time(0, 0, 0)) < window_end:
+		next_day_start = datetime.combine(day, time(0, 0, 0)) + timedelta(days=1)
+		days_computed += 1
+		for data in car_washes:
+			name = data["name"]
+			if taken[name] >= per_car_wash:
+				continue
+			timeline = schedulers[name].build_capacity_timelines(day, day, step_minutes, now=now).get(day)
+			if timeline is None:
+				continue
+			idx = timeline.next_free(0)
+			while idx < len(timeline) and taken[name] < per_car_wash:
+				slot_start = timeline.slot_start(idx)
+				if slot_start >= window_end:
+					break
+				found.append({
+					"car_wash": name,
+					"title": data.get("title"),
+					"start": slot_start,
+					"end": slot_start + step,
+					"capacity": timeline.capacity[idx],
+					"distance_km": round(distances[name], 2) if name in distances else None,
+				})
+				taken[name] += 1
+				idx = timeline.next_free(idx + 1)
+
+		# Все слоты следующих дней позже next_day_start — хватает ли уже найденного
+		found.sort(key=lambda r: (r["start"], r["distance_km"] if r["distance_km"] is not None else math.inf, r["title"] or ""))
+		if len(found) >= limit and found[limit - 1]["start"] < next_day_start:
+			break
+		day += timedelta(days=1)
+
+	results = []
+	for item in found[:limit]:
+		results.append(dict(
+			item,
+			start=item["start"].strftime("%Y-%m-%d %H:%M:%S"),
+			end=item["end"].strftime("%Y-%m-%d %H:%M:%S"),
+		))
+	return {"results": results, "car_washes": len(car_washes), "days_computed": days_computed}
+
+
+@frappe.whitelist()
+def find_free_slots_in_city(
+	city: str,
+	hours: float = 6,
+	limit: int = 10,
+	step_minutes: int = 15,
+	per_car_wash: int = 1,
+	lat: Optional[float] = None,
+	lon: Optional[float] = None,
+) -> Dict[str, Any]:
+	"""
+	Ближайшие свободные слоты во всех мойках города в пределах `hours` часов.
+	Returns {"results": [{"car_wash", "title", "start", "end", "capacity", "distance_km"}], "car_washes", "days_computed"}.
+	"""
+	if not city:
+		frappe.throw(_("City is required"))
+	hours = min(flt(hours) or 6, MAX_SEARCH_HOURS)
+	now = now_datetime()
+	car_washes = load_city_data(city, now, now + timedelta(hours=hours))
+	return rank_city_slots(
+		car_washes,
+		now,
+		hours,
+		limit=int(limit),
+		step_minutes=int(step_minutes),
+		per_car_wash=int(per_car_wash),
+		lat=flt(lat) if lat not in (None, "") else None,
+		lon=flt(lon) if lon not in (None, "") else None,
+	)
@@ -7,7 +7,7 @@ from typing import Any, Dict, List
 from .core import VisitsAggregator, RevenueAggregator, PaymentsAggregator, PriceControlAggregator, TariffsAggregator
 from .operational import UtilizationAggregator, ScheduleAggregator, QueueAggregator, CancellationsAggregator, BoxCapacityTypeAggregator
 from .analytics import ByDayAggregator, ByBoxAggregator, ByHourAggregator, StaffAggregator, CustomersAggregator, ServicesAggregator, CarSegmentAggregator
-from .special import PaymentLagAggregator, ForecastAggregator
+from .special import PaymentLagAggregator, ForecastAggregator, AnomaliesAggregator
 
 
 class AggregatorFactory:
@@ -88,3 +88,7 @@ class AggregatorFactory:
     @staticmethod
     def create_forecast_aggregator() -> ForecastAggregator:
         return ForecastAggregator()
+    
+    @staticmethod
+    def create_anomalies_aggregator() -> AnomaliesAggregator:
+        return AnomaliesAggregator()
@@ -6,6 +6,7 @@
 from typing import Any, Dict, List
 import frappe
 from ...base import MetricAggregator, ReportContext
+from .....car_wash.working_schedule import get_working_schedule
 
 
 class UtilizationAggregator(MetricAggregator):
@@ -22,13 +23,17 @@ class UtilizationAggregator(MetricAggregator):
             busy_seconds_sum += self._duration_seconds(r)
         
         boxes_count = max(1, len(self.boxes_data))
-        capacity_hours = (context.current_week.end - context.current_week.start).total_seconds() * boxes_count / 3600.0
+        # Ёмкость — рабочие часы недели по графику мойки (с исключениями), а не 24/7
+        schedule = get_working_schedule(context.car_wash)
+        open_seconds = schedule.open_seconds(context.current_week.start, context.current_week.end)
+        capacity_hours = open_seconds * boxes_count / 3600.0
         busy_hours = busy_seconds_sum / 3600.0
         util_pct = (busy_hours / capacity_hours * 100.0) if capacity_hours > 0 else 0.0
         
         return {
             "boxes": boxes_count,
             "busy_hours": round(busy_hours, 2),
+            "weekly_open_hours": round(open_seconds / 3600.0, 2),
             "weekly_capacity_hours": round(capacity_hours, 2),
             "utilization_pct": round(util_pct, 2),
         }
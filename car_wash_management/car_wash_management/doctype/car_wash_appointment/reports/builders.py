@@ -154,17 +154,9 @@ class ReportService:
         return f"weekly_report_{context.car_wash}_{context.current_week.start.date()}_{sections_hash}"
     
     def clear_cache(self, car_wash: str = None) -> None:
-        """Очищает кэш отчетов"""
-        if car_wash:
-            # Очищаем кэш для конкретной мойки
-            pattern = f"weekly_report_{car_wash}_*"
-            # В реальной реализации нужно использовать более сложную логику очистки
-            pass
-        else:
-            # Очищаем весь кэш отчетов
-            pattern = "weekly_report_*"
-            # В реальной реализации нужно использовать более сложную логику очистки
-            pass
+        """Очищает кэш отчетов: сброс версии делает устаревшими все секции мойки (или всех моек)"""
+        from .section_cache import clear
+        clear(car_wash)
 
 
 # Фабрика билдеров
@@ -137,6 +137,10 @@ def register_default_components():
         ReportSection.CAR_SEGMENT,
         AggregatorFactory.create_car_segment_aggregator()
     )
+    report_registry.register_aggregator(
+        ReportSection.ANOMALIES,
+        AggregatorFactory.create_anomalies_aggregator()
+    )
     # BOX_CAPACITY_TYPE создается в сервисе, т.к. требует список боксов при инициализации
     
     # Регистрируем билдеры
@@ -0,0 +1,66 @@
+# car_wash_management/car_wash_management/car_wash_management/doctype/car_wash_appointment/reports/report_benchmarks.py
+"""
+Бенчмарк недельного отчета: холодная и теплая задержка каждой секции.
+Запускать через: bench --site <site> execute car_wash_management.car_wash_management.doctype.car_wash_appointment.reports.report_benchmarks.benchmark_weekly_report --kwargs "{'car_wash': 'WASH-001', 'date': '2025-01-08'}"
+
+Холодный прогон — после сброса версии отчетов мойки (все секции пересчитываются),
+теплый — сразу за ним. Отдельно — полный отчет после изменения записи текущей недели:
+пересчитывается только текущая неделя (кроме forecast), предыдущая берется из кэша.
+"""
+
+import time
+from typing import Any, Dict, List
+
+from ...car_wash_booking.booking_price_and_duration.benchmarks import count_queries
+from ...car_wash_booking.booking_price_and_duration.versioning import bump_version
+from .base import ReportConfiguration, ReportSection
+from .section_cache import REPORT_NAMESPACE, WEEK_NAMESPACE, week_start
+from .service import ReportServiceFactory
+
+
+def _timed(fn, repeats: int) -> Dict[str, Any]:
+    timings = []
+    queries = 0
+    for _ in range(repeats):
+        with count_queries() as counter:
+            started = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - started) * 1000.0)
+        queries = counter["count"]
+    timings.sort()
+    return {"median_ms": round(timings[len(timings) // 2], 3), "max_ms": round(timings[-1], 3), "queries": queries}
+
+
+def benchmark_weekly_report(car_wash: str, date: str, repeats: int = 3) -> Dict[str, Any]:
+    service = ReportServiceFactory.create_weekly_service(ReportConfiguration())
+
+    def cold(sections: List[str]):
+        def run():
+            bump_version(REPORT_NAMESPACE, car_wash)
+            service.generate_report(car_wash, date, sections)
+        return run
+
+    def warm(sections: List[str]):
+        return lambda: service.generate_report(car_wash, date, sections)
+
+    result: Dict[str, Any] = {"sections": {}}
+    for section in ReportSection:
+        sections = [section.value]
+        result["sections"][section.value] = {
+            "cold": _timed(cold(sections), repeats),
+            "warm": _timed(warm(sections), repeats),
+        }
+
+    all_sections = [section.value for section in ReportSection]
+    current_week = f"{car_wash}:{week_start(date)}"
+
+    def after_appointment_change():
+        bump_version(WEEK_NAMESPACE, current_week)
+        service.generate_report(car_wash, date, all_sections)
+
+    result["full_report"] = {
+        "cold": _timed(cold(all_sections), repeats),
+        "warm": _timed(warm(all_sections), repeats),
+        "current_week_changed": _timed(after_appointment_change, repeats),
+    }
+    return result
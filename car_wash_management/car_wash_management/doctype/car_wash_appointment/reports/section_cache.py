@@ -0,0 +1,153 @@
+# car_wash_management/car_wash_management/car_wash_management/doctype/car_wash_appointment/reports/section_cache.py
+"""
+Кэш секций недельного отчета: запись на (мойка, неделя, секция) с версиями зависимостей.
+
+Секция зависит от версий (см. versioning):
+  - недели записей мойки — сбрасывается при изменении записи в этой неделе
+    (прежняя и новая неделя starts_on), остальные недели остаются теплыми;
+  - боксов мойки (utilization, by_box, box_capacity_type);
+  - графика работы (utilization) и прайс-каталога (price_control, tariffs);
+  - forecast — недель истории до начала недели, а не самой недели;
+  - отчетов мойки и всех моек — их сбрасывает clear_cache.
+Версии читаются до загрузки данных: сброс во время расчета сделает запись устаревшей.
+
+customers считает LTV и повторные визиты по всей истории клиентов (в том числе на
+других мойках), а forecast учитывает прогноз погоды (свой кэш на 6 часов) — обе секции
+кроме версий ограничены коротким TTL.
+"""
+
+import pickle
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import frappe
+from frappe.utils import get_datetime
+
+from .base import ReportSection
+from ...car_wash.working_schedule import VERSION_NAMESPACE as SCHEDULE_NAMESPACE
+from ...car_wash_booking.booking_price_and_duration.price_catalog import VERSION_NAMESPACE as PRICE_CATALOG_NAMESPACE
+from ...car_wash_booking.booking_price_and_duration.versioning import bump_version_now_and_after_commit, get_version
+
+SECTION_NAMESPACE = "weekly_report_section"
+WEEK_NAMESPACE = "weekly_report_week"
+BOXES_NAMESPACE = "weekly_report_boxes"
+REPORT_NAMESPACE = "weekly_report"
+ALL_CAR_WASHES = "*"
+ENTRY_TTL_SEC = 7 * 24 * 60 * 60
+FORECAST_HISTORY_WEEKS = 16
+
+BOX_SECTIONS = {ReportSection.UTILIZATION, ReportSection.BY_BOX, ReportSection.BOX_CAPACITY_TYPE}
+PRICE_SECTIONS = {ReportSection.PRICE_CONTROL, ReportSection.TARIFFS}
+SHORT_TTL_SECTIONS = {ReportSection.CUSTOMERS, ReportSection.FORECAST}
+
+Dependency = Tuple[str, str]
+
+
+def week_start(value) -> date:
+    """Понедельник недели, в которую попадает value."""
+    day = get_datetime(value).date()
+    return day - timedelta(days=day.weekday())
+
+
+def _week_key(car_wash: str, week: date) -> str:
+    return f"{car_wash}:{week}"
+
+
+def section_dependencies(section: ReportSection, car_wash: str, week: date) -> List[Dependency]:
+    """Версии, от которых зависит секция недели week."""
+    deps = [(REPORT_NAMESPACE, ALL_CAR_WASHES), (REPORT_NAMESPACE, car_wash)]
+    if section == ReportSection.FORECAST:
+        # Прогноз строится по истории до начала недели
+        deps += [
+            (WEEK_NAMESPACE, _week_key(car_wash, week - timedelta(weeks=offset)))
+            for offset in range(1, FORECAST_HISTORY_WEEKS + 1)
+        ]
+        return deps
+    deps.append((WEEK_NAMESPACE, _week_key(car_wash, week)))
+    if section in BOX_SECTIONS:
+        deps.append((BOXES_NAMESPACE, car_wash))
+    if section == ReportSection.UTILIZATION:
+        deps.append((SCHEDULE_NAMESPACE, car_wash))
+    if section in PRICE_SECTIONS:
+        deps.append((PRICE_CATALOG_NAMESPACE, car_wash))
+    return deps
+
+
+class SectionCache:
+    """Секции недель одной мойки: чтение и запись одним pipeline."""
+
+    def __init__(self, car_wash: str, short_ttl: int = 300):
+        self.car_wash = car_wash
+        self.short_ttl = short_ttl
+        self._versions: Dict[Dependency, str] = {}
+
+    def _key(self, week: date, section: ReportSection) -> str:
+        return f"{SECTION_NAMESPACE}:{self.car_wash}:{week}:{section.value}"
+
+    def versions(self, section: ReportSection, week: date) -> Tuple[str, ...]:
+        tokens = []
+        for dep in section_dependencies(section, self.car_wash, week):
+            if dep not in self._versions:
+                self._versions[dep] = get_version(*dep)
+            tokens.append(self._versions[dep])
+        return tuple(tokens)
+
+    def lookup(self, week: date, sections: List[ReportSection]) -> Tuple[Dict[str, Any], Dict[str, Tuple[str, ...]]]:
+        """
+        Актуальные секции недели и версии всех запрошенных секций
+        (их же передать в store — они прочитаны до загрузки данных).
+        """
+        versions = {section.value: self.versions(section, week) for section in sections}
+        cache = frappe.cache()
+        pipe = cache.pipeline(transaction=False)
+        for section in sections:
+            pipe.get(cache.make_key(self._key(week, section)))
+        found = {}
+        for section, payload in zip(sections, pipe.execute()):
+            if payload is None:
+                continue
+            entry = pickle.loads(payload)
+            if entry["versions"] == versions[section.value]:
+                found[section.value] = entry["value"]
+        return found, versions
+
+    def store(self, week: date, values: Dict[str, Any], versions: Dict[str, Tuple[str, ...]]) -> None:
+        cache = frappe.cache()
+        pipe = cache.pipeline(transaction=False)
+        for name, value in values.items():
+            section = ReportSection(name)
+            pipe.set(
+                cache.make_key(self._key(week, section)),
+                pickle.dumps({"versions": versions[name], "value": value}),
+                ex=self.short_ttl if section in SHORT_TTL_SECTIONS else ENTRY_TTL_SEC,
+            )
+        pipe.execute()
+
+
+# ---- инвалидация из контроллеров ----
+
+def _appointment_weeks(doc) -> List[Tuple[str, date]]:
+    if not doc or not doc.get("car_wash") or not doc.get("starts_on"):
+        return []
+    starts_on = get_datetime(doc.get("starts_on"))
+    weeks = [(doc.get("car_wash"), week_start(starts_on))]
+    if starts_on == datetime.combine(weeks[0][1], datetime.min.time()):
+        # Граница недели входит в обе (between в провайдере включает оба конца)
+        weeks.append((doc.get("car_wash"), weeks[0][1] - timedelta(weeks=1)))
+    return weeks
+
+
+def invalidate_appointment_weeks(before, doc) -> None:
+    """Запись сохранена (before — прежнее состояние) или удалена (doc=None): сбросить её недели."""
+    for car_wash, week in set(_appointment_weeks(before) + _appointment_weeks(doc)):
+        bump_version_now_and_after_commit(WEEK_NAMESPACE, _week_key(car_wash, week))
+
+
+def invalidate_boxes(car_wash: Optional[str]) -> None:
+    if car_wash:
+        bump_version_now_and_after_commit(BOXES_NAMESPACE, car_wash)
+
+
+def clear(car_wash: Optional[str] = None) -> None:
+    """Сбросить все секции мойки (или всех моек)."""
+    bump_version_now_and_after_commit(REPORT_NAMESPACE, car_wash or ALL_CAR_WASHES)
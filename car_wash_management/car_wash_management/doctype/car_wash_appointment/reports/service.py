@@ -7,10 +7,13 @@
 from datetime import datetime, timedelta
 from typing import Any, Dict, List, Optional
 import frappe
-from .base import ReportContext, WeekWindow, ReportConfiguration, report_registry
+from .base import ReportContext, ReportSection, WeekWindow, ReportConfiguration, report_registry
 from .providers import AppointmentDataProvider, BoxDataProvider
 from .aggregators import UtilizationAggregator
 from .builders import BuilderFactory
+from .section_cache import SectionCache
+
+SECTION_VALUES = {section.value for section in ReportSection}
 
 
 class WeeklyReportService:
@@ -46,20 +49,6 @@ class WeeklyReportService:
             
             frappe.logger().info(f"Report sections: {sections}")
             
-            # Загружаем данные
-            data = self._load_data(context)
-            
-            # Проверяем, что данные загружены
-            current_count = len(data["current"])
-            previous_count = len(data["previous"])
-            frappe.logger().info(f"Loaded data - current week: {current_count} records, previous week: {previous_count} records")
-            
-            if not data["current"] and not data["previous"]:
-                frappe.logger().warning(f"No data found for car_wash: {car_wash}, date: {date}")
-            
-            # Агрегируем метрики
-            current_sections = self._aggregate_sections(data["current"], context, sections)
-
             # Используем контекст предыдущей недели для корректных расчётов (ёмкость, боксы и т.д.)
             prev_context = ReportContext(
                 car_wash=context.car_wash,
@@ -70,7 +59,12 @@ class WeeklyReportService:
                 ),
                 generated_at=context.generated_at,
             )
-            previous_sections = self._aggregate_sections(data["previous"], prev_context, sections)
+            
+            # Сначала кэш секций: данные грузятся только для недель, где чего-то нет
+            section_cache = SectionCache(car_wash, short_ttl=self.config.cache_ttl)
+            boxes_holder: Dict[str, List[Dict[str, Any]]] = {}
+            current_sections = self._collect_sections(context, sections, section_cache, boxes_holder)
+            previous_sections = self._collect_sections(prev_context, sections, section_cache, boxes_holder)
             
             frappe.logger().info(f"Successfully aggregated {len(current_sections)} current sections and {len(previous_sections)} previous sections")
             
@@ -91,15 +85,14 @@ class WeeklyReportService:
             if not builder or not cache_manager:
                 raise RuntimeError("Required components not registered")
             
-            # Выполняем отчет
+            # Выполняем отчет (кэшируются секции, готовый JSON — нет: он устаревал бы целиком)
             from .builders import ReportService
             report_service = ReportService(cache_manager, builder)
             
             return report_service.execute_report(
                 context, 
                 report_data,
-                use_cache=self.config.enable_caching,
-                cache_ttl=self.config.cache_ttl,
+                use_cache=False,
                 sections_list=sections
             )
             
@@ -133,38 +126,36 @@ class WeeklyReportService:
         end = start + timedelta(days=7)
         return WeekWindow(start=start, end=end)
     
-    def _load_data(self, context: ReportContext) -> Dict[str, List[Dict[str, Any]]]:
-        """Загружает данные для обеих недель"""
-        appointment_provider = AppointmentDataProvider()
-        
-        # Загружаем данные отдельно для каждой недели (более эффективно)
-        current_appointments = appointment_provider.fetch_current_week_data(context)
-        
-        # Для предыдущей недели создаем отдельный контекст
-        prev_context = ReportContext(
-            car_wash=context.car_wash,
-            current_week=context.previous_week,
-            previous_week=WeekWindow(
-                start=context.previous_week.start - timedelta(days=7),
-                end=context.previous_week.start
-            ),
-            generated_at=context.generated_at
-        )
-        previous_appointments = appointment_provider.fetch_current_week_data(prev_context)
-        
-        return {
-            "current": current_appointments,
-            "previous": previous_appointments
-        }
+    def _collect_sections(self, context: ReportContext, sections: List[str], section_cache: SectionCache,
+                          boxes_holder: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Секции недели context: из кэша, недостающие — по записям недели (один запрос)"""
+        known = [ReportSection(s) for s in sections if s in SECTION_VALUES]
+        week = context.current_week.start.date()
+        
+        found, versions = section_cache.lookup(week, known) if self.config.enable_caching else ({}, {})
+        missing = [s.value for s in known if s.value not in found]
+        if missing:
+            appointments = AppointmentDataProvider().fetch_current_week_data(context)
+            frappe.logger().info(f"Loaded {len(appointments)} records for week {week}, sections: {missing}")
+            if "boxes" not in boxes_holder:
+                boxes_holder["boxes"] = BoxDataProvider().fetch_data(context)
+            computed = self._aggregate_sections(appointments, context, missing, boxes_holder["boxes"])
+            if self.config.enable_caching:
+                section_cache.store(week, computed, versions)
+            found.update(computed)
+        
+        # Порядок секций — как в запросе
+        return {s.value: found[s.value] for s in known if s.value in found}
     
     def _aggregate_sections(self, appointments: List[Dict[str, Any]], 
-                           context: ReportContext, sections: List[str]) -> Dict[str, Any]:
+                           context: ReportContext, sections: List[str],
+                           boxes: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
         """Агрегирует секции отчета"""
         result = {}
         
         # Загружаем боксы для утилизации
-        box_provider = BoxDataProvider()
-        boxes = box_provider.fetch_data(context)
+        if boxes is None:
+            boxes = BoxDataProvider().fetch_data(context)
         
         for section in sections:
             aggregator = self._get_aggregator(section, boxes)
@@ -8,6 +8,7 @@ from __future__ import annotations
 import frappe
 from .service import ReportServiceFactory, WeeklyReportService
 from .base import ReportConfiguration, ReportSection
+from ...car_wash_booking.booking_price_and_duration.single_flight import flight_key, single_flight
 
 
 # Создаем глобальный экземпляр сервиса
@@ -39,9 +40,13 @@ def get_weekly_owner_report(car_wash: str, date: str, sections: list = None) ->
     :param car_wash: имя/ID DocType 'Car wash'
     :param date: любая дата внутри нужной недели (YYYY-MM-DD)
     :param sections: список секций для включения в отчет (опционально)
+
+    Одинаковые одновременные запросы (мойка, дата, секции) одного пользователя считаются один раз.
     """
     service = _get_report_service()
-    return service.generate_report(car_wash, date, sections)
+    # Отчет читается с правами пользователя — общий только для его запросов
+    key = flight_key("get_weekly_owner_report", car_wash, date, sections, per_user=True)
+    return single_flight(key, lambda: service.generate_report(car_wash, date, sections), timeout=5.0)
 
 
 
@@ -0,0 +1,339 @@
+# car_wash/scheduler_benchmarks.py
+"""
+Бенчмарки расчёта свободных слотов.
+Запускать через: bench --site <site> execute car_wash_management.car_wash_management.doctype.car_wash_appointment.scheduler_benchmarks.benchmark_slot_timeline --kwargs "{'bookings': 2000}"
+
+benchmark_slot_timeline — синтетические данные (без БД), остальные читают данные мойки.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+import frappe
+from frappe.utils import add_days, getdate, now_datetime, nowdate
+
+from ..car_wash.working_schedule import WEEKDAYS, WorkingSchedule
+from ..car_wash_booking.booking_price_and_duration.benchmarks import count_queries
+from .availability_bitmap import DEFAULT_STEP_MINUTES, get_cached_free_slots, invalidate_car_wash
+from .box_assignment import BOX_TYPE_INDIVIDUAL_ONLY, BOX_TYPE_MIXED, AssignmentBox, AssignmentJob, BoxPlanner
+from .car_wash_scheduler import CarWashScheduler
+from .city_search import load_city_data, rank_city_slots
+from .slot_timeline import SlotTimeline
+
+DAY_START = datetime(2025, 1, 6)
+
+
+def build_synthetic_day(bookings: int, step_minutes: int, seed: int) -> Tuple[List[datetime], List[datetime]]:
+	"""Половина — записи на случайное время, половина — очередь с желаемым временем, отсортированная."""
+	rng = random.Random(seed)
+	minutes = 24 * 60
+	appointments = [DAY_START + timedelta(minutes=rng.randrange(minutes)) for _ in range(bookings // 2)]
+	queue = sorted(
+		DAY_START + timedelta(minutes=rng.randrange(0, minutes, step_minutes))
+		for _ in range(bookings - bookings // 2)
+	)
+	return appointments, queue
+
+
+def _legacy_free_slots(appointments, queue, boxes: int, step_minutes: int) -> List[Dict[str, Any]]:
+	"""Прежний алгоритм: список кортежей и линейный поиск слота — для сравнения."""
+	step = timedelta(minutes=step_minutes)
+	timeline = []
+	cur = DAY_START
+	while cur < DAY_START + timedelta(days=1):
+		timeline.append((cur, boxes))
+		cur += step
+
+	def find(when):
+		for i, (slot_start, _cap) in enumerate(timeline):
+			if slot_start >= when:
+				return i
+		return len(timeline)
+
+	for ap_s in appointments:
+		slot_time = DAY_START + (ap_s - DAY_START) // step * step
+		idx = find(slot_time)
+		if idx < len(timeline) and timeline[idx][0] == slot_time:
+			timeline[idx] = (slot_time, max(0, timeline[idx][1] - 1))
+	for earliest in queue:
+		idx = find(earliest)
+		while idx < len(timeline):
+			if timeline[idx][1] > 0:
+				timeline[idx] = (timeline[idx][0], timeline[idx][1] - 1)
+				break
+			idx += 1
+	return [
+		{"start": s.strftime("%Y-%m-%d %H:%M:%S"), "end": (s + step).strftime("%Y-%m-%d %H:%M:%S"), "capacity": c}
+		for s, c in timeline if c > 0
+	]
+
+
+def _occupancy_free_slots(appointments, queue, boxes: int, step_minutes: int, durations) -> List[Dict[str, Any]]:
+	timeline = SlotTimeline(DAY_START, DAY_START + timedelta(days=1), step_minutes)
+	timeline.fill_intervals([(DAY_START, DAY_START + timedelta(days=1))], boxes)
+	timeline.occupy(
+		(f"BOX-{idx % boxes}", ap_s, ap_s + duration) for idx, (ap_s, duration) in enumerate(zip(appointments, durations))
+	)
+	for earliest in queue:
+		timeline.take_first_free(earliest)
+	return timeline.free_slots(include_capacity=True)
+
+
+def _timeline_free_slots(appointments, queue, boxes: int, step_minutes: int) -> List[Dict[str, Any]]:
+	timeline = SlotTimeline(DAY_START, DAY_START + timedelta(days=1), step_minutes)
+	timeline.fill_intervals([(DAY_START, DAY_START + timedelta(days=1))], boxes)
+	for ap_s in appointments:
+		timeline.take_at(ap_s)
+	for earliest in queue:
+		timeline.take_first_free(earliest)
+	return timeline.free_slots(include_capacity=True)
+
+
+def benchmark_slot_timeline(
+	bookings: int = 2000,
+	boxes: int = 8,
+	step_minutes: int = 5,
+	sizes=(250, 500, 1000, 2000),
+	repeats: int = 3,
+	seed: int = 11,
+) -> Dict[str, Any]:
+	"""
+	Сутки с шагом step_minutes: прежний список кортежей против SlotTimeline.
+	"per_booking_us" у SlotTimeline не растёт с числом броней (у прежнего — растёт линейно).
+	"occupancy" — SlotTimeline с занятостью боксов по длительности записей (20–90 минут).
+	"""
+	sizes = sorted(set(sizes) | {bookings})
+	results = []
+	for size in sizes:
+		appointments, queue = build_synthetic_day(size, step_minutes, seed)
+		rng = random.Random(seed)
+		durations = [timedelta(minutes=rng.randrange(20, 91, 5)) for _ in appointments]
+		row = {"bookings": size}
+		for label, fn in (
+			("legacy", _legacy_free_slots),
+			("timeline", _timeline_free_slots),
+			("occupancy", lambda a, q, b, s: _occupancy_free_slots(a, q, b, s, durations)),
+		):
+			best = None
+			for _ in range(repeats):
+				started = time.perf_counter()
+				free = fn(appointments, queue, boxes, step_minutes)
+				elapsed = time.perf_counter() - started
+				best = elapsed if best is None else min(best, elapsed)
+			row[label] = {
+				"ms": round(best * 1000.0, 3),
+				"per_booking_us": round(best * 1e6 / size, 2),
+				"free_slots": len(free),
+			}
+		row["same_result"] = _legacy_free_slots(appointments, queue, boxes, step_minutes) == _timeline_free_slots(
+			appointments, queue, boxes, step_minutes)
+		row["speedup"] = round(row["legacy"]["ms"] / row["timeline"]["ms"], 1) if row["timeline"]["ms"] else None
+		results.append(row)
+	return {"boxes": boxes, "step_minutes": step_minutes, "slots": 24 * 60 // step_minutes, "results": results}
+
+
+def benchmark_free_slots_range(car_wash: str, days: int = 14, step_minutes: int = 15, repeats: int = 3) -> Dict[str, Any]:
+	"""
+	Календарь на `days` дней: цикл get_free_slots_for_date (новый планировщик на каждый день,
+	как отдельные HTTP-вызовы) против одного get_free_slots_for_range.
+	"""
+	start = getdate(nowdate())
+	dates = [add_days(start, offset) for offset in range(days)]
+
+	def per_day_loop():
+		return {
+			str(day): CarWashScheduler(car_wash).get_free_slots_for_date(
+				datetime.combine(day, datetime.min.time()), step_minutes=step_minutes)
+			for day in dates
+		}
+
+	def one_range():
+		return CarWashScheduler(car_wash).get_free_slots_for_range(dates[0], dates[-1], step_minutes=step_minutes)
+
+	result: Dict[str, Any] = {"car_wash": car_wash, "days": days, "step_minutes": step_minutes}
+	outputs = {}
+	for label, fn in (("per_day", per_day_loop), ("range", one_range)):
+		best = None
+		for _ in range(repeats):
+			with count_queries() as counter:
+				started = time.perf_counter()
+				outputs[label] = fn()
+				elapsed = time.perf_counter() - started
+			best = elapsed if best is None else min(best, elapsed)
+		result[label] = {"ms": round(best * 1000.0, 3), "queries": counter["count"]}
+	result["same_result"] = outputs["per_day"] == outputs["range"]
+	result["speedup"] = round(result["per_day"]["ms"] / result["range"]["ms"], 1) if result["range"]["ms"] else None
+	return result
+
+
+def benchmark_cached_free_slots(car_wash: str, days: int = 1, requests: int = 500) -> Dict[str, Any]:
+	"""
+	get_free_slots из битовых карт: холодный запрос (пересчёт), тёплые запросы (только Redis),
+	сравнение с полным пересчётом CarWashScheduler.
+	"""
+	start = getdate(nowdate())
+	end = add_days(start, days - 1)
+	invalidate_car_wash(car_wash)
+
+	with count_queries() as cold_counter:
+		started = time.perf_counter()
+		cached = get_cached_free_slots(car_wash, start, end, step_minutes=DEFAULT_STEP_MINUTES)
+		cold_ms = (time.perf_counter() - started) * 1000.0
+
+	samples = []
+	with count_queries() as warm_counter:
+		for _ in range(requests):
+			started = time.perf_counter()
+			get_cached_free_slots(car_wash, start, end, step_minutes=DEFAULT_STEP_MINUTES)
+			samples.append((time.perf_counter() - started) * 1000.0)
+	samples.sort()
+
+	full = CarWashScheduler(car_wash).get_free_slots_for_range(start, end, step_minutes=DEFAULT_STEP_MINUTES)
+	return {
+		"car_wash": car_wash,
+		"days": days,
+		"cold": {"ms": round(cold_ms, 3), "queries": cold_counter["count"]},
+		"warm": {
+			"p50_ms": round(samples[len(samples) // 2], 3),
+			"p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 3),
+			"queries": warm_counter["count"],
+		},
+		"same_result": cached == full,
+	}
+
+
+def build_synthetic_city(car_washes: int, now: datetime, appointments_per_day: int, seed: int) -> List[Dict[str, Any]]:
+	"""Мойки в формате city_search.load_city_data: 08–22 (часть круглосуточно), 2–6 боксов, записи на двое суток."""
+	rng = random.Random(seed)
+	day_start = datetime.combine(now.date(), datetime.min.time())
+	result = []
+	for idx in range(car_washes):
+		boxes = rng.randint(2, 6)
+		working_hours = [] if idx % 5 == 0 else [
+			frappe._dict(day_of_week=day, non_working=0, start_time=timedelta(hours=8), end_time=timedelta(hours=22))
+			for day in WEEKDAYS
+		]
+		appointments = []
+		for n in range(appointments_per_day * 2):
+			starts_on = day_start + timedelta(minutes=rng.randrange(0, 2 * 24 * 60, 5))
+			appointments.append(frappe._dict(
+				name=f"APP-{idx}-{n}", starts_on=starts_on, ends_on=None, box=f"BOX-{idx}-{n % boxes}",
+				duration_total=rng.randrange(20, 91, 5) * 60, work_started_on=None, work_ended_on=None,
+			))
+		appointments.sort(key=lambda a: a.starts_on)
+		result.append({
+			"name": f"CW-{idx:03d}",
+			"title": f"Car wash {idx}",
+			"lat": 51.1 + rng.random() / 10,
+			"lon": 71.4 + rng.random() / 10,
+			"schedule": WorkingSchedule.from_rows(working_hours),
+			"staffing": {},
+			"boxes_count": boxes,
+			"appointments": appointments,
+			"queue_bookings": [],
+		})
+	return result
+
+
+def benchmark_city_search(
+	car_washes: int = 200,
+	hours: float = 24,
+	limit: int = 10,
+	appointments_per_day: int = 60,
+	city: str = None,
+	repeats: int = 3,
+	seed: int = 13,
+) -> Dict[str, Any]:
+	"""
+	Поиск по городу: rank_city_slots на синтетических мойках против get_free_slots по каждой мойке
+	(те же предзагруженные данные — сравнивается только расчёт). С city — ещё и загрузка реального города.
+	"""
+	now = datetime.combine(getdate(nowdate()), datetime.min.time()) + timedelta(hours=20, minutes=7)
+	data = build_synthetic_city(car_washes, now, appointments_per_day, seed)
+	last_day = (now + timedelta(hours=hours)).date()
+
+	def per_car_wash():
+		found = []
+		for cw in data:
+			scheduler = CarWashScheduler(cw["name"]).preload(
+				schedule=cw["schedule"], staffing=cw["staffing"], boxes_count=cw["boxes_count"],
+				appointments=cw["appointments"], queue_bookings=cw["queue_bookings"],
+			)
+			for day, timeline in scheduler.build_capacity_timelines(now.date(), last_day, 15, now=now).items():
+				if timeline is not None:
+					found.extend((slot["start"], cw["name"]) for slot in timeline.free_slots(max_results=1))
+		return sorted(found)[:limit]
+
+	result: Dict[str, Any] = {"car_washes": car_washes, "hours": hours, "limit": limit}
+	for label, fn in (
+		("per_car_wash", per_car_wash),
+		("city_search", lambda: rank_city_slots(data, now, hours, limit=limit)),
+	):
+		best = None
+		for _ in range(repeats):
+			started = time.perf_counter()
+			output = fn()
+			elapsed = time.perf_counter() - started
+			best = elapsed if best is None else min(best, elapsed)
+		result[label] = {"ms": round(best * 1000.0, 3)}
+		if label == "city_search":
+			result[label]["days_computed"] = output["days_computed"]
+			result[label]["first"] = output["results"][:3]
+
+	if city:
+		with count_queries() as counter:
+			started = time.perf_counter()
+			loaded = load_city_data(city, now_datetime(), now_datetime() + timedelta(hours=hours))
+			load_ms = (time.perf_counter() - started) * 1000.0
+		result["real_city"] = {"car_washes": len(loaded), "load_ms": round(load_ms, 3), "queries": counter["count"]}
+	return result
+
+
+def build_synthetic_assignment(boxes: int, jobs: int, seed: int) -> Tuple[List[AssignmentBox], List[AssignmentJob]]:
+	"""Треть боксов IndividualOnly, пятая часть работ по договору, четверть — записи на своё время."""
+	rng = random.Random(seed)
+	box_list = [
+		AssignmentBox(f"BOX-{idx}", BOX_TYPE_INDIVIDUAL_ONLY if idx % 3 == 0 else BOX_TYPE_MIXED, f"Box {idx}")
+		for idx in range(boxes)
+	]
+	job_list = []
+	for idx in range(jobs):
+		fixed = idx % 4 == 0
+		job_list.append(AssignmentJob(
+			"Car wash appointment" if fixed else "Car wash booking",
+			f"JOB-{idx}",
+			rng.randrange(20, 91, 5) * 60,
+			rng.randrange(8 * 3600, 20 * 3600, 300),
+			fixed=fixed,
+			contract=rng.random() < 0.2,
+		))
+	# Очередь — в порядке желаемого времени, как из БД
+	job_list.sort(key=lambda j: (not j.fixed, j.earliest))
+	return box_list, job_list
+
+
+def benchmark_box_assignment(boxes: int = 12, jobs: int = 400, repeats: int = 5, seed: int = 17) -> Dict[str, Any]:
+	"""Назначение боксов на синтетический день 08–22 (без БД): время и сколько работ разложено."""
+	best = None
+	for _ in range(repeats):
+		box_list, job_list = build_synthetic_assignment(boxes, jobs, seed)
+		planner = BoxPlanner(box_list, [(8 * 3600, 22 * 3600)])
+		started = time.perf_counter()
+		assignments = planner.assign(job_list)
+		elapsed = time.perf_counter() - started
+		best = elapsed if best is None else min(best, elapsed)
+
+	misplaced = sum(
+		1 for a in assignments
+		if a.box and a.job.contract and planner.boxes[a.box].type == BOX_TYPE_INDIVIDUAL_ONLY
+	)
+	return {
+		"boxes": boxes,
+		"jobs": jobs,
+		"ms": round(best * 1000.0, 3),
+		"assigned": sum(1 for a in assignments if a.box),
+		"unassigned": sum(1 for a in assignments if not a.box),
+		"incompatible_placements": misplaced,
+	}
@@ -0,0 +1,189 @@
+# car_wash/slot_timeline.py
+"""
+Массив вместимости по слотам одного окна [start, end) с шагом step_minutes.
+
+- capacity — array('i'), слот по времени находится за O(1): (dt - start) // step;
+- next_free — "следующий слот со свободной вместимостью" на union-find
+  (path halving): заполненный слот склеивается со следующим, поэтому
+  размещение очереди стоит почти O(1) на машину вместо прохода по списку;
+- limit — потолок вместимости по интервалам (мойщики на смене);
+- occupy — занятость боксов по реальным интервалам записей: интервалы
+  одного бокса сливаются (сортировка), затем разностный массив по слотам —
+  O(N log N + слоты) вместо проверки каждой записи в каждом слоте.
+
+Нет зависимостей от frappe — используется CarWashScheduler и бенчмарками.
+"""
+
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class SlotTimeline:
+	__slots__ = ("start", "step", "step_seconds", "capacity", "_next")
+
+	def __init__(self, start: datetime, end: datetime, step_minutes: int):
+		self.start = start
+		self.step = timedelta(minutes=step_minutes)
+		self.step_seconds = step_minutes * 60
+		size = max(0, -(-int((end - start).total_seconds()) // self.step_seconds))
+		self.capacity = array("i", bytes(4 * size))
+		# _next[i] == i — в слоте есть вместимость; _next[size] == size — "свободных дальше нет"
+		self._next = array("i", range(1, size + 1))
+		self._next.append(size)
+
+	@classmethod
+	def from_capacity(cls, start: datetime, step_minutes: int, capacity: Iterable[int]) -> "SlotTimeline":
+		"""Таймлайн с уже посчитанной вместимостью слотов (например, сохранённой в кэше)."""
+		capacity = array("i", capacity)
+		timeline = cls(start, start + len(capacity) * timedelta(minutes=step_minutes), step_minutes)
+		timeline.capacity = capacity
+		timeline._relink()
+		return timeline
+
+	def __len__(self) -> int:
+		return len(self.capacity)
+
+	# ---------- построение ----------
+
+	def fill_intervals(self, intervals: Iterable[Tuple[datetime, datetime]], capacity: int) -> None:
+		"""capacity в слотах, чьё начало попадает в [st, et) одного из интервалов."""
+		size = len(self.capacity)
+		for st, et in intervals:
+			first = max(0, self._ceil_index(st))
+			last = min(size, self._ceil_index(et))
+			if first < last:
+				self.capacity[first:last] = array("i", [capacity]) * (last - first)
+		self._relink()
+
+	def limit(self, caps: Iterable[Tuple[datetime, datetime, int]]) -> None:
+		"""Не больше cap в слотах, чьё начало попадает в [st, et) (например, мойщиков на смене)."""
+		size = len(self.capacity)
+		capacity = self.capacity
+		for st, et, cap in caps:
+			for idx in range(max(0, self._ceil_index(st)), min(size, self._ceil_index(et))):
+				if capacity[idx] > cap:
+					capacity[idx] = max(0, cap)
+		self._relink()
+
+	def occupy(self, occupancies: Iterable[Tuple[Optional[str], datetime, datetime]]) -> None:
+		"""
+		Снять вместимость под записи (box, start, end): слот теряет единицу за каждый бокс,
+		занятый хоть на часть слота. Запись без бокса занимает "какой-то" бокс — считается
+		отдельно (консервативно).
+		"""
+		size = len(self.capacity)
+		by_box: Dict[Optional[str], List[Tuple[int, int]]] = {}
+		for box, st, et in occupancies:
+			first = max(0, self.index_of(st))
+			last = min(size, self._ceil_index(et))
+			if first < last:
+				by_box.setdefault(box, []).append((first, last))
+		if not by_box:
+			return
+
+		diff = [0] * (size + 1)
+		for box, ranges in by_box.items():
+			if box is None:
+				merged = ranges
+			else:
+				# Пересечения внутри одного бокса не занимают второй бокс
+				ranges.sort()
+				merged = []
+				for first, last in ranges:
+					if merged and first <= merged[-1][1]:
+						if last > merged[-1][1]:
+							merged[-1] = (merged[-1][0], last)
+					else:
+						merged.append((first, last))
+			for first, last in merged:
+				diff[first] += 1
+				diff[last] -= 1
+
+		busy = 0
+		capacity = self.capacity
+		for idx in range(size):
+			busy += diff[idx]
+			if busy:
+				capacity[idx] = max(0, capacity[idx] - busy)
+		self._relink()
+
+	def _relink(self) -> None:
+		# Пересобираем ссылки: нулевые слоты сразу пропускаются
+		for idx in range(len(self.capacity) - 1, -1, -1):
+			self._next[idx] = idx if self.capacity[idx] > 0 else self._next[idx + 1]
+
+	# ---------- индексация ----------
+
+	def index_of(self, when: datetime) -> int:
+		"""Индекс слота, в который попадает when (может быть вне [0, len))."""
+		return int((when - self.start).total_seconds()) // self.step_seconds
+
+	def _ceil_index(self, when: datetime) -> int:
+		return -(-int((when - self.start).total_seconds()) // self.step_seconds)
+
+	def slot_start(self, idx: int) -> datetime:
+		return self.start + idx * self.step
+
+	# ---------- списание вместимости ----------
+
+	def next_free(self, idx: int) -> int:
+		"""Первый слот >= idx с вместимостью > 0; len(self), если таких нет."""
+		size = len(self.capacity)
+		if idx >= size:
+			return size
+		nxt = self._next
+		idx = max(idx, 0)
+		while nxt[idx] != idx:
+			nxt[idx] = nxt[nxt[idx]]
+			idx = nxt[idx]
+		return idx
+
+	def take(self, idx: int) -> bool:
+		"""Списать единицу вместимости в слоте idx (не уходя в минус)."""
+		if not 0 <= idx < len(self.capacity) or self.capacity[idx] <= 0:
+			return False
+		self.capacity[idx] -= 1
+		if self.capacity[idx] == 0:
+			self._next[idx] = idx + 1
+		return True
+
+	def take_at(self, when: datetime) -> bool:
+		"""Списать слот, в который попадает when (без учёта длительности)."""
+		return self.take(self.index_of(when))
+
+	def take_first_free(self, earliest: datetime) -> Optional[int]:
+		"""Машина из очереди занимает первый свободный слот не раньше earliest."""
+		idx = self.next_free(self._ceil_index(earliest))
+		return idx if self.take(idx) else None
+
+	# ---------- выдача ----------
+
+	def free_bits(self) -> int:
+		"""Битовая карта: бит i установлен, если в слоте i есть вместимость."""
+		bits = 0
+		idx = self.next_free(0)
+		size = len(self.capacity)
+		while idx < size:
+			bits |= 1 << idx
+			idx = self.next_free(idx + 1)
+		return bits
+
+	def free_slots(self, max_results: Optional[int] = None, include_capacity: bool = False) -> List[Dict]:
+		free = []
+		capacity = self.capacity
+		idx = self.next_free(0)
+		size = len(capacity)
+		while idx < size:
+			slot_start = self.slot_start(idx)
+			item = {
+				"start": slot_start.strftime("%Y-%m-%d %H:%M:%S"),
+				"end": (slot_start + self.step).strftime("%Y-%m-%d %H:%M:%S"),
+			}
+			if include_capacity:
+				item["capacity"] = capacity[idx]
+			free.append(item)
+			if max_results and len(free) >= max_results:
+				break
+			idx = self.next_free(idx + 1)
+		return free
@@ -1,9 +1,82 @@
 # Copyright (c) 2024, Rifat Dzhumagulov and Contributors
 # See license.txt
 
-# import frappe
+from datetime import datetime, timedelta
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+
+from ..car_wash_booking.booking_price_and_duration.benchmarks import count_queries
+from ..car_wash_booking.slot_holds import slot_start
+from .availability_bitmap import get_cached_free_slots
+from .city_search import find_free_slots_in_city, rank_city_slots
+from .scheduler_benchmarks import build_synthetic_city
 
 
 class TestCarwashappointment(FrappeTestCase):
 	pass
+
+
+class TestAvailabilityBitmapQueue(FrappeTestCase):
+	def setUp(self):
+		self.car_wash = frappe.db.get_value("Car wash", {}, "name")
+		self.car, self.customer = frappe.db.get_value("Car wash car", {}, ["name", "customer"]) or (None, None)
+		if not self.car_wash or not self.car:
+			self.skipTest("No Car wash and Car wash car to book")
+		self.slot = slot_start(now_datetime() + timedelta(days=1))
+		self.booking = None
+
+	def tearDown(self):
+		if self.booking:
+			frappe.delete_doc("Car wash booking", self.booking, force=True, ignore_permissions=True)
+		frappe.db.commit()
+
+	def _capacity(self):
+		day = self.slot.date()
+		slots = get_cached_free_slots(self.car_wash, day, day, include_capacity=True)[str(day)]
+		start = self.slot.strftime("%Y-%m-%d %H:%M:%S")
+		return next((slot["capacity"] for slot in slots if slot["start"] == start), 0)
+
+	def test_committed_queue_booking_takes_cached_capacity(self):
+		capacity = self._capacity()  # день попадает в кэш
+		if not capacity:
+			self.skipTest("No free capacity at the test slot")
+		self.booking = frappe.get_doc({
+			"doctype": "Car wash booking",
+			"car_wash": self.car_wash,
+			"customer": self.customer,
+			"car": self.car,
+			"payment_status": "Not paid",
+			"desired_time": self.slot,
+		}).insert(ignore_permissions=True).name
+		frappe.db.commit()
+
+		# Запись дня обновлена на месте после коммита: чтение не пересобирает её из БД
+		with count_queries() as counter:
+			self.assertEqual(self._capacity(), capacity - 1)
+		self.assertEqual(counter["count"], 0)
+
+
+class TestCitySearch(FrappeTestCase):
+	def test_rank_city_slots_on_loaded_format(self):
+		# Данные в формате load_city_data: preload должен принимать всё, что она возвращает
+		now = datetime(2030, 1, 7, 20, 7)
+		car_washes = build_synthetic_city(12, now, appointments_per_day=20, seed=3)
+		with count_queries() as counter:
+			result = rank_city_slots(car_washes, now, hours=24, limit=5)
+		self.assertEqual(counter["count"], 0)  # графики и мойщики предзагружены
+		self.assertEqual(result["car_washes"], 12)
+		self.assertEqual(len(result["results"]), 5)
+		starts = [row["start"] for row in result["results"]]
+		self.assertEqual(starts, sorted(starts))
+		self.assertGreaterEqual(starts[0], now.strftime("%Y-%m-%d %H:%M:%S"))
+
+	def test_find_free_slots_in_city_end_to_end(self):
+		city = frappe.db.get_value("Car wash", {"city": ["is", "set"]}, "city")
+		if not city:
+			self.skipTest("No Car wash with a city")
+		result = find_free_slots_in_city(city, hours=24, limit=3)
+		self.assertGreaterEqual(result["car_washes"], 1)
+		for row in result["results"]:
+			self.assertGreaterEqual(row["start"], (now_datetime() - timedelta(minutes=15)).strftime("%Y-%m-%d %H:%M:%S"))
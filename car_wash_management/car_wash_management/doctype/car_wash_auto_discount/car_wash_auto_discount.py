@@ -3,7 +3,12 @@
 
 import frappe
 from frappe.model.document import Document
-from frappe.utils import now_datetime, getdate, flt
+from frappe.utils import getdate
+
+from ..car_wash_booking.booking_price_and_duration.auto_discount_rules import (
+    bump_discount_set_version,
+    compile_auto_discount_doc,
+)
 
 
 class Carwashautodiscount(Document):
@@ -29,20 +34,23 @@ class Carwashautodiscount(Document):
 
     # single-field condition validation removed (rules-only)
 
-    def is_valid_for_date(self, check_date=None):
-        """Check if discount is valid for given date"""
-        if not check_date:
-            check_date = now_datetime().date()
+    def on_update(self):
+        bump_discount_set_version(self.car_wash)
+        previous = self.get_doc_before_save()
+        if previous and previous.car_wash != self.car_wash:
+            bump_discount_set_version(previous.car_wash)
 
-        check_date = getdate(check_date)
+    def on_trash(self):
+        bump_discount_set_version(self.car_wash)
 
-        if self.valid_from and check_date < getdate(self.valid_from):
-            return False
+    # Evaluation goes through the compiled form (auto_discount_rules), same as quotes
 
-        if self.valid_to and check_date > getdate(self.valid_to):
-            return False
+    def compiled(self):
+        return compile_auto_discount_doc(self)
 
-        return True
+    def is_valid_for_date(self, check_date=None):
+        """Check if discount is valid for given date"""
+        return self.compiled().is_valid_for_date(check_date)
 
     def is_condition_met(self, customer_stats, services=None):
         """
@@ -50,158 +58,17 @@ class Carwashautodiscount(Document):
 
         Args:
             customer_stats: Stats from car_wash_client.get_statistics()
-            services: List of services in current booking (for service-specific conditions)
+            services: unused, kept for compatibility (service rules read top_services from stats)
         """
-        if not customer_stats or not customer_stats.get("periods"):
-            print("customer_stats is not valid")
-            return False
-
-        print("customer_stats is valid")
-
-        # Rules-only evaluation
-        return self._evaluate_rules(customer_stats, services)
-
-    def _evaluate_rules(self, customer_stats, services=None):
-        """Evaluate multiple rules with AND/OR logic"""
-        logic = (self.rules_logic or "ALL (AND)").strip().upper()
-        results = []
-        print("rules", self.rules)
-        for rule in self.rules:
-            results.append(self._evaluate_single_rule(rule, customer_stats, services))
-        if not results:
-            return False
-        if logic.startswith("ALL"):
-            return all(results)
-        return any(results)
-
-    def _evaluate_single_rule(self, rule, customer_stats, services=None):
-        """Evaluate a single rule row"""
-        periods = customer_stats.get("periods", {})
-        rule_type = (rule.rule_type or "").strip()
-        operator = (rule.operator or ">=").strip()
-        period_key = (rule.period or "all_time").strip() or "all_time"
-        period_stats = periods.get(period_key, {})
-
-        print("rule", rule)
-        print("rule_type", rule_type)
-        print("operator", operator)
-        print("period_key", period_key)
-        print("period_stats", period_stats)
-
-        # Nth Order rule (every Nth order)
-        if rule_type == "Nth Order":
-            all_time = periods.get("all_time", {})
-            next_order_no = int(all_time.get("total_appointments", 0) or 0) + 1
-            step = int(rule.nth_step or 0)
-            offset = int(rule.nth_offset or 0)
-            if step <= 0:
-                return False
-            return ((next_order_no - offset) % step) == 0
-
-        # Map rule types to values
-        if rule_type == "Total Orders Count":
-            actual = period_stats.get("total_appointments", 0)
-        elif rule_type == "Paid Orders Count":
-            actual = period_stats.get("paid_appointments", 0)
-        elif rule_type == "Total Spent Amount":
-            actual = period_stats.get("spent_total", 0.0)
-        elif rule_type == "Unique Cars Count":
-            actual = period_stats.get("unique_cars", 0)
-        elif rule_type == "Average Ticket Amount":
-            actual = period_stats.get("avg_ticket", 0.0)
-        elif rule_type == "First Time Customer":
-            all_time_stats = periods.get("all_time", {})
-            period_paid = period_stats.get("paid_appointments", 0) or 0
-            all_time_paid = all_time_stats.get("paid_appointments", 0) or 0
-            return all_time_paid == 0
-        elif rule_type == "Last Visit Days Ago":
-            last_visit = period_stats.get("last_visit_on")
-            if not last_visit:
-                return False
-            actual = (now_datetime().date() - getdate(last_visit)).days
-        elif rule_type == "Service Usage Count":
-            # If rule has own services list, use it; otherwise fallback to document-level target_services
-            if getattr(rule, "services", None):
-                target_services = [row.service for row in rule.services]
-            else:
-                target_services = [row.service for row in (self.target_services or [])]
-            actual = self._get_service_usage_count(period_stats.get("top_services", []), target_services)
-        else:
-            return False
-
-        target = flt(rule.value or 0)
-        return self._check_operator(operator, actual, target)
-
-    def _check_operator(self, operator, actual_value, target_value):
-        """Generic operator check for rule rows"""
-        actual_value = flt(actual_value)
-        target_value = flt(target_value)
-        if operator == ">=":
-            return actual_value >= target_value
-        if operator == ">":
-            return actual_value > target_value
-        if operator == "=":
-            return actual_value == target_value
-        if operator == "<":
-            return actual_value < target_value
-        if operator == "<=":
-            return actual_value <= target_value
-        return False
-
-    def _get_service_usage_count(self, top_services, target_service_names=None):
-        """Get usage count for target services"""
-        if not target_service_names:
-            if not self.target_services:
-                return 0
-            target_service_names = [row.service for row in self.target_services]
-        total_count = 0
-
-        for service_stat in top_services:
-            if service_stat.get("service") in target_service_names:
-                total_count += service_stat.get("count", 0)
-
-        return total_count
-
-    def _check_condition_operator(self, actual_value, target_value):
-        """Check condition based on operator"""
-        actual_value = flt(actual_value)
-        target_value = flt(target_value)
-
-        if self.condition_operator == ">=":
-            return actual_value >= target_value
-        elif self.condition_operator == ">":
-            return actual_value > target_value
-        elif self.condition_operator == "=":
-            return actual_value == target_value
-        elif self.condition_operator == "<":
-            return actual_value < target_value
-        elif self.condition_operator == "<=":
-            return actual_value <= target_value
-
-        return False
+        return self.compiled().is_condition_met(customer_stats)
 
     def is_applicable_to_services(self, services):
         """Check if discount applies to given services"""
-        if not self.applicable_services:
-            # If no specific services defined, applies to all
-            return True
-
-        applicable_service_names = [row.service for row in self.applicable_services]
-
-        # Check if any of the booking services match applicable services
-        for service in services:
-            service_name = service if isinstance(service, str) else service.get("service_id")
-            if service_name in applicable_service_names:
-                return True
-
-        return False
+        return self.compiled().is_applicable_to_services(services)
 
     def calculate_discount_amount(self, services_total):
         """Calculate discount amount based on discount type and value"""
-        if self.discount_type == "Percentage":
-            return (services_total * self.discount_value) / 100
-        else:  # Fixed Amount
-            return min(self.discount_value, services_total)  # Don't exceed total amount
+        return self.compiled().calculate_discount_amount(services_total)
 
 
 @frappe.whitelist()
@@ -0,0 +1,98 @@
+# Copyright (c) 2025, Rifat and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from ..car_wash_booking.booking_price_and_duration.auto_discounts import refresh_recorded_auto_discount_usage
+from ..car_wash_booking.booking_price_and_duration.benchmarks import count_queries
+from ..car_wash_booking.booking_price_and_duration.usage_ledger import get_usage_rows, insert_usage_rows
+from ..car_wash_booking.booking_price_and_duration.workflow_helpers import set_auto_discount_usage_flags
+
+
+def _usage_rows(car_wash, context_id, count):
+	return [
+		{
+			"car_wash": car_wash,
+			"context_type": "Booking",
+			"context_id": context_id,
+			"discount_id": f"TEST-AD-{idx}",
+			"discount_name": f"Test discount {idx}",
+			"service_discount": 100.0,
+			"commission_waived": 0.0,
+			"total_discount": 100.0,
+		}
+		for idx in range(count)
+	]
+
+
+class TestCarwashautodiscountusage(FrappeTestCase):
+	def setUp(self):
+		self.car_wash = frappe.db.get_value("Car wash", {}, "name")
+		if not self.car_wash:
+			self.skipTest("No Car wash to record usage for")
+
+	def tearDown(self):
+		# Строки и счётчик серии пишутся в транзакции теста
+		frappe.db.rollback()
+
+	def _new_context(self):
+		return f"TEST-{frappe.generate_hash(length=10)}"
+
+	def _insert_statements(self, count):
+		"""Every SQL statement issued while inserting `count` rows."""
+		context_id = self._new_context()
+		with count_queries() as counter:
+			names = insert_usage_rows(self.car_wash, _usage_rows(self.car_wash, context_id, count))
+		self.assertEqual(len(set(names)), count)
+		self.assertEqual([r.name for r in get_usage_rows("Booking", context_id)], names)
+		return counter["count"]
+
+	def test_statement_count_does_not_grow_with_rows(self):
+		self._insert_statements(1)  # прогрев meta
+		self.assertEqual(self._insert_statements(2), self._insert_statements(40))
+
+	def _insert_one(self, context_id):
+		doc = frappe.get_doc({"doctype": "Car wash auto discount usage", **_usage_rows(self.car_wash, context_id, 1)[0]})
+		doc.flags.ignore_links = True
+		return doc.insert(ignore_permissions=True).name
+
+	def test_names_continue_the_insert_series(self):
+		context_id = self._new_context()
+		before = self._insert_one(context_id)
+		bulk = insert_usage_rows(self.car_wash, _usage_rows(self.car_wash, context_id, 3))
+		after = self._insert_one(context_id)
+
+		prefix, number = before.rsplit("-", 1)
+		expected = [f"{prefix}-{int(number) + offset:0{len(number)}d}" for offset in range(1, 5)]
+		self.assertEqual(bulk + [after], expected)
+
+	def test_flags_touch_only_changed_rows(self):
+		context_id = self._new_context()
+		insert_usage_rows(self.car_wash, _usage_rows(self.car_wash, context_id, 30))
+		disabled = {"TEST-AD-1", "TEST-AD-2"}
+
+		with count_queries() as counter:
+			set_auto_discount_usage_flags("Booking", context_id, disabled, enable_others=True)
+		self.assertEqual(counter["count"], 2)  # чтение + один UPDATE
+		flags = {r.discount_id: r.is_disabled for r in get_usage_rows("Booking", context_id, fields=["is_disabled"])}
+		self.assertEqual({d for d, flag in flags.items() if flag}, disabled)
+
+		with count_queries() as counter:
+			set_auto_discount_usage_flags("Booking", context_id, disabled, enable_others=True)
+		self.assertEqual(counter["count"], 1)  # ничего не изменилось — только чтение
+
+	def test_refresh_writes_once_and_only_changes(self):
+		context_id = self._new_context()
+		insert_usage_rows(self.car_wash, _usage_rows(self.car_wash, context_id, 30))
+
+		# Скидок TEST-AD-* нет, поэтому суммы обнуляются — меняются все строки
+		with count_queries() as counter:
+			result = refresh_recorded_auto_discount_usage("Booking", context_id, 5000, 100)
+		self.assertEqual(result["updated_count"], 30)
+		self.assertEqual(counter["count"], 3)  # строки, скидки, один UPDATE
+
+		with count_queries() as counter:
+			result = refresh_recorded_auto_discount_usage("Booking", context_id, 5000, 100)
+		self.assertEqual(result["updated_count"], 0)
+		self.assertEqual(counter["count"], 2)
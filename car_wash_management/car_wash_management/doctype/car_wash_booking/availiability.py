@@ -1,4 +1,5 @@
 import frappe
+from frappe.utils import cint
 
 
 def create_availability(doc):
@@ -24,30 +25,37 @@ def update_or_create_availability(doc):
         return
 
 
-def update_cars_in_queue(doc):
-    """
-    Increments `cars_in_queue` in `Car Wash Availability` when `has_appointment`
-    changes from False to True in `Car Wash Booking`.
-    """
-    if doc.is_new():
-        try:
-            update_queue_num(doc)
-        except frappe.DoesNotExistError:
-            create_availability(doc)
-        return
+def is_in_queue(doc) -> bool:
+    """Бронь стоит в очереди мойки: не удалена, не отменена и ещё без записи."""
+    return bool(doc and doc.get("car_wash")) and not (
+        cint(doc.get("is_deleted")) or cint(doc.get("is_cancelled")) or cint(doc.get("has_appointment"))
+    )
 
-    # Fetch the previous state of the document
-    previous_doc = frappe.get_doc("Car wash booking", doc.name)
 
-    # Check if has_appointment changed from False → True
-    if not previous_doc.has_appointment and doc.has_appointment:
+def update_cars_in_queue(before, doc):
+    """
+    Переход брони (before — прежнее состояние, None для новой; doc=None — удаление)
+    меняет `cars_in_queue` мойки атомарным UPDATE на ±1. Без перехода — ни одного запроса;
+    пересчёт очереди и сохранение `Car wash availability` не нужны.
+    """
+    deltas = {}
+    if is_in_queue(before):
+        deltas[before.get("car_wash")] = deltas.get(before.get("car_wash"), 0) - 1
+    if is_in_queue(doc):
+        deltas[doc.get("car_wash")] = deltas.get(doc.get("car_wash"), 0) + 1
 
-        # Fetch the corresponding Car Wash Availability document
-        try:
-            update_queue_num(doc)
-        except frappe.DoesNotExistError:
-            create_availability(doc)
-            return  # If the document doesn't exist, safely exit
+    for car_wash, delta in deltas.items():
+        if not delta:
+            continue
+        # Строки ещё нет — её создаст бокс мойки или reconcile_availability_counters
+        frappe.db.sql(
+            """
+            UPDATE `tabCar wash availability`
+            SET cars_in_queue = GREATEST(cars_in_queue + %s, 0)
+            WHERE name = %s
+            """,
+            (delta, car_wash),
+        )
 
 
 def get_cars_in_queue(doc):
@@ -60,3 +68,59 @@ def update_queue_num(doc):
     availability_doc.cars_in_queue = get_cars_in_queue(doc)
     availability_doc.boxes_count = boxes_count
     availability_doc.save(ignore_permissions=True)
+
+
+def reconcile_availability_counters(commit: bool = True):
+    """
+    Ежечасная сверка: cars_in_queue и boxes_count по всем мойкам двумя группированными
+    запросами; пишутся только расходящиеся строки, недостающие создаются.
+    commit=True (задача планировщика) — коммит по каждой мойке, сбой одной откатывает
+    только её; commit=False — всё в транзакции вызывающего, ошибки пробрасываются.
+    """
+    queue = dict(frappe.db.sql(
+        """
+        SELECT car_wash, COUNT(*) FROM `tabCar wash booking`
+        WHERE has_appointment = 0 AND is_cancelled = 0 AND is_deleted = 0 AND car_wash IS NOT NULL
+        GROUP BY car_wash
+        """
+    ))
+    boxes = dict(frappe.db.sql(
+        """
+        SELECT car_wash, COUNT(*) FROM `tabCar wash box`
+        WHERE car_wash IS NOT NULL
+        GROUP BY car_wash
+        """
+    ))
+    current = {
+        row.name: row
+        for row in frappe.get_all(
+            "Car wash availability", fields=["name", "cars_in_queue", "boxes_count"], limit_page_length=0)
+    }
+
+    created = repaired = 0
+    for car_wash in frappe.get_all("Car wash", pluck="name"):
+        expected = {"cars_in_queue": cint(queue.get(car_wash)), "boxes_count": cint(boxes.get(car_wash))}
+        try:
+            row = current.get(car_wash)
+            if row is None:
+                if not boxes.get(car_wash):
+                    continue  # как и раньше, строка появляется вместе с первым боксом
+                create_availability(frappe._dict(car_wash=car_wash))
+                created += 1
+            elif cint(row.cars_in_queue) != expected["cars_in_queue"] or cint(row.boxes_count) != expected["boxes_count"]:
+                frappe.db.set_value("Car wash availability", car_wash, expected, update_modified=False)
+                repaired += 1
+                frappe.logger().warning(
+                    f"[Availability counters] drift at {car_wash}: "
+                    f"cars_in_queue {row.cars_in_queue} -> {expected['cars_in_queue']}, "
+                    f"boxes_count {row.boxes_count} -> {expected['boxes_count']}"
+                )
+            if commit:
+                frappe.db.commit()
+        except Exception:
+            if not commit:
+                raise
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), f"Availability counters reconcile failed: {car_wash}")
+
+    return {"created": created, "repaired": repaired}
@@ -1,3 +1,3 @@
-from .booking import get_booking_price_and_duration
+from .booking import get_booking_price_and_duration, get_booking_prices_and_durations
 
-__all__ = ["get_booking_price_and_duration"]
+__all__ = ["get_booking_price_and_duration", "get_booking_prices_and_durations"]
@@ -0,0 +1,389 @@
+# car_wash/auto_discount_rules.py
+"""
+Compiled auto discount rules.
+
+`Car wash auto discount` documents and their rule rows are compiled once per
+car wash into plain predicate objects (no Document instances), cached by a
+discount-set version that every discount change bumps. Evaluating a quote
+then needs no document loads and no queries, whatever the number of
+configured discounts.
+
+Lookup order: worker memory (same version) → Redis payload for the version → database.
+"""
+
+from dataclasses import dataclass, field
+from datetime import date
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import frappe
+from frappe.utils import flt, getdate, now_datetime
+
+from .versioning import get_version, bump_version_now_and_after_commit
+
+VERSION_NAMESPACE = "auto_discount_set"
+PAYLOAD_TTL_SEC = 24 * 3600
+
+# (site, car_wash) -> (version, tuple of CompiledAutoDiscount)
+_compiled: Dict[Tuple[str, str], Tuple[str, Tuple["CompiledAutoDiscount", ...]]] = {}
+
+# rule type -> key in period statistics
+_STAT_FIELDS = {
+    "Total Orders Count": "total_appointments",
+    "Paid Orders Count": "paid_appointments",
+    "Total Spent Amount": "spent_total",
+    "Unique Cars Count": "unique_cars",
+    "Average Ticket Amount": "avg_ticket",
+}
+
+_OPERATORS = {
+    ">=": lambda a, b: a >= b,
+    ">": lambda a, b: a > b,
+    "=": lambda a, b: a == b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+def _never(actual, target) -> bool:
+    return False
+
+
+# ---- rule predicates ----
+@dataclass(frozen=True)
+class StatThresholdRule:
+    """Period statistic compared with a threshold (orders, paid orders, spent, cars, avg ticket)."""
+    stat_field: str
+    period: str
+    compare: Any
+    target: float
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        actual = (periods.get(self.period) or {}).get(self.stat_field, 0)
+        return self.compare(flt(actual), self.target)
+
+
+@dataclass(frozen=True)
+class NthOrderRule:
+    """Every Nth order (by all-time count), shifted by offset."""
+    step: int
+    offset: int
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        if self.step <= 0:
+            return False
+        next_order_no = int((periods.get("all_time") or {}).get("total_appointments", 0) or 0) + 1
+        return ((next_order_no - self.offset) % self.step) == 0
+
+
+@dataclass(frozen=True)
+class FirstTimeCustomerRule:
+    """No paid appointments yet."""
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        return ((periods.get("all_time") or {}).get("paid_appointments", 0) or 0) == 0
+
+
+@dataclass(frozen=True)
+class LastVisitDaysAgoRule:
+    """Days since the last visit in the period compared with a threshold."""
+    period: str
+    compare: Any
+    target: float
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        last_visit = (periods.get(self.period) or {}).get("last_visit_on")
+        if not last_visit:
+            return False
+        return self.compare(flt((today - getdate(last_visit)).days), self.target)
+
+
+@dataclass(frozen=True)
+class ServiceUsageCountRule:
+    """How many times the target services were used in the period (from top_services)."""
+    period: str
+    services: frozenset
+    compare: Any
+    target: float
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        actual = 0
+        if self.services:
+            for stat in (periods.get(self.period) or {}).get("top_services", []) or []:
+                if stat.get("service") in self.services:
+                    actual += stat.get("count", 0)
+        return self.compare(flt(actual), self.target)
+
+
+@dataclass(frozen=True)
+class NeverRule:
+    """Unknown rule type: never satisfied."""
+
+    def __call__(self, periods: Mapping[str, Any], today: date) -> bool:
+        return False
+
+
+def compile_rule(rule: Mapping[str, Any], rule_services: Iterable[str], target_services: Iterable[str]):
+    rule_type = (rule.get("rule_type") or "").strip()
+    compare = _OPERATORS.get((rule.get("operator") or ">=").strip(), _never)
+    period = (rule.get("period") or "all_time").strip() or "all_time"
+    target = flt(rule.get("value") or 0)
+
+    if rule_type == "Nth Order":
+        return NthOrderRule(step=int(rule.get("nth_step") or 0), offset=int(rule.get("nth_offset") or 0))
+    if rule_type in _STAT_FIELDS:
+        return StatThresholdRule(stat_field=_STAT_FIELDS[rule_type], period=period, compare=compare, target=target)
+    if rule_type == "First Time Customer":
+        return FirstTimeCustomerRule()
+    if rule_type == "Last Visit Days Ago":
+        return LastVisitDaysAgoRule(period=period, compare=compare, target=target)
+    if rule_type == "Service Usage Count":
+        # Если у правила свой список услуг — используем его, иначе target_services скидки
+        services = frozenset(rule_services) or frozenset(target_services)
+        return ServiceUsageCountRule(period=period, services=services, compare=compare, target=target)
+    return NeverRule()
+
+
+# ---- compiled discount ----
+@dataclass(frozen=True)
+class CompiledAutoDiscount:
+    name: str
+    name_title: Optional[str]
+    description: Optional[str]
+    discount_type: str
+    discount_value: float
+    minimum_order_amount: float
+    waive_queue_commission: int
+    priority: int
+    can_combine_with_promocodes: int
+    can_combine_with_other_auto_discounts: int
+    usage_limit_per_customer: int
+    valid_from: Optional[date]
+    valid_to: Optional[date]
+    rules_logic: Optional[str]
+    match_all: bool
+    rules: Tuple[Any, ...]
+    applicable_services: frozenset
+    rules_snapshot: Tuple[Mapping[str, Any], ...] = field(default=())
+
+    def is_valid_for_date(self, check_date: Optional[date] = None) -> bool:
+        check_date = getdate(check_date) if check_date else now_datetime().date()
+        if self.valid_from and check_date < self.valid_from:
+            return False
+        if self.valid_to and check_date > self.valid_to:
+            return False
+        return True
+
+    def is_condition_met(self, customer_stats: Mapping[str, Any], today: Optional[date] = None) -> bool:
+        if not customer_stats or not customer_stats.get("periods"):
+            return False
+        if not self.rules:
+            return False
+        periods = customer_stats["periods"]
+        today = today or now_datetime().date()
+        if self.match_all:
+            return all(rule(periods, today) for rule in self.rules)
+        return any(rule(periods, today) for rule in self.rules)
+
+    def is_applicable_to_services(self, services: Iterable[Any]) -> bool:
+        if not self.applicable_services:
+            # Если услуги не заданы — скидка применима ко всем
+            return True
+        for service in services or []:
+            if isinstance(service, str):
+                service_name = service
+            elif isinstance(service, dict):
+                service_name = service.get("service_id") or service.get("service")
+            else:
+                service_name = getattr(service, "service", None)
+            if service_name in self.applicable_services:
+                return True
+        return False
+
+    def calculate_discount_amount(self, services_total: float) -> float:
+        if self.discount_type == "Percentage":
+            return (services_total * self.discount_value) / 100
+        # Fixed Amount: не больше суммы заказа
+        return min(self.discount_value, services_total)
+
+    def rules_snapshot_list(self) -> List[Dict[str, Any]]:
+        return [dict(r, services=list(r["services"])) for r in self.rules_snapshot]
+
+
+def _compile_discount(row: Mapping[str, Any], rules: List[Mapping[str, Any]],
+                      services_by_rule: Mapping[str, List[str]],
+                      target_services: List[str], applicable_services: List[str]) -> CompiledAutoDiscount:
+    logic = (row.get("rules_logic") or "ALL (AND)").strip().upper()
+    snapshot = tuple(
+        MappingProxyType({
+            "rule_type": r.get("rule_type"),
+            "operator": r.get("operator"),
+            "value": r.get("value"),
+            "period": r.get("period"),
+            "nth_step": r.get("nth_step"),
+            "nth_offset": r.get("nth_offset"),
+            "services": tuple(services_by_rule.get(r.get("name"), ())),
+        })
+        for r in rules
+    )
+    return CompiledAutoDiscount(
+        name=row["name"],
+        name_title=row.get("name_title"),
+        description=row.get("description"),
+        discount_type=row.get("discount_type") or "Percentage",
+        discount_value=flt(row.get("discount_value")),
+        minimum_order_amount=flt(row.get("minimum_order_amount")),
+        waive_queue_commission=row.get("waive_queue_commission") or 0,
+        priority=row.get("priority") or 0,
+        can_combine_with_promocodes=row.get("can_combine_with_promocodes") or 0,
+        can_combine_with_other_auto_discounts=row.get("can_combine_with_other_auto_discounts") or 0,
+        usage_limit_per_customer=row.get("usage_limit_per_customer") or 0,
+        valid_from=getdate(row["valid_from"]) if row.get("valid_from") else None,
+        valid_to=getdate(row["valid_to"]) if row.get("valid_to") else None,
+        rules_logic=row.get("rules_logic"),
+        match_all=logic.startswith("ALL"),
+        rules=tuple(compile_rule(r, services_by_rule.get(r.get("name"), ()), target_services) for r in rules),
+        applicable_services=frozenset(applicable_services),
+        rules_snapshot=snapshot,
+    )
+
+
+def compile_auto_discount_doc(doc) -> CompiledAutoDiscount:
+    """Compile a loaded `Car wash auto discount` document (used by its controller methods)."""
+    rules = [r.as_dict() for r in (doc.rules or [])]
+    services_by_rule = {
+        r.name: [s.service for s in (getattr(r, "services", None) or [])] for r in (doc.rules or [])
+    }
+    return _compile_discount(
+        doc.as_dict(),
+        rules,
+        services_by_rule,
+        [s.service for s in (doc.target_services or [])],
+        [s.service for s in (doc.applicable_services or [])],
+    )
+
+
+def _service_ids(rows: Iterable[Any]) -> List[str]:
+    return [r if isinstance(r, str) else r.get("service") for r in (rows or [])]
+
+
+def compile_auto_discount_config(config: Mapping[str, Any], index: int = 1) -> CompiledAutoDiscount:
+    """
+    Compile an unsaved discount configuration: doctype fields plus "rules" (each with
+    optional "services"), "target_services" and "applicable_services" (ids or child rows).
+    A configuration without "name" is named "proposed-{index}" (index — its position in the
+    proposed set), so several unsaved configurations never share a name.
+    Used by the what-if simulator (see discount_simulator).
+    """
+    rules = [dict(r, name=r.get("name") or f"rule-{idx}") for idx, r in enumerate(config.get("rules") or [], start=1)]
+    return _compile_discount(
+        dict(config, name=config.get("name") or f"proposed-{index}"),
+        rules,
+        {r["name"]: _service_ids(r.get("services")) for r in rules},
+        _service_ids(config.get("target_services")),
+        _service_ids(config.get("applicable_services")),
+    )
+
+
+# ---- loading & caching ----
+def _load_payload(car_wash: str) -> Dict[str, Any]:
+    """Active discounts of a car wash with all child rows: four queries, no get_doc."""
+    discounts = frappe.get_all(
+        "Car wash auto discount",
+        filters={"car_wash": car_wash, "is_active": 1, "is_deleted": 0},
+        fields=[
+            "name", "name_title", "description", "discount_type", "discount_value",
+            "minimum_order_amount", "waive_queue_commission", "rules_logic", "priority",
+            "valid_from", "valid_to", "usage_limit_per_customer",
+            "can_combine_with_promocodes", "can_combine_with_other_auto_discounts",
+        ],
+        order_by="priority asc",
+        limit_page_length=0,
+    )
+    names = [d.name for d in discounts]
+    if not names:
+        return {"discounts": [], "rules": [], "rule_services": [], "discount_services": []}
+
+    rules = frappe.get_all(
+        "Car wash auto discount rule",
+        filters={"parent": ["in", names], "parenttype": "Car wash auto discount"},
+        fields=["name", "parent", "idx", "rule_type", "operator", "value", "period", "nth_step", "nth_offset"],
+        order_by="idx asc",
+        limit_page_length=0,
+    )
+    rule_services = frappe.get_all(
+        "Car wash auto discount rule service",
+        filters={"parent": ["in", [r.name for r in rules] or [""]]},
+        fields=["parent", "service"],
+        order_by="idx asc",
+        limit_page_length=0,
+    ) if rules else []
+    discount_services = frappe.get_all(
+        "Car wash auto discount service",
+        filters={"parent": ["in", names], "parenttype": "Car wash auto discount"},
+        fields=["parent", "parentfield", "service"],
+        order_by="idx asc",
+        limit_page_length=0,
+    )
+    return {
+        "discounts": discounts,
+        "rules": rules,
+        "rule_services": rule_services,
+        "discount_services": discount_services,
+    }
+
+
+def _compile_payload(payload: Dict[str, Any]) -> Tuple[CompiledAutoDiscount, ...]:
+    rules_by_discount: Dict[str, List[Mapping[str, Any]]] = {}
+    for r in payload["rules"]:
+        rules_by_discount.setdefault(r["parent"], []).append(r)
+
+    services_by_rule: Dict[str, List[str]] = {}
+    for s in payload["rule_services"]:
+        services_by_rule.setdefault(s["parent"], []).append(s["service"])
+
+    targets: Dict[str, List[str]] = {}
+    applicable: Dict[str, List[str]] = {}
+    for s in payload["discount_services"]:
+        bucket = targets if s["parentfield"] == "target_services" else applicable
+        bucket.setdefault(s["parent"], []).append(s["service"])
+
+    return tuple(
+        _compile_discount(
+            d,
+            rules_by_discount.get(d["name"], []),
+            services_by_rule,
+            targets.get(d["name"], []),
+            applicable.get(d["name"], []),
+        )
+        for d in payload["discounts"]
+    )
+
+
+def get_discount_set_version(car_wash: str) -> str:
+    return get_version(VERSION_NAMESPACE, car_wash)
+
+
+def get_compiled_auto_discounts(car_wash: str) -> Tuple[CompiledAutoDiscount, ...]:
+    """Active discounts of a car wash, compiled and ordered by priority; one Redis read when warm."""
+    version = get_discount_set_version(car_wash)
+    local_key = (getattr(frappe.local, "site", None) or "", car_wash)
+    cached = _compiled.get(local_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    payload_key = f"auto_discount_set:{car_wash}:{version}"
+    payload = frappe.cache().get_value(payload_key)
+    if payload is None:
+        payload = _load_payload(car_wash)
+        frappe.cache().set_value(payload_key, payload, expires_in_sec=PAYLOAD_TTL_SEC)
+
+    discounts = _compile_payload(payload)
+    _compiled[local_key] = (version, discounts)
+    return discounts
+
+
+def bump_discount_set_version(car_wash: Optional[str]) -> None:
+    """Invalidate compiled discounts of a car wash (call on any auto discount change)."""
+    if car_wash:
+        bump_version_now_and_after_commit(VERSION_NAMESPACE, car_wash)
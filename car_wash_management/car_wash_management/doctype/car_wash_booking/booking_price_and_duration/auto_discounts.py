@@ -5,68 +5,12 @@ Provides logic for finding, validating and applying auto discounts with caching.
 """
 
 import frappe
-from typing import Dict, Any, List, Optional
-from frappe.utils import now_datetime, getdate, flt
+from typing import Dict, Any, List, Optional, Sequence
+from frappe.utils import now_datetime, flt
 
-
-def get_applicable_auto_discounts_cached(
-    car_wash: str,
-    customer: str,
-    services: list,
-    services_total: float,
-    cache_ttl_sec: int = 300,  # 5 минут кэш
-    force_refresh: bool = False
-) -> List[Dict[str, Any]]:
-    """
-    Get applicable auto discounts with caching
-
-    Args:
-        car_wash: Car wash ID
-        customer: Customer ID
-        services: List of services
-        services_total: Total amount of services
-        cache_ttl_sec: Cache TTL in seconds
-        force_refresh: Force cache refresh
-
-    Returns:
-        List of applicable auto discounts
-    """
-    # Проверяем наличие фичи promo у мойки
-    car_wash_doc = frappe.get_doc("Car wash", car_wash)
-    has_promo_feature = car_wash_doc.has_journal_feature("promo")
-    
-    if not has_promo_feature:
-        return []
-
-    # Create cache key
-    service_ids = []
-    for service in services:
-        if isinstance(service, dict):
-            service_ids.append(service.get("service_id", ""))
-        else:
-            service_ids.append(str(service))
-
-    services_key = "|".join(sorted(service_ids))
-    cache_key = f"auto_discounts:v1:{car_wash}:{customer}:{services_key}:{services_total}:ttl={cache_ttl_sec}"
-
-    if not force_refresh:
-        cached = frappe.cache().get_value(cache_key)
-        if cached:
-            return frappe.parse_json(cached)
-
-    # Get applicable discounts
-    applicable_discounts = _get_applicable_auto_discounts(
-        car_wash=car_wash,
-        customer=customer,
-        services=services,
-        services_total=services_total,
-        force_refresh=force_refresh
-    )
-
-    # Cache results
-    frappe.cache().set_value(cache_key, applicable_discounts, expires_in_sec=cache_ttl_sec)
-
-    return applicable_discounts
+from .auto_discount_rules import CompiledAutoDiscount, get_compiled_auto_discounts
+from .discount_solver import POLICY_MAX_DISCOUNT, choose_auto_discounts
+from .usage_ledger import AMOUNT_FIELDS, diff_usage_row, get_usage_rows, insert_usage_rows, update_usage_rows
 
 
 def _get_applicable_auto_discounts(
@@ -74,102 +18,63 @@ def _get_applicable_auto_discounts(
     customer: str,
     services: list,
     services_total: float,
-    force_refresh: bool = False
+    force_refresh: bool = False,
+    compiled_discounts: Optional[Sequence[CompiledAutoDiscount]] = None,
+    customer_stats: Optional[Dict[str, Any]] = None,
 ) -> List[Dict[str, Any]]:
     """
     Internal method to get applicable auto discounts
-    """
-    # Get active auto discounts for this car wash
-    discounts = frappe.get_all(
-        "Car wash auto discount",
-        filters={
-            "car_wash": car_wash,
-            "is_active": 1,
-            "is_deleted": 0
-        },
-        order_by="priority asc"
-    )
 
-    print("discounts", discounts)
+    Discounts are evaluated from their compiled form (see auto_discount_rules), so no
+    discount documents are loaded here. compiled_discounts and customer_stats may be
+    passed preloaded by callers that quote several carts of the same car wash (see QuoteContext).
+    """
+    if compiled_discounts is None:
+        compiled_discounts = get_compiled_auto_discounts(car_wash)
 
-    if not discounts:
+    if not compiled_discounts:
         return []
 
     # Get customer statistics with caching
-    customer_stats = _get_customer_stats_cached(customer, car_wash, force_refresh=force_refresh)
+    if customer_stats is None:
+        customer_stats = _get_customer_stats_cached(customer, car_wash, force_refresh=force_refresh)
 
+    today = now_datetime().date()
     applicable_discounts = []
 
-    for discount_data in discounts:
-        discount = frappe.get_doc("Car wash auto discount", discount_data.name)
-
-        print("discount", discount)
-
-        # Check if discount is valid for current date
-        if not discount.is_valid_for_date():
-            print("discount is not valid for current date")
+    for discount in compiled_discounts:
+        if not discount.is_valid_for_date(today):
             continue
 
-        # Check minimum order amount
         if discount.minimum_order_amount and services_total < discount.minimum_order_amount:
-            print("discount is not valid for minimum order amount")
             continue
 
-        # Check if condition is met
-        if not discount.is_condition_met(customer_stats, services):
-            print("customer_stats", customer_stats)
-            print("services", services)
-            print("discount is not valid for condition")
+        if not discount.is_condition_met(customer_stats, today):
             continue
 
-        # Check if applicable to current services
         if not discount.is_applicable_to_services(services):
-            print("discount is not valid for applicable to services")
             continue
 
         # Check usage limit per customer
         if discount.usage_limit_per_customer:
-            print("discount is not valid for usage limit per customer")
             usage_count = _get_customer_discount_usage_count(customer, discount.name)
             if usage_count >= discount.usage_limit_per_customer:
-                print("discount is not valid for usage limit per customer")
                 continue
 
-        print("discount is valid")
-
-        # Calculate discount amount
-        service_discount = discount.calculate_discount_amount(services_total)
-
-        print("service_discount", service_discount)
-
-        # Prepare rules snapshot (rules-based conditions)
-        try:
-            rules_snapshot = [{
-                "rule_type": r.rule_type,
-                "operator": r.operator,
-                "value": r.value,
-                "period": r.period,
-                "nth_step": r.nth_step,
-                "nth_offset": r.nth_offset,
-                "services": [s.service for s in (getattr(r, "services", []) or [])],
-            } for r in (discount.rules or [])]
-        except Exception:
-            rules_snapshot = []
-
         applicable_discounts.append({
             "discount_id": discount.name,
             "name": discount.name_title,
             "description": discount.description,
             "discount_type": discount.discount_type,
             "discount_value": discount.discount_value,
-            "service_discount": service_discount,
+            "service_discount": discount.calculate_discount_amount(services_total),
             "waive_queue_commission": discount.waive_queue_commission,
             "priority": discount.priority,
             "can_combine_with_promocodes": discount.can_combine_with_promocodes,
             "can_combine_with_other_auto_discounts": discount.can_combine_with_other_auto_discounts,
             "condition_met_details": {
                 "rules_logic": discount.rules_logic,
-                "rules": rules_snapshot,
+                "rules": discount.rules_snapshot_list(),
             }
         })
 
@@ -178,21 +83,15 @@ def _get_applicable_auto_discounts(
 
 def _get_customer_stats_cached(customer: str, car_wash: str, force_refresh: bool = False) -> Dict[str, Any]:
     """
-    Get customer statistics with caching
+    Get customer statistics from the materialized `Car wash client stats` rows (O(1) per quote).
+    All used services are returned in top_services so Service Usage Count rules see every service;
+    force_refresh rebuilds the rows from appointments first.
     """
-    try:
-        customer_doc = frappe.get_doc("Car wash client", customer)
-        return customer_doc.get_statistics(car_wash=car_wash, cache_ttl_sec=1800, force_refresh=1 if force_refresh else 0)
-    except:
-        # If customer doesn't exist yet, return empty stats (for first time customers)
-        return {
-            "customer": customer,
-            "periods": {
-                "month": {"total_appointments": 0, "paid_appointments": 0, "spent_total": 0.0, "avg_ticket": 0.0, "unique_cars": 0, "top_services": [], "by_status": {}},
-                "year": {"total_appointments": 0, "paid_appointments": 0, "spent_total": 0.0, "avg_ticket": 0.0, "unique_cars": 0, "top_services": [], "by_status": {}},
-                "all_time": {"total_appointments": 0, "paid_appointments": 0, "spent_total": 0.0, "avg_ticket": 0.0, "unique_cars": 0, "top_services": [], "by_status": {}}
-            }
-        }
+    from ...car_wash_client.client_stats import get_client_stats, rebuild_client_stats
+
+    if force_refresh and customer:
+        rebuild_client_stats(customer=customer, car_wash=car_wash)
+    return get_client_stats(customer, car_wash, limit=None, with_titles=False)
 
 
 def _get_customer_discount_usage_count(customer: str, discount_id: str) -> int:
@@ -208,7 +107,8 @@ def apply_best_auto_discounts(
     applicable_discounts: List[Dict[str, Any]],
     services_total: float,
     commission_amount: float = 0.0,
-    allow_combinations: bool = True
+    allow_combinations: bool = True,
+    policy: str = POLICY_MAX_DISCOUNT,
 ) -> Dict[str, Any]:
     """
     Apply the best combination of auto discounts
@@ -218,6 +118,7 @@ def apply_best_auto_discounts(
         services_total: Total service amount
         commission_amount: Commission amount
         allow_combinations: Allow combining multiple discounts
+        policy: "max_discount" (best subset, see discount_solver) or "priority"
 
     Returns:
         Dictionary with applied discounts and final amounts
@@ -232,24 +133,16 @@ def apply_best_auto_discounts(
             "total_discount": 0.0
         }
 
-    if not allow_combinations or len(applicable_discounts) == 1:
-        # Apply only the best (highest priority) discount
-        best_discount = applicable_discounts[0]
-        return _apply_single_discount(best_discount, services_total, commission_amount)
-
-    # Try to find best combination
-    best_result = _apply_single_discount(applicable_discounts[0], services_total, commission_amount)
-
-    if len(applicable_discounts) > 1:
-        # Check combinations
-        combinable_discounts = [d for d in applicable_discounts if d.get("can_combine_with_other_auto_discounts")]
-
-        if len(combinable_discounts) > 1:
-            combination_result = _apply_discount_combination(combinable_discounts, services_total, commission_amount)
-            if combination_result["total_discount"] > best_result["total_discount"]:
-                best_result = combination_result
-
-    return best_result
+    chosen = choose_auto_discounts(
+        applicable_discounts,
+        services_total=services_total,
+        commission_amount=commission_amount,
+        allow_combinations=allow_combinations,
+        policy=policy,
+    )
+    if len(chosen) == 1:
+        return _apply_single_discount(chosen[0], services_total, commission_amount)
+    return _apply_discount_combination(chosen, services_total, commission_amount)
 
 
 def record_auto_discount_usage(
@@ -270,8 +163,6 @@ def record_auto_discount_usage(
     if not has_promo_feature:
         return
 
-    print('Try to record')
-
     applied_discounts: List[Dict[str, Any]] = auto_result.get("applied_discounts", [])
     commission_waived_total = flt(auto_result.get("commission_waived", 0.0))
 
@@ -282,26 +173,25 @@ def record_auto_discount_usage(
             index_with_waiver = idx
             break
 
+    rows = []
     for idx, d in enumerate(applied_discounts):
-        try:
-            commission_waived = commission_waived_total if idx == index_with_waiver else 0.0
-            service_discount = flt(d.get("service_discount", 0.0))
-            frappe.get_doc({
-                "doctype": "Car wash auto discount usage",
-                "car_wash": car_wash,
-                "customer": customer,
-                "context_type": context_type,
-                "context_id": context_id,
-                "discount_id": d.get("discount_id"),
-                "discount_name": d.get("name"),
-                "rules_snapshot": frappe.as_json(d.get("condition_met_details")),
-                "service_discount": service_discount,
-                "commission_waived": commission_waived,
-                "total_discount": service_discount + commission_waived,
-            }).insert(ignore_permissions=True)
-        except Exception as e:
-            print("Auto discount usage record failed", e)
-            frappe.log_error(frappe.get_traceback(), "Auto discount usage record failed")
+        commission_waived = commission_waived_total if idx == index_with_waiver else 0.0
+        service_discount = flt(d.get("service_discount", 0.0))
+        rows.append({
+            "car_wash": car_wash,
+            "customer": customer,
+            "context_type": context_type,
+            "context_id": context_id,
+            "discount_id": d.get("discount_id"),
+            "discount_name": d.get("name"),
+            "rules_snapshot": frappe.as_json(d.get("condition_met_details")),
+            "service_discount": service_discount,
+            "commission_waived": commission_waived,
+            "total_discount": service_discount + commission_waived,
+        })
+
+    # Одна вставка на все скидки (см. usage_ledger); ошибка откатывает сохранение вместе с учётом
+    insert_usage_rows(car_wash, rows)
 
 
 def _apply_single_discount(discount: Dict[str, Any], services_total: float, commission_amount: float) -> Dict[str, Any]:
@@ -456,13 +346,9 @@ def refresh_recorded_auto_discount_usage(
     Recompute and update recorded usage amounts against new base totals without re-evaluating eligibility.
 
     Returns dict with aggregated sums: {service_discount_sum, commission_waived_sum, total_discount_sum, updated_count}
+    (updated_count — rows whose amounts actually changed)
     """
-    rows = frappe.get_all(
-        "Car wash auto discount usage",
-        filters={"context_type": context_type, "context_id": context_id},
-        fields=["name", "discount_id"],
-        order_by="creation asc",
-    ) or []
+    rows = get_usage_rows(context_type, context_id, fields=AMOUNT_FIELDS)
 
     if not rows:
         return {
@@ -472,53 +358,61 @@ def refresh_recorded_auto_discount_usage(
             "updated_count": 0,
         }
 
+    # Настройки всех скидок одним запросом (включая неактивные — пересчёт не проверяет условия)
+    discount_ids = list({r["discount_id"] for r in rows if r.get("discount_id")})
+    discounts = {
+        d.name: d
+        for d in frappe.get_all(
+            "Car wash auto discount",
+            filters={"name": ["in", discount_ids]},
+            fields=["name", "discount_type", "discount_value", "waive_queue_commission"],
+            limit_page_length=0,
+        )
+    } if discount_ids else {}
+
     # Determine which discount (first with waive flag) should carry the commission waiver
-    index_with_waiver = -1
-    discount_docs: List[Optional[Any]] = []
-    for idx, r in enumerate(rows):
-        try:
-            d = frappe.get_doc("Car wash auto discount", r["discount_id"]) if r.get("discount_id") else None
-        except Exception:
-            d = None
-        discount_docs.append(d)
-        if index_with_waiver == -1 and d and getattr(d, "waive_queue_commission", 0):
-            index_with_waiver = idx
+    index_with_waiver = next(
+        (idx for idx, r in enumerate(rows) if (discounts.get(r.get("discount_id")) or {}).get("waive_queue_commission")),
+        -1,
+    )
 
     service_discount_sum = 0.0
     commission_waived_sum = 0.0
+    changes = {}
 
     for idx, r in enumerate(rows):
-        d = discount_docs[idx]
+        d = discounts.get(r.get("discount_id"))
         if not d:
             # If missing, zero out
             service_discount = 0.0
             commission_waived = 0.0
         else:
             # Recompute service discount from discount config (no rule re-evaluation)
-            if getattr(d, "discount_type", "Percentage") == "Percentage":
+            if (d.discount_type or "Percentage") == "Percentage":
                 service_discount = (flt(base_services_total) * flt(d.discount_value or 0)) / 100.0
             else:
                 service_discount = min(flt(d.discount_value or 0), flt(base_services_total))
-            commission_waived = flt(base_commission) if (idx == index_with_waiver and getattr(d, "waive_queue_commission", 0)) else 0.0
+            commission_waived = flt(base_commission) if idx == index_with_waiver else 0.0
 
-        total_discount = flt(service_discount) + flt(commission_waived)
-
-        # Update the usage row
-        try:
-            doc = frappe.get_doc("Car wash auto discount usage", r["name"]) 
-            doc.service_discount = service_discount
-            doc.commission_waived = commission_waived
-            doc.total_discount = total_discount
-            doc.save(ignore_permissions=True)
-        except Exception:
-            frappe.log_error(frappe.get_traceback(), f"Refresh auto discount usage failed: {r['name']}")
+        changes[r["name"]] = diff_usage_row(r, {
+            "service_discount": service_discount,
+            "commission_waived": commission_waived,
+            "total_discount": flt(service_discount) + flt(commission_waived),
+        })
 
         service_discount_sum += service_discount
         commission_waived_sum += commission_waived
 
+    # Пишем только изменившиеся строки, одним UPDATE
+    try:
+        updated_count = update_usage_rows(changes)
+    except Exception:
+        updated_count = 0
+        frappe.log_error(frappe.get_traceback(), "Refresh auto discount usage failed")
+
     return {
         "service_discount_sum": flt(service_discount_sum),
         "commission_waived_sum": flt(commission_waived_sum),
         "total_discount_sum": flt(service_discount_sum + commission_waived_sum),
-        "updated_count": len(rows),
+        "updated_count": updated_count,
     }
@@ -0,0 +1,386 @@
+# car_wash/benchmarks.py
+"""
+Бенчмарки расчёта стоимости бронирования на реальных данных мойки.
+Запускать через: bench --site <site> execute car_wash_management.car_wash_management.doctype.car_wash_booking.booking_price_and_duration.benchmarks.benchmark_batch_quotes --kwargs "{'car_wash': 'WASH-001', 'carts': 20}"
+
+Бенчмарки цен только читают данные; бенчмарк сохранения документа откатывает транзакцию.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from typing import Any, Dict, List
+
+import frappe
+
+from .booking import get_booking_price_and_duration, get_booking_prices_and_durations
+from .auto_discount_rules import compile_auto_discount_config
+from .discount_simulator import simulate
+from .discount_solver import brute_force_auto_discounts, choose_auto_discounts
+from .quote_session import close_quote_session, open_quote_session, update_quote_session
+from .tariff_matcher import CarProfile, compile_tariff_matcher
+from . import auto_discount_rules, price_catalog
+
+
+@contextmanager
+def count_queries():
+    """Count frappe.db.sql calls inside the block: `with count_queries() as counter: ...; counter["count"]`."""
+    counter = {"count": 0}
+    original_sql = frappe.db.sql
+
+    def counting_sql(*args, **kwargs):
+        counter["count"] += 1
+        return original_sql(*args, **kwargs)
+
+    frappe.db.sql = counting_sql
+    try:
+        yield counter
+    finally:
+        frappe.db.sql = original_sql
+
+
+def clear_local_caches() -> None:
+    """Drop compiled catalogs and auto discounts held in worker memory so every variant starts cold."""
+    price_catalog._catalogs.clear()
+    auto_discount_rules._compiled.clear()
+
+
+def _measure(fn, repeats: int) -> Dict[str, Any]:
+    timings = []
+    queries = 0
+    for _ in range(repeats):
+        clear_local_caches()
+        with count_queries() as counter:
+            started = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - started) * 1000.0)
+        queries = counter["count"]
+    timings.sort()
+    return {
+        "min_ms": round(timings[0], 2),
+        "median_ms": round(timings[len(timings) // 2], 2),
+        "queries": queries,
+    }
+
+
+def build_sample_carts(car_wash: str, carts: int = 20, max_services: int = 4, seed: int = 42) -> List[Dict[str, Any]]:
+    """Random carts from active services of the car wash and cars seen in its appointments."""
+    rng = random.Random(seed)
+    services = frappe.get_all(
+        "Car wash service",
+        filters={"car_wash": car_wash, "is_disabled": 0, "is_deleted": 0},
+        pluck="name",
+    )
+    cars = frappe.get_all(
+        "Car wash appointment",
+        filters={"car_wash": car_wash, "is_deleted": 0, "car": ["is", "set"]},
+        pluck="car",
+        limit_page_length=200,
+    )
+    if not services or not cars:
+        frappe.throw("Car wash has no active services or no appointments with cars to sample from.")
+
+    sample = []
+    for idx in range(int(carts)):
+        picked = rng.sample(services, k=min(len(services), rng.randint(1, max_services)))
+        sample.append({
+            "key": idx,
+            "car": rng.choice(cars),
+            "services": [{"service": s} for s in picked],
+        })
+    return sample
+
+
+def benchmark_batch_quotes(car_wash: str, carts: int = 20, repeats: int = 5) -> Dict[str, Any]:
+    """
+    N последовательных get_booking_price_and_duration против одного get_booking_prices_and_durations.
+    Каждый прогон начинается с холодного каталога в памяти воркера; Redis-кэш остаётся общим для обоих вариантов.
+    """
+    sample = build_sample_carts(car_wash, carts=carts)
+
+    def sequential():
+        for cart in sample:
+            get_booking_price_and_duration(car_wash, cart["car"], cart["services"])
+
+    def batch():
+        get_booking_prices_and_durations(car_wash, sample)
+
+    # прогрев Redis-кэша, чтобы варианты сравнивались на равных
+    batch()
+
+    result = {
+        "car_wash": car_wash,
+        "carts": len(sample),
+        "sequential": _measure(sequential, int(repeats)),
+        "batch": _measure(batch, int(repeats)),
+    }
+    return result
+
+
+def benchmark_appointment_save_queries(car_wash: str, car: str, services: list, tariff: str = None) -> Dict[str, Any]:
+    """
+    Число запросов на одно сохранение `Car wash appointment` без мемоизации расчёта и с ней.
+    Вставка выполняется внутри транзакции и откатывается.
+    """
+    if isinstance(services, str):
+        services = frappe.parse_json(services)
+
+    def insert_once():
+        doc = frappe.get_doc({
+            "doctype": "Car wash appointment",
+            "car_wash": car_wash,
+            "car": car,
+            "tariff": tariff,
+            "services": [{"service": s} if isinstance(s, str) else s for s in services],
+        })
+        doc.insert(ignore_permissions=True)
+
+    result = {}
+    for label, skip_memo in (("without_memo", True), ("with_memo", False)):
+        frappe.flags.skip_quote_memo = skip_memo
+        frappe.local.booking_quote_memo = None
+        try:
+            with count_queries() as counter:
+                started = time.perf_counter()
+                insert_once()
+                elapsed = (time.perf_counter() - started) * 1000.0
+            result[label] = {"queries": counter["count"], "ms": round(elapsed, 2)}
+        finally:
+            frappe.flags.skip_quote_memo = False
+            frappe.db.rollback()
+
+    return result
+
+
+def build_sample_discounts(count: int, services_total: float, rng: random.Random) -> List[Dict[str, Any]]:
+    """Synthetic applicable auto discounts in the shape _get_applicable_auto_discounts returns."""
+    discounts = []
+    for idx in range(int(count)):
+        if rng.random() < 0.5:
+            service_discount = services_total * rng.choice([5, 10, 15, 20, 50]) / 100
+        else:
+            service_discount = min(rng.choice([100, 250, 500, 1000, 3000]), services_total)
+        discounts.append({
+            "discount_id": f"AD-{idx}",
+            "service_discount": service_discount,
+            "waive_queue_commission": int(rng.random() < 0.3),
+            "priority": idx,
+            "can_combine_with_other_auto_discounts": int(rng.random() < 0.7),
+        })
+    return discounts
+
+
+def benchmark_auto_discount_solver(candidates: int = 30, samples: int = 200, brute_force_candidates: int = 12, seed: int = 7) -> Dict[str, Any]:
+    """
+    Микро-бенчмарк выбора набора автоскидок (без БД): время решателя на `candidates`
+    кандидатах и, для сравнения, полного перебора на `brute_force_candidates`.
+    """
+    rng = random.Random(seed)
+
+    def timings_for(solver, count: int) -> Dict[str, Any]:
+        timings = []
+        for _ in range(int(samples)):
+            services_total = rng.choice([1500, 4000, 10000, 100000])
+            sample = build_sample_discounts(count, services_total, rng)
+            started = time.perf_counter()
+            solver(sample, services_total, 100.0)
+            timings.append((time.perf_counter() - started) * 1000.0)
+        timings.sort()
+        return {
+            "candidates": count,
+            "median_ms": round(timings[len(timings) // 2], 4),
+            "p99_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 4),
+            "max_ms": round(timings[-1], 4),
+        }
+
+    result = {
+        "solver": timings_for(choose_auto_discounts, candidates),
+        "solver_small": timings_for(choose_auto_discounts, brute_force_candidates),
+        "brute_force_small": timings_for(brute_force_auto_discounts, brute_force_candidates),
+    }
+    return result
+
+
+BODY_TYPES = ["Passenger", "Minivan", "Sedan", "CompactSUV", "Jeep", "LargeSUV", "Minibus", "Business"]
+
+
+def build_sample_tariff_filters(tariffs: int, filters_per_tariff: int, makes: int, rng: random.Random):
+    """Synthetic active tariffs (auto-selection order) with `Car wash tariff filter` rows."""
+    names = [f"TARIFF-{idx}" for idx in range(int(tariffs))]
+    rows = []
+    for name in names[:-1]:  # последний тариф без фильтров — подходит всем
+        rows.append({"parent": name, "attribute": "markId", "operator": "=", "value_exact": f"MAKE-{rng.randrange(makes)}"})
+        for _ in range(int(filters_per_tariff) - 1):
+            kind = rng.choice(["bodyType", "modelYearFrom", "modelYearTo", "year"])
+            if kind == "bodyType":
+                rows.append({"parent": name, "attribute": "bodyType", "operator": "in",
+                             "value_exact": ",".join(rng.sample(BODY_TYPES, 3))})
+            elif kind == "year":
+                low = rng.randrange(1995, 2020)
+                rows.append({"parent": name, "attribute": "modelYearFrom", "operator": "between",
+                             "value_from": str(low), "value_to": str(low + 5)})
+            else:
+                rows.append({"parent": name, "attribute": kind, "operator": ">=" if kind == "modelYearFrom" else "<=",
+                             "value_exact": str(rng.randrange(1995, 2025))})
+    return names, rows
+
+
+def benchmark_tariff_matching(tariff_counts=(10, 100, 500), filters_per_tariff: int = 3, makes: int = 50,
+                              lookups: int = 2000, seed: int = 11) -> Dict[str, Any]:
+    """
+    Микро-бенчмарк авто-подбора тарифа (без БД): время resolve на разном числе тарифов.
+    cold — каждый профиль машины впервые (мемо сброшен), warm — те же машины повторно.
+    """
+    rng = random.Random(seed)
+    result = {}
+    for count in tariff_counts:
+        names, rows = build_sample_tariff_filters(count, filters_per_tariff, makes, rng)
+        started = time.perf_counter()
+        matcher = compile_tariff_matcher(names, rows)
+        compile_ms = (time.perf_counter() - started) * 1000.0
+
+        profiles = [
+            CarProfile(make=f"MAKE-{rng.randrange(makes)}", body_type=rng.choice(BODY_TYPES), year=rng.randrange(1995, 2025))
+            for _ in range(int(lookups))
+        ]
+
+        def timings_for(clear_memo: bool) -> Dict[str, Any]:
+            timings = []
+            for profile in profiles:
+                if clear_memo:
+                    matcher._memo.clear()
+                started = time.perf_counter()
+                matcher.resolve(profile)
+                timings.append((time.perf_counter() - started) * 1_000_000.0)
+            timings.sort()
+            return {
+                "median_us": round(timings[len(timings) // 2], 2),
+                "p99_us": round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 2),
+            }
+
+        cold = timings_for(clear_memo=True)
+        timings_for(clear_memo=False)  # прогрев мемо
+        result[str(count)] = {
+            "filters": len(rows),
+            "compile_ms": round(compile_ms, 2),
+            "cold": cold,
+            "warm": timings_for(clear_memo=False),
+        }
+    return result
+
+
+def benchmark_quote_session(car_wash: str, deltas: int = 20, seed: int = 5) -> Dict[str, Any]:
+    """
+    Сессия кассира: корзина собирается по одной услуге (add/remove), на каждой дельте
+    сравнивается время инкрементального пересчёта с полным расчётом той же корзины.
+    """
+    rng = random.Random(seed)
+    cart = build_sample_carts(car_wash, carts=1, max_services=1, seed=seed)[0]
+    services = frappe.get_all(
+        "Car wash service",
+        filters={"car_wash": car_wash, "is_disabled": 0, "is_deleted": 0},
+        pluck="name",
+    )
+
+    opened = open_quote_session(car_wash, cart["car"], services=cart["services"])
+    if opened.get("status") != "success":
+        frappe.throw(opened.get("message"))
+    session_id = opened["session_id"]
+
+    delta_ms, full_ms = [], []
+    cart_size = len(cart["services"])
+    try:
+        for _ in range(int(deltas)):
+            if cart_size > 1 and rng.random() < 0.3:
+                op = {"op": "remove_service", "service": rng.choice(opened["services"])["service"]}
+            else:
+                op = {"op": "add_service", "service": rng.choice(services)}
+            opened = update_quote_session(session_id, [op], compare=True)
+            if opened.get("status") != "success":
+                continue
+            cart_size = len(opened["services"])
+            delta_ms.append(opened["timing"]["ms"])
+            full_ms.append(opened["timing"]["full_ms"])
+    finally:
+        close_quote_session(session_id)
+
+    def summary(values: List[float]) -> Dict[str, Any]:
+        values = sorted(values)
+        if not values:
+            return {}
+        return {
+            "median_ms": round(values[len(values) // 2], 3),
+            "p90_ms": round(values[min(len(values) - 1, int(len(values) * 0.9))], 3),
+        }
+
+    result = {"car_wash": car_wash, "deltas": len(delta_ms), "delta": summary(delta_ms), "full_recompute": summary(full_ms)}
+    return result
+
+
+SAMPLE_DISCOUNT_CONFIGS = [
+    {"name": "SIM-NTH", "discount_type": "Percentage", "discount_value": 50, "priority": 1,
+     "rules": [{"rule_type": "Nth Order", "nth_step": 5, "nth_offset": 0}]},
+    {"name": "SIM-FIRST", "discount_type": "Fixed Amount", "discount_value": 1000, "priority": 2,
+     "can_combine_with_other_auto_discounts": 1, "rules": [{"rule_type": "First Time Customer"}]},
+    {"name": "SIM-LOYAL", "discount_type": "Percentage", "discount_value": 10, "priority": 3,
+     "can_combine_with_other_auto_discounts": 1, "rules_logic": "ALL (AND)",
+     "rules": [{"rule_type": "Paid Orders Count", "operator": ">=", "value": 3, "period": "month"},
+               {"rule_type": "Total Spent Amount", "operator": ">=", "value": 20000, "period": "year"}]},
+    {"name": "SIM-RETURN", "discount_type": "Percentage", "discount_value": 15, "priority": 4,
+     "usage_limit_per_customer": 2, "rules": [{"rule_type": "Last Visit Days Ago", "operator": ">=", "value": 60}]},
+    {"name": "SIM-SERVICE", "discount_type": "Fixed Amount", "discount_value": 500, "priority": 5,
+     "minimum_order_amount": 3000, "can_combine_with_other_auto_discounts": 1,
+     "rules": [{"rule_type": "Service Usage Count", "operator": ">=", "value": 4, "services": ["SVC-1", "SVC-2"]}]},
+]
+
+
+def build_synthetic_appointment_records(appointments: int, clients: int, days: int, seed: int) -> List[Dict[str, Any]]:
+    """Appointment records in the shape stream_appointment_records yields, ordered by starts_on."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, 8)
+    step = timedelta(days=days) / max(1, int(appointments))
+    records = []
+    for idx in range(int(appointments)):
+        services_total = float(rng.choice([1500, 2500, 4000, 6000, 9000]))
+        records.append({
+            "name": f"APT-{idx}",
+            "client": f"CL-{rng.randrange(clients)}",
+            "starts_on": start + step * idx,
+            "paid": rng.random() < 0.9,
+            "services_total": services_total,
+            "staff_reward": services_total * 0.3,
+            "car": f"CAR-{rng.randrange(clients * 2)}",
+            "services": tuple(f"SVC-{s}" for s in rng.sample(range(30), rng.randint(1, 3))),
+            "recorded_discount": services_total * 0.1 if rng.random() < 0.15 else 0.0,
+        })
+    return records
+
+
+def benchmark_discount_simulator(appointments: int = 500000, clients: int = 40000, days: int = 730, seed: int = 3) -> Dict[str, Any]:
+    """
+    Бенчмарк what-if симулятора (без БД): повтор `appointments` синтетических записей за `days` дней
+    через SAMPLE_DISCOUNT_CONFIGS; оцениваются записи последнего года, ранние только копят статистику.
+    """
+    started = time.perf_counter()
+    records = build_synthetic_appointment_records(appointments, clients, days, seed)
+    build_ms = (time.perf_counter() - started) * 1000.0
+
+    discounts = [compile_auto_discount_config(c) for c in SAMPLE_DISCOUNT_CONFIGS]
+    to_date = records[-1]["starts_on"].date()
+    from_date = to_date - timedelta(days=364)
+
+    started = time.perf_counter()
+    report = simulate(records, discounts, from_date, to_date)
+    simulate_ms = (time.perf_counter() - started) * 1000.0
+
+    result = {
+        "appointments": len(records),
+        "evaluated": report["appointments"],
+        "build_ms": round(build_ms, 1),
+        "simulate_ms": round(simulate_ms, 1),
+        "per_appointment_us": round(simulate_ms * 1000.0 / max(1, len(records)), 2),
+        "proposed_discount_total": report["proposed"]["discount_total"],
+        "affected_clients": report["proposed"]["affected_clients"],
+    }
+    return result
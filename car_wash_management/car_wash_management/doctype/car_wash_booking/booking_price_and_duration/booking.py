@@ -1,33 +1,26 @@
 # car_wash/booking.py
 
 import frappe
+from frappe import _
 from typing import Dict, Any, Tuple
 
-from .tariffs import resolve_applicable_tariff
 from .validation import (
     validate_required_params,
     build_service_counter,
     build_custom_price_map,
 )
-from .cache_helpers import (
-    _make_service_ids_tuple,
-    _cached_get_valid_service_ids,
-    _cached_get_service_docs,
-    _cached_get_service_prices_by_tariff,
-    _ensure_tariff_valid_cached,
-)
-from .calculation import (
-    calculate_totals,
-)
 from .promocode import (
     validate_and_apply_promocode,
-    record_promocode_usage,
+    reserve_promocode,
+    confirm_promocode_usage,
 )
 from .auto_discounts import (
-    get_applicable_auto_discounts_cached,
     apply_best_auto_discounts,
     validate_auto_discount_with_promocode,
 )
+from .quote_context import QuoteContext
+from .quote_memo import get_request_quote_context, quote_fingerprint, memoize_quote
+from .tracing import debug_requested, quote_trace, trace_stage
 
 @frappe.whitelist(allow_guest=True)
 def get_booking_price_and_duration(
@@ -42,7 +35,7 @@ def get_booking_price_and_duration(
     created_by_admin: bool = True, # ← Создается ли бронирование администратором мойки
     apply_auto_discounts: bool = True, # ← Применять автоматические скидки
     disabled_auto_discounts: list = None, # ← Список ID отключенных автоскидок
-    auto_discount_cache_ttl: int = 300 # ← TTL кэша для автоскидок (5 минут)
+    debug: bool = False, # ← Вернуть тайминги стадий расчёта в "debug" (System Manager)
 ) -> Dict[str, Any]:
     """
     Compute total price & duration for the given car wash booking with promocode and auto discount support.
@@ -62,85 +55,225 @@ def get_booking_price_and_duration(
 
     Промокод применяется к итоговой стоимости услуг и может освобождать от комиссии за очередь.
     Автоскидки и промокоды могут комбинироваться в зависимости от настроек скидки.
+
+    debug=True добавляет в ответ "debug": время и число SQL-запросов по стадиям расчёта (см. tracing.py);
+    учитывается только для System Manager.
+    """
+    debug = debug_requested(debug)
+    with quote_trace(debug) as trace:
+        try:
+            # Текущая проверка оставлена без изменений (car остаётся required).
+            with trace_stage("validation"):
+                validate_required_params(car_wash, car, services)
+
+            response = _memoized_quote_cart(
+                get_request_quote_context(car_wash),
+                car=car,
+                services=services,
+                tariff=tariff,
+                promocode=promocode,
+                user=user,
+                is_time_booking=is_time_booking,
+                commission_amount=commission_amount,
+                created_by_admin=created_by_admin,
+                apply_auto_discounts=apply_auto_discounts,
+                disabled_auto_discounts=disabled_auto_discounts,
+            )
+
+        except frappe.ValidationError as ve:
+            frappe.log_error(ve.message, "Booking Validation Error")
+            response = {"status": "error", "message": ve.message}
+
+        except Exception as e:
+            frappe.log_error(str(e), "Booking Error")
+            response = {"status": "error", "message": str(e)}
+
+    if debug and trace is not None:
+        response["debug"] = trace.as_dict()
+    return response
+
+
+@frappe.whitelist(allow_guest=True)
+def get_booking_prices_and_durations(
+    car_wash: str,
+    carts: list,
+    is_time_booking: bool = False,
+    commission_amount: float = 100.0,
+    created_by_admin: bool = True,
+    apply_auto_discounts: bool = True,
+    debug: bool = False,
+) -> Dict[str, Any]:
     """
+    Batch variant of get_booking_price_and_duration: price many carts of one car wash in a single call.
+
+    Каждый элемент carts: {"car", "services", "tariff"?, "promocode"?, "user"?, "disabled_auto_discounts"?, "key"?}.
+    Прайс-каталог мойки (тарифы, услуги, цены), фича promo, автоскидки и статистика клиентов
+    загружаются один раз на мойку (QuoteContext) и переиспользуются всеми корзинами.
+
+    Returns:
+        {"status": "success", "count": N, "results": [...]} — results в порядке carts,
+        каждый элемент имеет тот же формат, что и ответ одиночного вызова (плюс "key", если передан).
+        Ошибка в одной корзине не прерывает расчёт остальных.
+        debug=True добавляет "debug" — стадии, суммированные по всем корзинам (только для System Manager).
+    """
+    debug = debug_requested(debug)
+    with quote_trace(debug) as trace:
+        try:
+            if isinstance(carts, str):
+                carts = frappe.parse_json(carts)
+            if not car_wash or not isinstance(carts, list):
+                frappe.throw(_("Provide 'car_wash' and a list of 'carts'."))
+
+            context = get_request_quote_context(car_wash)
+            with trace_stage("prefetch"):
+                _prefetch_carts(context, carts)
+
+            results = []
+            for cart in carts:
+                results.append(_quote_batch_cart(
+                    context,
+                    cart,
+                    is_time_booking=is_time_booking,
+                    commission_amount=commission_amount,
+                    created_by_admin=created_by_admin,
+                    apply_auto_discounts=apply_auto_discounts,
+                ))
+
+            response = {"status": "success", "count": len(results), "results": results}
+
+        except frappe.ValidationError as ve:
+            frappe.log_error(ve.message, "Booking Validation Error")
+            response = {"status": "error", "message": ve.message}
+
+        except Exception as e:
+            frappe.log_error(str(e), "Booking Error")
+            response = {"status": "error", "message": str(e)}
+
+    if debug and trace is not None:
+        response["debug"] = trace.as_dict()
+    return response
+
+
+def _prefetch_carts(context: QuoteContext, carts: list) -> None:
+    """Warm the context for all carts: cars with one query, each distinct tariff once."""
+    context.prefetch_cars(c.get("car") for c in carts if isinstance(c, dict))
+
+    for cart in carts:
+        if not isinstance(cart, dict) or not cart.get("services"):
+            continue
+        try:
+            context.resolve_tariff(cart.get("tariff"), cart.get("car"), cart["services"])
+        except frappe.ValidationError:
+            # Ошибка конкретной корзины вернётся в её результате
+            continue
+
+
+def _quote_batch_cart(context: QuoteContext, cart: Any, **defaults) -> Dict[str, Any]:
+    key = cart.get("key") if isinstance(cart, dict) else None
     try:
-        # Текущая проверка оставлена без изменений (car остаётся required).
-        validate_required_params(car_wash, car, services)
+        if not isinstance(cart, dict):
+            frappe.throw(_("Each cart must be an object."))
+        with trace_stage("validation"):
+            validate_required_params(context.car_wash, cart.get("car"), cart.get("services"))
+        result = _memoized_quote_cart(
+            context,
+            car=cart.get("car"),
+            services=cart.get("services"),
+            tariff=cart.get("tariff"),
+            promocode=cart.get("promocode"),
+            user=cart.get("user"),
+            disabled_auto_discounts=cart.get("disabled_auto_discounts"),
+            **defaults,
+        )
+    except frappe.ValidationError as ve:
+        result = {"status": "error", "message": ve.message}
+    except Exception as e:
+        frappe.log_error(str(e), "Booking Batch Error")
+        result = {"status": "error", "message": str(e)}
 
-        service_counter = build_service_counter(services)
+    if key is not None:
+        result["key"] = key
+    return result
 
-        # Определяем customer из автомобиля, если user не передан (или пустой)
-        resolved_user = user
-        if not resolved_user:
-            try:
-                car_doc = frappe.get_doc("Car wash car", car)
-                # попытка взять клиента из стандартного поля car.customer; fallback на client
-                resolved_user = getattr(car_doc, "customer", None) or getattr(car_doc, "client", None)
-            except Exception:
-                resolved_user = None
+
+def _memoized_quote_cart(context: QuoteContext, car: str, services: list, user: str = None, **params) -> Dict[str, Any]:
+    """_quote_cart reused within the request for identical inputs (see quote_memo)."""
+    with trace_stage("customer"):
+        customer = context.resolve_customer(car, user)
+    fingerprint = quote_fingerprint(context, car=car, services=services, customer=customer, **params)
+    return memoize_quote(
+        fingerprint,
+        lambda: _quote_cart(context, car=car, services=services, user=customer, **params),
+    )
+
+
+def _quote_cart(
+    context: QuoteContext,
+    car: str,
+    services: list,
+    tariff: Any = None,
+    promocode: str = None,
+    user: str = None,
+    is_time_booking: bool = False,
+    commission_amount: float = 100.0,
+    created_by_admin: bool = True,
+    apply_auto_discounts: bool = True,
+    disabled_auto_discounts: list = None,
+) -> Dict[str, Any]:
+    """Price one cart using lookups memoized in the context. Raises on validation errors."""
+    with trace_stage("validation"):
+        service_counter = build_service_counter(services)
 
         # Avoid building custom map if no custom_price entries exist
         custom_price_map = build_custom_price_map(services) if any(
             isinstance(s, dict) and s.get('custom_price') for s in services
         ) else {}
 
-        # Cache-aware resolution of valid ids
-        ids_tuple = _make_service_ids_tuple(service_counter)
-        valid_ids = list(_cached_get_valid_service_ids(ids_tuple))
+        # Validation of service ids against the price catalog
+        context.validate_service_ids(service_counter.keys())
+
+    # Определяем customer из автомобиля, если user не передан (или пустой)
+    with trace_stage("customer"):
+        resolved_user = context.resolve_customer(car, user)
 
-        # 1) Явно переданный тариф → валидируем, иначе авто-подбор
-        if tariff:
-            tariff_id = _ensure_tariff_valid_cached(tariff, car_wash)
-        else:
-            tariff_id = resolve_applicable_tariff(car_wash=car_wash, car=car, services=services)
+    # 1) Явно переданный тариф → валидируем, иначе авто-подбор
+    with trace_stage("tariff"):
+        tariff_id = context.resolve_tariff(tariff, car, services)
 
-        # 2) Документы услуг + цены по тарифу
-        ids_tuple = tuple(valid_ids)
-        docs = _cached_get_service_docs(ids_tuple)
-        prices = _cached_get_service_prices_by_tariff(ids_tuple, tariff_id)
+    # 2) Услуги и цены тарифа из прайс-каталога
+    with trace_stage("service_docs"):
+        service_docs = context.service_docs()
+    with trace_stage("prices"):
+        service_prices = context.service_prices(tariff_id)
 
-        # 3) Базовые итоги (без промокода)
-        base_services_price, total_duration, modifiers, custom_prices, staff_reward_total = calculate_totals(
-            service_counter, docs, prices, tariff_id, custom_price_map
+    # 3) Базовые итоги (без промокода)
+    with trace_stage("calculate_totals"):
+        base_services_price, total_duration, modifiers, custom_prices, staff_reward_total = context.base_totals(
+            service_counter, tariff_id, custom_price_map, service_docs=service_docs, service_prices=service_prices
         )
 
-        # 4) Расчет комиссии в зависимости от типа пользователя
-        actual_commission = 0.0
-        if not created_by_admin and not is_time_booking:
-            # Комиссия только для обычных пользователей при вставании в очередь
-            actual_commission = commission_amount
+    # 4) Расчет комиссии в зависимости от типа пользователя
+    actual_commission = 0.0
+    if not created_by_admin and not is_time_booking:
+        # Комиссия только для обычных пользователей при вставании в очередь
+        actual_commission = commission_amount
 
-        # 5) Проверка наличия фичи promo у мойки
-        print(f"DEBUG get_booking_price_and_duration: Checking promo feature for car_wash={car_wash}")
-        car_wash_doc = frappe.get_doc("Car wash", car_wash)
-        has_promo_feature = car_wash_doc.has_journal_feature("promo")
-        print(f"DEBUG get_booking_price_and_duration: has_promo_feature={has_promo_feature}")
+    # 5) Проверка наличия фичи promo у мойки
+    has_promo_feature = context.has_promo_feature
 
-        print("has_promo_feature", has_promo_feature)
-        
-        # 6) Получение и применение автоматических скидок (только если есть фича promo)
-        auto_discount_result = {"applied_discounts": [], "total_service_discount": 0.0, "commission_waived": 0.0, "final_services_total": base_services_price, "final_commission": actual_commission, "total_discount": 0.0}
+    # 6) Получение и применение автоматических скидок (только если есть фича promo)
+    auto_discount_result = {"applied_discounts": [], "total_service_discount": 0.0, "commission_waived": 0.0, "final_services_total": base_services_price, "final_commission": actual_commission, "total_discount": 0.0}
 
+    with trace_stage("auto_discounts"):
         if has_promo_feature and apply_auto_discounts and resolved_user:  # Автоскидки применяются только для авторизованных пользователей с фичей promo
             try:
                 # Получаем применимые автоскидки
-                applicable_auto_discounts = get_applicable_auto_discounts_cached(
-                    car_wash=car_wash,
+                applicable_auto_discounts = context.applicable_auto_discounts(
                     customer=resolved_user,
                     services=services,
                     services_total=base_services_price,
-                    cache_ttl_sec=auto_discount_cache_ttl,
-                    force_refresh=True
                 )
 
-                print("car_wash", car_wash)
-                print("resolved_user", resolved_user)
-                print("services", services)
-                print("base_services_price", base_services_price)
-                print("auto_discount_cache_ttl", auto_discount_cache_ttl)
-                print("force_refresh", True)
-                print("applicable_auto_discounts", applicable_auto_discounts)
-
                 # Исключаем отключенные скидки
                 if disabled_auto_discounts:
                     applicable_auto_discounts = [
@@ -157,25 +290,25 @@ def get_booking_price_and_duration(
                         allow_combinations=True
                     )
             except Exception as e:
-                print("Auto discount error: ", e)
                 frappe.log_error(f"Auto discount error: {str(e)}", "Auto Discount Error")
                 # Продолжаем без автоскидок в случае ошибки
 
-        # Обновляем стоимость после автоскидок
-        services_after_auto_discount = auto_discount_result["final_services_total"]
-        commission_after_auto_discount = auto_discount_result["final_commission"]
-
-        # 7) Применение промокода (только если есть фича promo)
-        promo_result = {
-            'valid': False,
-            'message': '',
-            'service_discount': 0.0,
-            'commission_waived': 0.0,
-            'total_discount': 0.0,
-            'final_services_total': services_after_auto_discount,
-            'final_commission': commission_after_auto_discount,
-        }
-
+    # Обновляем стоимость после автоскидок
+    services_after_auto_discount = auto_discount_result["final_services_total"]
+    commission_after_auto_discount = auto_discount_result["final_commission"]
+
+    # 7) Применение промокода (только если есть фича promo)
+    promo_result = {
+        'valid': False,
+        'message': '',
+        'service_discount': 0.0,
+        'commission_waived': 0.0,
+        'total_discount': 0.0,
+        'final_services_total': services_after_auto_discount,
+        'final_commission': commission_after_auto_discount,
+    }
+
+    with trace_stage("promocode"):
         if has_promo_feature and promocode:
             # Проверяем совместимость автоскидок с промокодом
             can_combine = validate_auto_discount_with_promocode(auto_discount_result, True)
@@ -183,13 +316,14 @@ def get_booking_price_and_duration(
             if can_combine:
                 promo_result = validate_and_apply_promocode(
                     promocode=promocode,
-                    car_wash=car_wash,
+                    car_wash=context.car_wash,
                     user=resolved_user,
                     services_total=services_after_auto_discount,  # Применяем к цене после автоскидок
                     commission_amount=commission_after_auto_discount,
                     is_time_booking=is_time_booking,
                     services=services,
-                    created_by_admin=created_by_admin
+                    created_by_admin=created_by_admin,
+                    has_promo_feature=has_promo_feature
                 )
             else:
                 promo_result = {
@@ -202,70 +336,62 @@ def get_booking_price_and_duration(
                     'final_commission': commission_after_auto_discount,
                 }
 
-        # 8) Финальные расчёты с учётом промокода
-        final_services_price = promo_result['final_services_total']
-        final_commission = promo_result['final_commission']
-        # Для очереди обычного пользователя возвращаем к оплате только комиссию
-        if not created_by_admin and not is_time_booking:
-            final_total = final_commission
-        else:
-            final_total = final_services_price + final_commission
-
-        response = {
-            "status": "success",
-            "base_services_price": base_services_price,
-            "final_services_price": final_services_price,
-            "original_commission": actual_commission,
-            "final_commission": final_commission,
-            "total_price": final_total,
-            "total_duration": total_duration,
-            "staff_reward_total": staff_reward_total,
-            "applied_modifiers": modifiers,
-            "applied_custom_prices": custom_prices,
-            "tariff": tariff_id,
-            "created_by_admin": created_by_admin,
-            "is_time_booking": is_time_booking,
-            "has_promo_feature": has_promo_feature,
-
-            # Информация об автоматических скидках
-            "auto_discounts_applied": len(auto_discount_result["applied_discounts"]) > 0,
-            "auto_discounts": {
-                "applied_discounts": auto_discount_result["applied_discounts"],
-                "total_service_discount": auto_discount_result["total_service_discount"],
-                "commission_waived": auto_discount_result["commission_waived"],
-                "total_discount": auto_discount_result["total_discount"],
-                "services_price_after_auto_discounts": services_after_auto_discount,
-                "commission_after_auto_discounts": commission_after_auto_discount
-            },
-
-            # Информация о промокоде
-            "promocode_applied": promo_result['valid'],
-            "promocode_message": promo_result.get('message', ''),
-            "promocode_discount": {
-                "service_discount": promo_result['service_discount'],
-                "commission_waived": promo_result['commission_waived'],
-                "total_discount": promo_result['total_discount'],
-                "promo_type": promo_result.get('promo_type'),
-                "promo_data": promo_result.get('promo_data')
-            },
-
-            # Общая информация о скидках
-            "total_discounts": {
-                "auto_discount_total": auto_discount_result["total_discount"],
-                "promocode_total": promo_result['total_discount'],
-                "combined_total": auto_discount_result["total_discount"] + promo_result['total_discount']
-            }
+    # 8) Финальные расчёты с учётом промокода
+    final_services_price = promo_result['final_services_total']
+    final_commission = promo_result['final_commission']
+    # Для очереди обычного пользователя возвращаем к оплате только комиссию
+    if not created_by_admin and not is_time_booking:
+        final_total = final_commission
+    else:
+        final_total = final_services_price + final_commission
+
+    response = {
+        "status": "success",
+        "base_services_price": base_services_price,
+        "final_services_price": final_services_price,
+        "original_commission": actual_commission,
+        "final_commission": final_commission,
+        "total_price": final_total,
+        "total_duration": total_duration,
+        "staff_reward_total": staff_reward_total,
+        "applied_modifiers": modifiers,
+        "applied_custom_prices": custom_prices,
+        "tariff": tariff_id,
+        "created_by_admin": created_by_admin,
+        "is_time_booking": is_time_booking,
+        "has_promo_feature": has_promo_feature,
+
+        # Информация об автоматических скидках
+        "auto_discounts_applied": len(auto_discount_result["applied_discounts"]) > 0,
+        "auto_discounts": {
+            "applied_discounts": auto_discount_result["applied_discounts"],
+            "total_service_discount": auto_discount_result["total_service_discount"],
+            "commission_waived": auto_discount_result["commission_waived"],
+            "total_discount": auto_discount_result["total_discount"],
+            "services_price_after_auto_discounts": services_after_auto_discount,
+            "commission_after_auto_discounts": commission_after_auto_discount
+        },
+
+        # Информация о промокоде
+        "promocode_applied": promo_result['valid'],
+        "promocode_message": promo_result.get('message', ''),
+        "promocode_discount": {
+            "service_discount": promo_result['service_discount'],
+            "commission_waived": promo_result['commission_waived'],
+            "total_discount": promo_result['total_discount'],
+            "promo_type": promo_result.get('promo_type'),
+            "promo_data": promo_result.get('promo_data')
+        },
+
+        # Общая информация о скидках
+        "total_discounts": {
+            "auto_discount_total": auto_discount_result["total_discount"],
+            "promocode_total": promo_result['total_discount'],
+            "combined_total": auto_discount_result["total_discount"] + promo_result['total_discount']
         }
+    }
 
-        return response
-
-    except frappe.ValidationError as ve:
-        frappe.log_error(ve.message, "Booking Validation Error")
-        return {"status": "error", "message": ve.message}
-
-    except Exception as e:
-        frappe.log_error(str(e), "Booking Error")
-        return {"status": "error", "message": str(e)}
+    return response
 
 
 @frappe.whitelist()
@@ -283,6 +409,8 @@ def apply_promocode_to_booking_attempt(
         promocode: Promocode to apply
         created_by_admin: True if promocode is being applied by admin
     """
+    # Резерв промокода и изменения попытки — в одной транзакции; при ошибке откатываем до savepoint
+    frappe.db.savepoint("apply_promocode")
     try:
         # Получаем документ booking attempt
         booking_doc = frappe.get_doc("Car wash mobile booking attempt", booking_attempt_id)
@@ -313,7 +441,8 @@ def apply_promocode_to_booking_attempt(
             commission_amount=original_commission,
             is_time_booking=booking_doc.is_time_booking,
             services=booking_doc.services,
-            created_by_admin=created_by_admin
+            created_by_admin=created_by_admin,
+            has_promo_feature=has_promo_feature
         )
 
         if not promo_result['valid']:
@@ -322,6 +451,14 @@ def apply_promocode_to_booking_attempt(
                 "message": promo_result['message']
             }
 
+        # Атомарно занимаем использование промокода до изменения попытки
+        usage_name = reserve_promocode(promocode, booking_doc.car_wash, booking_attempt_id, booking_doc.user, promo_result)
+        if not usage_name:
+            return {
+                "status": "error",
+                "message": _('Промокод исчерпал лимит использований')
+            }
+
         # Обновляем документ
         booking_doc.promo_code_applied = promocode
         booking_doc.promo_code_type = promo_result['promo_type']
@@ -337,8 +474,8 @@ def apply_promocode_to_booking_attempt(
 
         booking_doc.save()
 
-        # Записываем использование промокода
-        record_promocode_usage(promocode, booking_attempt_id, booking_doc.user, promo_result)
+        # Использование подтверждается в той же транзакции, коммит — по завершении запроса
+        confirm_promocode_usage(usage_name)
 
         return {
             "status": "success",
@@ -352,5 +489,6 @@ def apply_promocode_to_booking_attempt(
         }
 
     except Exception as e:
+        frappe.db.rollback(save_point="apply_promocode")
         frappe.log_error(str(e), "Promocode Application Error")
         return {"status": "error", "message": str(e)}
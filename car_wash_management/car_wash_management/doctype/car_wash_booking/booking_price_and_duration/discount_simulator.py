@@ -0,0 +1,412 @@
+# car_wash/discount_simulator.py
+"""
+What-if simulator for auto discounts.
+
+Replays past appointments of a car wash through a proposed discount
+configuration and reports what it would have cost: discount amount, affected
+clients and the impact on revenue and margin, next to what was actually given.
+
+Everything runs in bulk and in memory:
+- appointments (with their services and recorded auto discount usage) are
+  streamed in keyset-paginated chunks ordered by starts_on, a constant number
+  of queries per chunk;
+- each client's running statistics (all time, calendar year and month of the
+  appointment) are accumulated as the stream goes, so every appointment is
+  evaluated against the stats its client had right before it — the same
+  periods the live rules look at (see client_stats);
+- discounts are compiled once (auto_discount_rules) and chosen with the same
+  solver as live quotes (discount_solver). Per-client usage limits are tracked.
+
+Appointments before from_date only build up statistics. The price before
+discounts is services_total plus the auto discounts recorded for the
+appointment; margin is that price minus discounts minus staff reward.
+Queue commission does not apply to appointments and is not simulated.
+"""
+
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence
+
+import frappe
+from frappe import _
+from frappe.utils import flt, get_datetime, getdate
+
+from .auto_discount_rules import (
+    CompiledAutoDiscount,
+    ServiceUsageCountRule,
+    compile_auto_discount_config,
+    compile_auto_discount_doc,
+    get_compiled_auto_discounts,
+)
+from .discount_solver import POLICY_MAX_DISCOUNT, choose_auto_discounts, set_value_cents
+
+CHUNK_SIZE = 20000
+
+APPOINTMENT_FIELDS = [
+    "name", "customer", "starts_on", "payment_status", "services_total", "staff_reward_total", "car",
+]
+
+
+class _Period:
+    """Running statistics of one client for one period (only ever grows during a replay)."""
+    __slots__ = ("key", "total", "paid", "spent", "first_visit", "last_visit", "cars", "services")
+
+    def __init__(self, key: Any = None):
+        self.reset(key)
+
+    def reset(self, key: Any) -> None:
+        self.key = key
+        self.total = 0
+        self.paid = 0
+        self.spent = 0.0
+        self.first_visit: Optional[datetime] = None
+        self.last_visit: Optional[datetime] = None
+        self.cars: set = set()
+        self.services: Dict[str, int] = {}
+
+    def add(self, record: Mapping[str, Any], track: "_Tracking") -> None:
+        self.total += 1
+        if record["paid"]:
+            self.paid += 1
+            self.spent += record["services_total"]
+        starts_on = record["starts_on"]
+        if self.first_visit is None:
+            self.first_visit = starts_on
+        self.last_visit = starts_on  # поток упорядочен по starts_on
+        if track.cars and record["car"]:
+            self.cars.add(record["car"])
+        if track.services:
+            services = self.services
+            for service in record["services"]:
+                services[service] = services.get(service, 0) + 1
+
+    def get(self, field: str, default: Any = None) -> Any:
+        """Read like a client_stats._period_stats dict, without building one per evaluation."""
+        getter = _PERIOD_FIELDS.get(field)
+        return getter(self) if getter is not None else default
+
+
+_PERIOD_FIELDS = {
+    "total_appointments": lambda p: p.total,
+    "paid_appointments": lambda p: p.paid,
+    "spent_total": lambda p: p.spent,
+    "avg_ticket": lambda p: (p.spent / p.paid) if p.paid else 0.0,
+    "unique_cars": lambda p: len(p.cars),
+    "first_visit_on": lambda p: p.first_visit,
+    "last_visit_on": lambda p: p.last_visit,
+    # порядок не важен: правила суммируют count по своим услугам
+    "top_services": lambda p: [{"service": service, "count": count} for service, count in p.services.items()],
+}
+
+_EMPTY_PERIOD = _Period()
+
+
+class _Tracking:
+    """What the discounts being simulated actually read; the rest is not accumulated."""
+    __slots__ = ("periods", "cars", "services")
+
+    def __init__(self, discounts: Sequence[CompiledAutoDiscount]):
+        rules = [rule for d in discounts for rule in d.rules]
+        # Правила без period (Nth Order, First Time Customer) читают all_time
+        self.periods = frozenset(getattr(rule, "period", "all_time") for rule in rules)
+        self.cars = any(getattr(rule, "stat_field", None) == "unique_cars" for rule in rules)
+        self.services = any(isinstance(rule, ServiceUsageCountRule) for rule in rules)
+
+
+class _ClientHistory:
+    __slots__ = ("all_time", "year", "month")
+
+    def __init__(self):
+        self.all_time = _Period()
+        self.year = _Period()
+        self.month = _Period()
+
+    def stats(self, starts_on: datetime) -> Dict[str, Any]:
+        """Stats as they were right before an appointment at starts_on (periods read like dicts)."""
+        return {"periods": {
+            "all_time": self.all_time,
+            "year": self.year if self.year.key == starts_on.year else _EMPTY_PERIOD,
+            "month": self.month if self.month.key == (starts_on.year, starts_on.month) else _EMPTY_PERIOD,
+        }}
+
+    def add(self, record: Mapping[str, Any], track: _Tracking) -> None:
+        starts_on = record["starts_on"]
+        self.all_time.add(record, track)
+        if "year" in track.periods:
+            if self.year.key != starts_on.year:
+                self.year.reset(starts_on.year)
+            self.year.add(record, track)
+        if "month" in track.periods:
+            if self.month.key != (starts_on.year, starts_on.month):
+                self.month.reset((starts_on.year, starts_on.month))
+            self.month.add(record, track)
+
+
+def _candidates(
+    discounts: Sequence[CompiledAutoDiscount],
+    stats: Mapping[str, Any],
+    record: Mapping[str, Any],
+    day: date,
+    base_total: float,
+    used: Mapping[str, int],
+) -> List[Dict[str, Any]]:
+    """Applicable discounts for one appointment, as _get_applicable_auto_discounts would list them.
+    discounts must already be valid for the day."""
+    result = []
+    for discount in discounts:
+        if discount.minimum_order_amount and base_total < discount.minimum_order_amount:
+            continue
+        if discount.usage_limit_per_customer and used.get(discount.name, 0) >= discount.usage_limit_per_customer:
+            continue
+        if not discount.is_condition_met(stats, day):
+            continue
+        if not discount.is_applicable_to_services(record["services"]):
+            continue
+        result.append({
+            "discount_id": discount.name,
+            "name": discount.name_title,
+            "service_discount": discount.calculate_discount_amount(base_total),
+            "waive_queue_commission": 0,
+            "priority": discount.priority,
+            "can_combine_with_other_auto_discounts": discount.can_combine_with_other_auto_discounts,
+        })
+    return result
+
+
+def simulate(
+    records: Iterable[Mapping[str, Any]],
+    discounts: Sequence[CompiledAutoDiscount],
+    from_date: date,
+    to_date: date,
+    policy: str = POLICY_MAX_DISCOUNT,
+) -> Dict[str, Any]:
+    """
+    Replay records ordered by starts_on. Each record: name, client, starts_on (datetime), paid,
+    services_total, staff_reward, car, services (tuple of ids), recorded_discount.
+    """
+    track = _Tracking(discounts)
+    valid_by_day: Dict[date, List[CompiledAutoDiscount]] = {}
+    histories: Dict[str, _ClientHistory] = {}
+    usage: Dict[str, Dict[str, int]] = {}
+    by_discount: Dict[str, Dict[str, Any]] = {
+        d.name: {"title": d.name_title, "uses": 0, "amount": 0.0, "clients": set()} for d in discounts
+    }
+
+    appointments = 0
+    base_total = proposed_total = historical_total = staff_total = 0.0
+    proposed_clients: set = set()
+    historical_clients: set = set()
+    proposed_count = historical_count = 0
+
+    for record in records:
+        client = record["client"]
+        history = histories.get(client)
+        if history is None:
+            history = histories[client] = _ClientHistory()
+
+        day = record["starts_on"].date()
+        if from_date <= day <= to_date:
+            appointments += 1
+            base = record["services_total"] + record["recorded_discount"]
+            base_total += base
+            staff_total += record["staff_reward"]
+            if record["recorded_discount"] > 0:
+                historical_total += record["recorded_discount"]
+                historical_count += 1
+                historical_clients.add(client)
+
+            valid = valid_by_day.get(day)
+            if valid is None:
+                valid = valid_by_day[day] = [d for d in discounts if d.is_valid_for_date(day)]
+            if valid:
+                used = usage.get(client) or {}
+                candidates = _candidates(valid, history.stats(record["starts_on"]), record, day, base, used)
+                if candidates:
+                    chosen = candidates if len(candidates) == 1 else choose_auto_discounts(candidates, base, 0.0, True, policy)
+                    amount = set_value_cents(chosen, base, 0.0) / 100.0
+                    proposed_total += amount
+                    proposed_count += 1
+                    proposed_clients.add(client)
+                    used = usage.setdefault(client, {})
+                    # При нескольких скидках сумма делится пропорционально (с учётом потолка по сумме услуг)
+                    raw = sum(c["service_discount"] for c in chosen) or 1.0
+                    for c in chosen:
+                        stat = by_discount[c["discount_id"]]
+                        stat["uses"] += 1
+                        stat["amount"] += amount * c["service_discount"] / raw
+                        stat["clients"].add(client)
+                        used[c["discount_id"]] = used.get(c["discount_id"], 0) + 1
+
+        history.add(record, track)
+
+    historical_revenue = base_total - historical_total
+    proposed_revenue = base_total - proposed_total
+    historical_margin = historical_revenue - staff_total
+    proposed_margin = proposed_revenue - staff_total
+
+    def pct(part: float, whole: float) -> float:
+        return round(part * 100.0 / whole, 2) if whole else 0.0
+
+    return {
+        "appointments": appointments,
+        "clients_seen": len(histories),
+        "proposed": {
+            "discount_total": flt(proposed_total, 2),
+            "appointments_discounted": proposed_count,
+            "affected_clients": len(proposed_clients),
+            "newly_discounted_clients": len(proposed_clients - historical_clients),
+            "no_longer_discounted_clients": len(historical_clients - proposed_clients),
+            "by_discount": {
+                name: {"title": s["title"], "uses": s["uses"], "amount": flt(s["amount"], 2), "clients": len(s["clients"])}
+                for name, s in by_discount.items()
+            },
+        },
+        "historical": {
+            "discount_total": flt(historical_total, 2),
+            "appointments_discounted": historical_count,
+            "affected_clients": len(historical_clients),
+        },
+        "revenue": {
+            "before_discounts": flt(base_total, 2),
+            "historical": flt(historical_revenue, 2),
+            "proposed": flt(proposed_revenue, 2),
+            "delta": flt(proposed_revenue - historical_revenue, 2),
+        },
+        "margin": {
+            "staff_reward_total": flt(staff_total, 2),
+            "historical": flt(historical_margin, 2),
+            "proposed": flt(proposed_margin, 2),
+            "delta": flt(proposed_margin - historical_margin, 2),
+            "historical_pct": pct(historical_margin, historical_revenue),
+            "proposed_pct": pct(proposed_margin, proposed_revenue),
+        },
+    }
+
+
+# ---- loading ----
+def _chunk_services(names: List[str]) -> Dict[str, List[str]]:
+    services: Dict[str, List[str]] = {}
+    for row in frappe.get_all(
+        "Car wash appointment service",
+        filters={"parenttype": "Car wash appointment", "parent": ["in", names]},
+        fields=["parent", "service"],
+        limit_page_length=0,
+    ):
+        services.setdefault(row.parent, []).append(row.service)
+    return services
+
+
+def _chunk_recorded_discounts(names: List[str]) -> Dict[str, float]:
+    return {
+        row.context_id: flt(row.service_discount)
+        for row in frappe.get_all(
+            "Car wash auto discount usage",
+            filters={"context_type": "Appointment", "context_id": ["in", names], "is_disabled": 0},
+            fields=["context_id", "sum(service_discount) as service_discount"],
+            group_by="context_id",
+            limit_page_length=0,
+        )
+    }
+
+
+def stream_appointment_records(car_wash: str, to_date: date, chunk_size: int = CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    """Appointments of a car wash up to to_date ordered by starts_on: three queries per chunk."""
+    until = datetime.combine(getdate(to_date), datetime.max.time())
+    last: Optional[tuple] = None
+    while True:
+        conditions = "car_wash = %(car_wash)s and is_deleted = 0 and customer is not null and customer != ''" \
+            " and starts_on is not null and starts_on <= %(until)s"
+        params: Dict[str, Any] = {"car_wash": car_wash, "until": until, "limit": int(chunk_size)}
+        if last:
+            # keyset-пагинация по (starts_on, name) — без OFFSET
+            conditions += " and (starts_on > %(last_starts_on)s or (starts_on = %(last_starts_on)s and name > %(last_name)s))"
+            params.update(last_starts_on=last[0], last_name=last[1])
+        rows = frappe.db.sql(
+            f"""
+            select {', '.join(f'`{field}`' for field in APPOINTMENT_FIELDS)}
+            from `tabCar wash appointment`
+            where {conditions}
+            order by starts_on asc, name asc
+            limit %(limit)s
+            """,
+            params,
+            as_dict=True,
+        )
+        if not rows:
+            return
+
+        names = [r.name for r in rows]
+        services = _chunk_services(names)
+        recorded = _chunk_recorded_discounts(names)
+        for r in rows:
+            yield {
+                "name": r.name,
+                "client": r.customer,
+                "starts_on": get_datetime(r.starts_on),
+                "paid": r.payment_status == "Paid",
+                "services_total": flt(r.services_total),
+                "staff_reward": flt(r.staff_reward_total),
+                "car": r.car,
+                "services": tuple(services.get(r.name, ())),
+                "recorded_discount": recorded.get(r.name, 0.0),
+            }
+        if len(rows) < chunk_size:
+            return
+        last = (rows[-1].starts_on, rows[-1].name)
+
+
+def _compile_proposed(car_wash: str, discounts: Any) -> List[CompiledAutoDiscount]:
+    """None — current active set; list of names — those discounts; list of dicts — unsaved configs."""
+    if discounts is None:
+        return list(get_compiled_auto_discounts(car_wash))
+    compiled = []
+    for index, item in enumerate(discounts, start=1):
+        if isinstance(item, str):
+            doc = frappe.get_doc("Car wash auto discount", item)
+            if doc.car_wash != car_wash:
+                frappe.throw(_("Auto discount {0} does not belong to car wash {1}.").format(item, car_wash))
+            compiled.append(compile_auto_discount_doc(doc))
+        else:
+            compiled.append(compile_auto_discount_config(item, index))
+    # Отчёт ведётся по имени скидки: одинаковые имена слились бы в одну строку
+    names = [d.name for d in compiled]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        frappe.throw(_("Proposed discounts must have unique names: {0}").format(", ".join(duplicates)))
+    # Порядок как у живого расчёта: priority asc
+    return sorted(compiled, key=lambda d: d.priority)
+
+
+@frappe.whitelist()
+def simulate_auto_discounts(
+    car_wash: str,
+    from_date: str,
+    to_date: str,
+    discounts: Any = None,
+    policy: str = POLICY_MAX_DISCOUNT,
+) -> Dict[str, Any]:
+    """
+    What-if replay of [from_date, to_date] appointments through a discount configuration.
+
+    discounts: None (current active discounts), list of `Car wash auto discount` names, or list of
+    unsaved configurations (see auto_discount_rules.compile_auto_discount_config).
+    """
+    frappe.has_permission("Car wash auto discount", "write", throw=True)
+    if isinstance(discounts, str):
+        discounts = frappe.parse_json(discounts)
+    from_date, to_date = getdate(from_date), getdate(to_date)
+    if from_date > to_date:
+        frappe.throw(_("'from_date' must not be after 'to_date'."))
+
+    started = time.perf_counter()
+    compiled = _compile_proposed(car_wash, discounts)
+    result = simulate(stream_appointment_records(car_wash, to_date), compiled, from_date, to_date, policy=policy)
+    result.update({
+        "car_wash": car_wash,
+        "from_date": str(from_date),
+        "to_date": str(to_date),
+        "policy": policy,
+        "discounts": [d.name for d in compiled],
+        "elapsed_ms": round((time.perf_counter() - started) * 1000.0, 1),
+    })
+    return result
@@ -0,0 +1,172 @@
+# car_wash/discount_solver.py
+"""
+Choice of the auto discount set to apply.
+
+Feasible sets: any single applicable discount, or any set of discounts that
+all allow combining with other auto discounts (a non-combinable discount is
+exclusive). Stacked service discounts are capped by the services total and the
+queue commission is waived at most once.
+
+Policies:
+- "max_discount" (default): the set with the largest total discount; ties go to
+  fewer discounts, then to higher priority (earlier candidates).
+- "priority": the highest priority discount, stacked with the other combinable
+  ones when it is combinable itself.
+
+Stacking more discounts never lowers the total, so the best value is known
+upfront (stack every combinable discount). What is left is the smallest set
+reaching it, then the highest priority one: the size comes from the largest
+amounts, and the set is built index by index, taking the earliest discount that
+still lets the rest reach the value. "Can r discounts of a suffix reach it" is
+O(1) from per-suffix sorted prefix sums, so the whole choice is O(n^2 log n)
+with no search and no input-dependent blow-up.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+POLICY_MAX_DISCOUNT = "max_discount"
+POLICY_PRIORITY = "priority"
+
+
+def _cents(value: float) -> int:
+    return int(round(float(value or 0) * 100))
+
+
+def set_value_cents(discounts: Sequence[Dict[str, Any]], services_total: float, commission_amount: float) -> int:
+    """Total discount (in cents) of applying the given discounts together."""
+    if not discounts:
+        return 0
+    service_part = sum(_cents(d["service_discount"]) for d in discounts)
+    if len(discounts) > 1:
+        service_part = min(service_part, _cents(services_total))
+    waived = _cents(commission_amount) if any(d.get("waive_queue_commission") for d in discounts) else 0
+    return service_part + waived
+
+
+def is_feasible(discounts: Sequence[Dict[str, Any]]) -> bool:
+    return len(discounts) <= 1 or all(d.get("can_combine_with_other_auto_discounts") for d in discounts)
+
+
+def _better(value: int, chosen: Tuple[int, ...], best_value: int, best: Optional[Tuple[int, ...]]) -> bool:
+    if best is None or value != best_value:
+        return best is None or value > best_value
+    if len(chosen) != len(best):
+        return len(chosen) < len(best)
+    return chosen < best
+
+
+def _solve_max_discount(
+    candidates: Sequence[Dict[str, Any]],
+    services_total: float,
+    commission_amount: float,
+    allow_combinations: bool,
+) -> Tuple[int, ...]:
+    commission = _cents(commission_amount)
+
+    # Singletons are always feasible
+    best: Optional[Tuple[int, ...]] = None
+    best_value = -1
+    for idx, discount in enumerate(candidates):
+        value = set_value_cents([discount], services_total, commission_amount)
+        if _better(value, (idx,), best_value, best):
+            best, best_value = (idx,), value
+
+    combinable = [idx for idx, d in enumerate(candidates) if d.get("can_combine_with_other_auto_discounts")]
+    if not allow_combinations or len(combinable) < 2:
+        return best
+
+    # Positions below are in combinable (priority) order
+    amounts = [_cents(candidates[idx]["service_discount"]) for idx in combinable]
+    waives = [bool(candidates[idx].get("waive_queue_commission")) for idx in combinable]
+    n = len(combinable)
+
+    # Value of stacking everything: no combination does better, and a singleton reaching it wins the tie
+    need_waiver = commission > 0 and any(waives)
+    target = min(sum(amounts), _cents(services_total))
+    if target + (commission if need_waiver else 0) <= best_value:
+        return best
+
+    # Per suffix: prefix sums of its amounts sorted descending and the rank/amount of its largest waiver
+    suffixes = []
+    for start in range(n + 1):
+        ranked = sorted(range(start, n), key=lambda pos: -amounts[pos])
+        prefix = [0]
+        for pos in ranked:
+            prefix.append(prefix[-1] + amounts[pos])
+        waiver_rank = next((rank for rank, pos in enumerate(ranked) if waives[pos]), None)
+        suffixes.append((prefix, waiver_rank, amounts[ranked[waiver_rank]] if waiver_rank is not None else 0))
+
+    def reaches(start: int, count: int, missing: int, waiver: bool) -> bool:
+        """Can `count` discounts after `start` add `missing` cents (and a waiver, if needed)?"""
+        prefix, waiver_rank, waiver_amount = suffixes[start]
+        if count > len(prefix) - 1:
+            return False
+        if not waiver:
+            return prefix[count] >= missing
+        if count == 0 or waiver_rank is None:
+            return False
+        top = prefix[count] if waiver_rank < count else prefix[count - 1] + waiver_amount
+        return top >= missing
+
+    size = next(count for count in range(1, n + 1) if reaches(0, count, target, need_waiver))
+
+    # Earliest position at every step that still completes the set: the highest priority set of that size
+    chosen: List[int] = []
+    start, missing, waiver = 0, target, need_waiver
+    for step in range(size):
+        for pos in range(start, n):
+            if reaches(pos + 1, size - step - 1, missing - amounts[pos], waiver and not waives[pos]):
+                chosen.append(combinable[pos])
+                start, missing, waiver = pos + 1, missing - amounts[pos], waiver and not waives[pos]
+                break
+    return tuple(chosen)
+
+
+def _solve_priority(candidates: Sequence[Dict[str, Any]], allow_combinations: bool) -> Tuple[int, ...]:
+    first = candidates[0]
+    if not allow_combinations or not first.get("can_combine_with_other_auto_discounts"):
+        return (0,)
+    return tuple(idx for idx, d in enumerate(candidates) if idx == 0 or d.get("can_combine_with_other_auto_discounts"))
+
+
+def choose_auto_discounts(
+    candidates: Sequence[Dict[str, Any]],
+    services_total: float,
+    commission_amount: float = 0.0,
+    allow_combinations: bool = True,
+    policy: str = POLICY_MAX_DISCOUNT,
+) -> List[Dict[str, Any]]:
+    """
+    Pick the discounts to apply from applicable ones (ordered by priority, as
+    _get_applicable_auto_discounts returns them). Returned in candidate order.
+    """
+    if not candidates:
+        return []
+    if policy == POLICY_PRIORITY:
+        chosen = _solve_priority(candidates, allow_combinations)
+    else:
+        chosen = _solve_max_discount(candidates, services_total, commission_amount, allow_combinations)
+    return [candidates[idx] for idx in sorted(chosen)]
+
+
+def brute_force_auto_discounts(
+    candidates: Sequence[Dict[str, Any]],
+    services_total: float,
+    commission_amount: float = 0.0,
+    allow_combinations: bool = True,
+) -> List[Dict[str, Any]]:
+    """Reference for "max_discount": enumerate every feasible subset (tests and benchmarks only)."""
+    best: Optional[Tuple[int, ...]] = None
+    best_value = -1
+    n = len(candidates)
+    for mask in range(1, 1 << n):
+        chosen = tuple(idx for idx in range(n) if mask >> idx & 1)
+        if len(chosen) > 1 and not allow_combinations:
+            continue
+        subset = [candidates[idx] for idx in chosen]
+        if not is_feasible(subset):
+            continue
+        value = set_value_cents(subset, services_total, commission_amount)
+        if _better(value, chosen, best_value, best):
+            best, best_value = chosen, value
+    return [candidates[idx] for idx in best] if best is not None else []
@@ -0,0 +1,114 @@
+# car_wash/price_catalog.py
+"""
+Compiled, immutable price catalog per car wash.
+
+One catalog holds everything a quote needs about prices: services (with
+durations and price modifier fields), tariffs, tariff prices and the compiled
+tariff filters used for auto-selection (see tariff_matcher.py). It is
+tagged with a version token (see versioning.py); any change of
+`Car wash service`, `Car wash service price`, `Car wash service price modifier`
+or `Car wash tariff` (filters are its child rows) bumps the version, and the next quote rebuilds it.
+
+Lookup order: worker memory (same version) → Redis payload for the version → database.
+"""
+
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import frappe
+
+from .repository import get_car_wash_services, get_car_wash_tariffs, get_service_price_rows, get_tariff_filter_rows
+from .tariff_matcher import TariffMatcher, compile_tariff_matcher
+from .versioning import get_version, bump_version_now_and_after_commit
+
+VERSION_NAMESPACE = "price_catalog"
+PAYLOAD_TTL_SEC = 24 * 3600
+
+# (site, car_wash) -> PriceCatalog
+_catalogs: Dict[Tuple[str, str], "PriceCatalog"] = {}
+
+
+@dataclass(frozen=True)
+class PriceCatalog:
+    """Read-only view of a car wash price list. Rows must not be mutated by callers."""
+    car_wash: str
+    version: str
+    services: Mapping[str, Any]
+    active_service_ids: frozenset
+    tariffs: Mapping[str, Any]
+    active_tariffs: Tuple[str, ...]  # by priority desc, modified desc
+    prices: Mapping[str, Mapping[str, Mapping[str, Any]]]  # tariff -> service -> price info
+    tariff_matcher: TariffMatcher
+
+    def tariff_prices(self, tariff_id: str) -> Mapping[str, Mapping[str, Any]]:
+        return self.prices.get(tariff_id, _EMPTY)
+
+
+_EMPTY: Mapping = MappingProxyType({})
+
+
+def get_price_catalog(car_wash: str) -> PriceCatalog:
+    """Current catalog of a car wash; costs one Redis read when warm."""
+    version = get_version(VERSION_NAMESPACE, car_wash)
+    local_key = (getattr(frappe.local, "site", None) or "", car_wash)
+    catalog = _catalogs.get(local_key)
+    if catalog is not None and catalog.version == version:
+        return catalog
+
+    payload_key = f"price_catalog:{car_wash}:{version}"
+    payload = frappe.cache().get_value(payload_key)
+    if payload is None:
+        payload = _load_payload(car_wash)
+        frappe.cache().set_value(payload_key, payload, expires_in_sec=PAYLOAD_TTL_SEC)
+
+    catalog = _compile(car_wash, version, payload)
+    _catalogs[local_key] = catalog
+    return catalog
+
+
+def bump_price_catalog_version(car_wash: Optional[str]) -> None:
+    """Invalidate the catalog of a car wash (call from doc events of price-related doctypes)."""
+    if car_wash:
+        bump_version_now_and_after_commit(VERSION_NAMESPACE, car_wash)
+
+
+def _load_payload(car_wash: str) -> Dict[str, Any]:
+    tariffs = get_car_wash_tariffs(car_wash)
+    return {
+        "services": get_car_wash_services(car_wash),
+        "tariffs": tariffs,
+        "prices": get_service_price_rows([t["name"] for t in tariffs]),
+        "tariff_filters": get_tariff_filter_rows([t["name"] for t in tariffs if t.get("is_active")]),
+    }
+
+
+def _compile(car_wash: str, version: str, payload: Dict[str, Any]) -> PriceCatalog:
+    services = {r["name"]: frappe._dict(r) for r in payload["services"]}
+    active_service_ids = frozenset(
+        name for name, r in services.items() if not r.get("is_disabled") and not r.get("is_deleted")
+    )
+
+    tariffs = {r["name"]: frappe._dict(r) for r in payload["tariffs"]}
+    # payload rows are already ordered by priority desc, modified desc
+    active_tariffs = tuple(r["name"] for r in payload["tariffs"] if r.get("is_active"))
+
+    prices: Dict[str, Dict[str, Any]] = {}
+    for r in payload["prices"]:
+        prices.setdefault(r["tariff"], {})[r["base_service"]] = MappingProxyType({
+            "price": r.get("price"),
+            "staff_reward": (r.get("staff_reward") or 0.0),
+            # duration из прайс-строки (если задана) переопределяет duration сервиса
+            "duration": r.get("duration"),
+        })
+
+    return PriceCatalog(
+        car_wash=car_wash,
+        version=version,
+        services=MappingProxyType(services),
+        active_service_ids=active_service_ids,
+        tariffs=MappingProxyType(tariffs),
+        active_tariffs=active_tariffs,
+        prices=MappingProxyType({t: MappingProxyType(p) for t, p in prices.items()}),
+        tariff_matcher=compile_tariff_matcher(active_tariffs, payload.get("tariff_filters") or ()),
+    )
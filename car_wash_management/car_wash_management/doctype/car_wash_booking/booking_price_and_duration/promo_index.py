@@ -0,0 +1,125 @@
+# car_wash/promo_index.py
+"""
+Hot index of active promo codes per car wash.
+
+Active codes of a car wash (with their applicable services) are loaded with two
+queries into immutable PromoCodeEntry objects keyed by code, so a quote looks a
+code up without get_doc. The index is versioned: `Car wash promo code`
+on_update/on_trash bump the version of its car wash.
+
+used_count is deliberately not part of the index — it changes on every
+redemption and is read live (see promocode.get_used_count / reserve_promocode).
+
+Lookup order: worker memory (same version) → Redis payload for the version → database.
+"""
+
+from dataclasses import dataclass
+from datetime import date
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import frappe
+from frappe.utils import flt, getdate
+
+from .versioning import get_version, bump_version_now_and_after_commit
+
+VERSION_NAMESPACE = "promo_code_index"
+PAYLOAD_TTL_SEC = 24 * 3600
+
+# (site, car_wash) -> (version, {code: PromoCodeEntry})
+_indexes: Dict[Tuple[str, str], Tuple[str, Mapping[str, "PromoCodeEntry"]]] = {}
+
+
+@dataclass(frozen=True)
+class PromoCodeEntry:
+    name: str
+    code: str
+    title: Optional[str]
+    car_wash: str
+    promo_type: Optional[str]
+    discount_type: Optional[str]
+    discount_value: float
+    minimum_order_amount: float
+    waive_queue_commission: int
+    valid_from: Optional[date]
+    valid_to: Optional[date]
+    usage_limit: int
+    applicable_services: frozenset
+
+
+def _load_payload(car_wash: str) -> Dict[str, Any]:
+    codes = frappe.get_all(
+        "Car wash promo code",
+        filters={"car_wash": car_wash, "is_active": 1, "is_deleted": 0},
+        fields=[
+            "name", "code", "title", "car_wash", "promo_type", "discount_type", "discount_value",
+            "minimum_order_amount", "waive_queue_commission", "valid_from", "valid_to", "usage_limit",
+        ],
+        limit_page_length=0,
+    )
+    services = frappe.get_all(
+        "Car wash promo code service",
+        filters={"parenttype": "Car wash promo code", "parent": ["in", [c.name for c in codes]]},
+        fields=["parent", "service"],
+        limit_page_length=0,
+    ) if codes else []
+    return {"codes": codes, "services": services}
+
+
+def _compile(payload: Dict[str, Any]) -> Mapping[str, PromoCodeEntry]:
+    services_by_code: Dict[str, set] = {}
+    for row in payload["services"]:
+        services_by_code.setdefault(row["parent"], set()).add(row["service"])
+
+    index: Dict[str, PromoCodeEntry] = {}
+    for row in payload["codes"]:
+        if not row.get("code") or row["code"] in index:
+            # Как и get_doc по фильтрам, при дублях кода берём первую строку
+            continue
+        index[row["code"]] = PromoCodeEntry(
+            name=row["name"],
+            code=row["code"],
+            title=row.get("title"),
+            car_wash=row["car_wash"],
+            promo_type=row.get("promo_type"),
+            discount_type=row.get("discount_type"),
+            discount_value=flt(row.get("discount_value")),
+            minimum_order_amount=flt(row.get("minimum_order_amount")),
+            waive_queue_commission=row.get("waive_queue_commission") or 0,
+            valid_from=getdate(row["valid_from"]) if row.get("valid_from") else None,
+            valid_to=getdate(row["valid_to"]) if row.get("valid_to") else None,
+            usage_limit=int(row.get("usage_limit") or 0),
+            applicable_services=frozenset(services_by_code.get(row["name"], ())),
+        )
+    return MappingProxyType(index)
+
+
+def get_promo_code_index(car_wash: str) -> Mapping[str, PromoCodeEntry]:
+    """Active promo codes of a car wash by code; one Redis read when warm."""
+    version = get_version(VERSION_NAMESPACE, car_wash)
+    local_key = (getattr(frappe.local, "site", None) or "", car_wash)
+    cached = _indexes.get(local_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    payload_key = f"promo_code_index:{car_wash}:{version}"
+    payload = frappe.cache().get_value(payload_key)
+    if payload is None:
+        payload = _load_payload(car_wash)
+        frappe.cache().set_value(payload_key, payload, expires_in_sec=PAYLOAD_TTL_SEC)
+
+    index = _compile(payload)
+    _indexes[local_key] = (version, index)
+    return index
+
+
+def get_promo_code(code: str, car_wash: str) -> Optional[PromoCodeEntry]:
+    if not code or not car_wash:
+        return None
+    return get_promo_code_index(car_wash).get(code)
+
+
+def bump_promo_code_index_version(car_wash: Optional[str]) -> None:
+    """Invalidate the promo code index of a car wash (call on any promo code change)."""
+    if car_wash:
+        bump_version_now_and_after_commit(VERSION_NAMESPACE, car_wash)
@@ -2,9 +2,12 @@
 
 import frappe
 from frappe import _
+from frappe.utils import now_datetime
 from typing import Dict, Any, Optional
 from datetime import datetime
 
+from .promo_index import PromoCodeEntry, get_promo_code
+
 
 def validate_and_apply_promocode(
     promocode: str,
@@ -14,7 +17,8 @@ def validate_and_apply_promocode(
     commission_amount: float,
     is_time_booking: bool = False,
     services: list = None,
-    created_by_admin: bool = False
+    created_by_admin: bool = False,
+    has_promo_feature: Optional[bool] = None
 ) -> Dict[str, Any]:
     """
     Validate promocode and calculate discounts.
@@ -28,6 +32,7 @@ def validate_and_apply_promocode(
         is_time_booking: True if booking for specific time, False for queue
         services: List of services for validation
         created_by_admin: True if booking created by car wash admin
+        has_promo_feature: already known feature flag (e.g. from QuoteContext); None — check `Car wash`
     
     Returns:
     {
@@ -46,9 +51,10 @@ def validate_and_apply_promocode(
         return _create_no_promo_response(services_total, commission_amount)
 
     # Проверяем наличие фичи promo у мойки
-    car_wash_doc = frappe.get_doc("Car wash", car_wash)
-    has_promo_feature = car_wash_doc.has_journal_feature("promo")
-    
+    if has_promo_feature is None:
+        car_wash_doc = frappe.get_doc("Car wash", car_wash)
+        has_promo_feature = car_wash_doc.has_journal_feature("promo")
+
     if not has_promo_feature:
         return {
             'valid': False,
@@ -60,8 +66,8 @@ def validate_and_apply_promocode(
             'final_commission': commission_amount,
         }
 
-    # Получаем данные промокода
-    promo_doc = _get_promocode_doc(promocode, car_wash)
+    # Получаем данные промокода из индекса активных кодов мойки
+    promo_doc = get_promo_code(promocode, car_wash)
     if not promo_doc:
         return {
             'valid': False,
@@ -107,20 +113,12 @@ def _create_no_promo_response(services_total: float, commission_amount: float) -
     }
 
 
-def _get_promocode_doc(promocode: str, car_wash: str) -> Optional[Any]:
-    """Get promocode document if valid."""
-    try:
-        promo_doc = frappe.get_doc("Car wash promo code", {
-            'code': promocode,
-            'car_wash': car_wash,
-            'is_active': 1
-        })
-        return promo_doc
-    except frappe.DoesNotExistError:
-        return None
+def get_used_count(promo_code_name: str) -> int:
+    """Live redemption counter (not cached: it changes on every redemption)."""
+    return int(frappe.db.get_value("Car wash promo code", promo_code_name, "used_count") or 0)
 
 
-def _validate_promocode(promo_doc: Any, user: str, services_total: float) -> Dict[str, Any]:
+def _validate_promocode(promo_doc: PromoCodeEntry, user: str, services_total: float) -> Dict[str, Any]:
     """Validate promocode conditions."""
     today = datetime.now().date()
 
@@ -138,7 +136,7 @@ def _validate_promocode(promo_doc: Any, user: str, services_total: float) -> Dic
         }
 
     # Проверка лимита использований
-    if promo_doc.usage_limit and promo_doc.used_count >= promo_doc.usage_limit:
+    if promo_doc.usage_limit and get_used_count(promo_doc.name) >= promo_doc.usage_limit:
         return {
             'valid': False,
             'message': _('Промокод исчерпал лимит использований')
@@ -156,7 +154,7 @@ def _validate_promocode(promo_doc: Any, user: str, services_total: float) -> Dic
 
 
 def _apply_promocode_discount(
-    promo_doc: Any,
+    promo_doc: PromoCodeEntry,
     services_total: float,
     commission_amount: float,
     is_time_booking: bool,
@@ -202,24 +200,24 @@ def _apply_promocode_discount(
         'promo_data': {
             'code': promo_doc.code,
             'title': promo_doc.title,
-            'discount_type': getattr(promo_doc, 'discount_type', None),
-            'discount_value': getattr(promo_doc, 'discount_value', None)
+            'discount_type': promo_doc.discount_type,
+            'discount_value': promo_doc.discount_value
         }
     }
 
 
 def _calculate_service_discount(
-    promo_doc: Any,
+    promo_doc: PromoCodeEntry,
     services_total: float,
     services: list = None
 ) -> float:
     """Calculate service discount amount."""
-    if not hasattr(promo_doc, 'discount_type') or not hasattr(promo_doc, 'discount_value'):
+    if not promo_doc.discount_type:
         return 0.0
 
     # Если указаны применимые услуги, проверяем их
     if promo_doc.applicable_services and services:
-        applicable_service_ids = [row.service for row in promo_doc.applicable_services]
+        applicable_service_ids = promo_doc.applicable_services
 
         # Рассчитываем сумму только по применимым услугам
         applicable_total = 0.0
@@ -245,22 +243,76 @@ def _calculate_service_discount(
     return max(0, discount)
 
 
-def record_promocode_usage(
-    promo_code: str,
+# ---- Redemption: reserve → confirm / release ----
+# Счётчик used_count меняется только здесь и только под блокировкой строки промокода
+# (SELECT ... FOR UPDATE), поэтому параллельные погашения не превышают usage_limit.
+# Ничего не коммитится: резерв живёт в транзакции запроса и откатывается вместе с ней.
+
+def try_reserve_promo_code_use(promo_code_name: str) -> bool:
+    """Atomically take one use of a promo code if it is active and under its limit."""
+    row = frappe.db.sql(
+        """
+        SELECT used_count, usage_limit, is_active, is_deleted
+        FROM `tabCar wash promo code`
+        WHERE name = %s
+        FOR UPDATE
+        """,
+        (promo_code_name,),
+        as_dict=1,
+    )
+    if not row or not row[0].is_active or row[0].is_deleted:
+        return False
+    if row[0].usage_limit and int(row[0].used_count or 0) >= int(row[0].usage_limit):
+        return False
+
+    frappe.db.sql(
+        """
+        UPDATE `tabCar wash promo code`
+        SET used_count = IFNULL(used_count, 0) + 1
+        WHERE name = %s
+        """,
+        (promo_code_name,),
+    )
+    return True
+
+
+def release_promo_code_use(promo_code_name: str) -> None:
+    """Give one use back (never below zero)."""
+    frappe.db.sql(
+        """
+        UPDATE `tabCar wash promo code`
+        SET used_count = used_count - 1
+        WHERE name = %s AND used_count > 0
+        """,
+        (promo_code_name,),
+    )
+
+
+def reserve_promocode(
+    promocode: str,
+    car_wash: str,
     mobile_booking_attempt: str,
     user: str,
     promo_result: Dict[str, Any]
-) -> None:
-    """Record promocode usage for analytics."""
+) -> Optional[str]:
+    """
+    Reserve one use of the promocode for a booking attempt and write a `Reserved` usage row.
+    Returns the usage name, or None when the code is unknown, inactive or exhausted.
+    """
     if not promo_result.get('valid') or not promo_result.get('promo_data'):
-        return
+        return None
+
+    promo = get_promo_code(promocode, car_wash)
+    if not promo or not try_reserve_promo_code_use(promo.name):
+        return None
 
-    # Создаем запись об использовании промокода
     usage_doc = frappe.get_doc({
         'doctype': 'Car wash promo code usage',
-        'promo_code': promo_code,
+        'promo_code': promo.name,
         'mobile_booking_attempt': mobile_booking_attempt,
         'user': user,
+        'status': 'Reserved',
+        'usage_date': now_datetime(),
         'promo_type': promo_result['promo_type'],
         'service_discount_amount': promo_result['service_discount'],
         'commission_waived_amount': promo_result['commission_waived'],
@@ -271,11 +323,39 @@ def record_promocode_usage(
         'final_commission': promo_result['final_commission']
     })
     usage_doc.insert(ignore_permissions=True)
+    return usage_doc.name
 
-    # Увеличиваем счётчик использований промокода
-    frappe.db.sql("""
-        UPDATE `tabCar wash promo code`
-        SET used_count = used_count + 1
-        WHERE code = %s
-    """, [promo_code])
-    frappe.db.commit()
+
+def confirm_promocode_usage(usage_name: str) -> None:
+    """Mark a reserved use as redeemed (the counter was already taken on reserve)."""
+    frappe.db.set_value("Car wash promo code usage", usage_name, "status", "Confirmed", update_modified=False)
+
+
+def release_promocode_usage(usage_name: str) -> bool:
+    """Return a reserved or confirmed use to the code. Idempotent: False if already released."""
+    row = frappe.db.sql(
+        """
+        SELECT promo_code, status
+        FROM `tabCar wash promo code usage`
+        WHERE name = %s
+        FOR UPDATE
+        """,
+        (usage_name,),
+        as_dict=1,
+    )
+    if not row or row[0].status == "Released":
+        return False
+
+    frappe.db.set_value("Car wash promo code usage", usage_name, "status", "Released", update_modified=False)
+    release_promo_code_use(row[0].promo_code)
+    return True
+
+
+def release_promocode_usages_for_attempt(mobile_booking_attempt: str) -> int:
+    """Release every active promocode use of a booking attempt (on delete/cancel)."""
+    names = frappe.get_all(
+        "Car wash promo code usage",
+        filters={"mobile_booking_attempt": mobile_booking_attempt, "status": ["!=", "Released"]},
+        pluck="name",
+    )
+    return sum(1 for name in names if release_promocode_usage(name))
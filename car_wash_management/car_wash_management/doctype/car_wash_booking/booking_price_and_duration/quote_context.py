@@ -0,0 +1,191 @@
+# car_wash/quote_context.py
+"""
+Per-car-wash state shared between quotes computed in one request.
+
+A single quote and a batch of carts go through the same QuoteContext, so the
+`Car wash` feature check, the price catalog (services, tariffs, tariff prices),
+active auto discounts and customer statistics are loaded once per car wash
+instead of once per cart. Cars (customer and the attributes tariff filters
+look at) are fetched in bulk, so auto-picking a tariff costs no queries.
+"""
+
+import frappe
+from frappe import _
+from typing import Any, Dict, Iterable, List, Optional, Mapping, Tuple
+
+from .tariffs import ensure_tariff_valid_for_car_wash, resolve_applicable_tariff
+from .cache_helpers import _normalize_tariff_key
+from .calculation import calculate_totals
+from .tariff_matcher import CAR_PROFILE_FIELDS, EMPTY_PROFILE, CarProfile
+from .price_catalog import PriceCatalog, get_price_catalog, VERSION_NAMESPACE as CATALOG_NAMESPACE
+from .versioning import get_version
+from .auto_discount_rules import CompiledAutoDiscount, get_compiled_auto_discounts, get_discount_set_version
+from .auto_discounts import (
+    _get_applicable_auto_discounts,
+    _get_customer_stats_cached,
+)
+
+CUSTOMER_STATS_NAMESPACE = "customer_stats"
+
+
+class QuoteContext:
+    """Memoizes per-car-wash lookups for the quotes of one request."""
+
+    def __init__(self, car_wash: str):
+        self.car_wash = car_wash
+        self._has_promo_feature: Optional[bool] = None
+        self._tariffs: Dict[str, str] = {}
+        self._auto_tariffs: Dict[CarProfile, str] = {}
+        self._customers_by_car: Dict[str, Optional[str]] = {}
+        self._profiles_by_car: Dict[str, CarProfile] = {}
+        self._catalog: Optional[PriceCatalog] = None
+        self._base_totals: Dict[Any, tuple] = {}
+        self._auto_discounts: Optional[Tuple[CompiledAutoDiscount, ...]] = None
+        self._auto_discounts_version: Optional[str] = None
+        self._customer_stats: Dict[tuple, Dict[str, Any]] = {}
+
+    # ---- car wash ----
+    @property
+    def has_promo_feature(self) -> bool:
+        if self._has_promo_feature is None:
+            car_wash_doc = frappe.get_doc("Car wash", self.car_wash)
+            self._has_promo_feature = bool(car_wash_doc.has_journal_feature("promo"))
+        return self._has_promo_feature
+
+    @property
+    def catalog(self) -> PriceCatalog:
+        if self._catalog is None:
+            self._catalog = get_price_catalog(self.car_wash)
+        return self._catalog
+
+    @property
+    def auto_discounts(self) -> Tuple[CompiledAutoDiscount, ...]:
+        if self._auto_discounts is None:
+            self._auto_discounts_version = get_discount_set_version(self.car_wash)
+            self._auto_discounts = get_compiled_auto_discounts(self.car_wash)
+        return self._auto_discounts
+
+    def is_stale(self) -> bool:
+        """True when the catalog or discount set this context loaded has been invalidated since."""
+        if self._catalog is not None and self._catalog.version != get_version(CATALOG_NAMESPACE, self.car_wash):
+            return True
+        return self._auto_discounts is not None and self._auto_discounts_version != get_discount_set_version(self.car_wash)
+
+    # ---- tariffs ----
+    def resolve_tariff(self, tariff: Any, car: Optional[str] = None, services: Optional[list] = None) -> str:
+        """Validate an explicit tariff or auto-pick one by the car; each distinct tariff/car profile is resolved once."""
+        if tariff:
+            key = _normalize_tariff_key(tariff)
+            if key not in self._tariffs:
+                self._tariffs[key] = ensure_tariff_valid_for_car_wash(key, self.car_wash, catalog=self.catalog)
+            return self._tariffs[key]
+
+        # Без фильтров у тарифов машина не влияет на выбор — не читаем её
+        profile = self.car_profile(car) if car and self.catalog.tariff_matcher.has_filters else EMPTY_PROFILE
+        if profile not in self._auto_tariffs:
+            self._auto_tariffs[profile] = resolve_applicable_tariff(
+                car_wash=self.car_wash, car=car, services=services, catalog=self.catalog, car_profile=profile
+            )
+        return self._auto_tariffs[profile]
+
+    # ---- cars & customers ----
+    def prefetch_cars(self, cars: Iterable[str]) -> None:
+        """Load the customer and tariff filter attributes of many cars with one query."""
+        missing = sorted({c for c in cars if c and c not in self._profiles_by_car})
+        if not missing:
+            return
+        rows = frappe.get_all(
+            "Car wash car",
+            filters={"name": ["in", missing]},
+            fields=["name", "customer", *CAR_PROFILE_FIELDS],
+        )
+        found = {r.name: r for r in rows}
+        for car in missing:
+            row = found.get(car)
+            self._customers_by_car.setdefault(car, row.customer if row else None)
+            self._profiles_by_car[car] = CarProfile.from_row(row)
+
+    def car_profile(self, car: str) -> CarProfile:
+        if car not in self._profiles_by_car:
+            self.prefetch_cars([car])
+        return self._profiles_by_car[car]
+
+    def resolve_customer(self, car: str, user: Optional[str] = None) -> Optional[str]:
+        """Explicit user wins; otherwise the customer linked to the car (None if unknown)."""
+        if user:
+            return user
+        if car not in self._customers_by_car:
+            self.prefetch_cars([car])
+        return self._customers_by_car.get(car)
+
+    # ---- services & prices ----
+    def validate_service_ids(self, service_ids: Iterable[str]) -> None:
+        missing = set(service_ids) - self.catalog.active_service_ids
+        if missing:
+            frappe.throw(_("Invalid/inactive services: {0}").format(", ".join(missing)))
+
+    def service_docs(self) -> Mapping[str, Any]:
+        return self.catalog.services
+
+    def service_prices(self, tariff_id: str) -> Mapping[str, Any]:
+        return self.catalog.tariff_prices(tariff_id)
+
+    def base_totals(
+        self,
+        service_counter,
+        tariff_id: str,
+        custom_price_map: Dict[str, float],
+        service_docs: Optional[Mapping[str, Any]] = None,
+        service_prices: Optional[Mapping[str, Any]] = None,
+    ) -> tuple:
+        """calculate_totals memoized per (tariff, services multiset, custom prices)."""
+        key = (
+            tariff_id,
+            tuple(sorted(service_counter.items())),
+            tuple(sorted((k, float(v)) for k, v in custom_price_map.items())),
+        )
+        if key not in self._base_totals:
+            self._base_totals[key] = calculate_totals(
+                service_counter,
+                service_docs if service_docs is not None else self.service_docs(),
+                service_prices if service_prices is not None else self.service_prices(tariff_id),
+                tariff_id,
+                custom_price_map,
+            )
+        return self._base_totals[key]
+
+    def preload(
+        self,
+        has_promo_feature: Optional[bool] = None,
+        customer: Optional[str] = None,
+        customer_stats: Optional[Dict[str, Any]] = None,
+        stats_version: Optional[str] = None,
+    ) -> None:
+        """Seed lookups a caller kept between requests (see quote_session)."""
+        if has_promo_feature is not None:
+            self._has_promo_feature = bool(has_promo_feature)
+        if customer and customer_stats is not None and stats_version:
+            self._customer_stats[(customer, stats_version)] = customer_stats
+
+    # ---- auto discounts ----
+    def customer_stats(self, customer: str) -> Dict[str, Any]:
+        # keyed by stats version: an appointment saved later in the same request makes them stale
+        key = (customer, get_version(CUSTOMER_STATS_NAMESPACE, customer))
+        if key not in self._customer_stats:
+            self._customer_stats[key] = _get_customer_stats_cached(customer, self.car_wash)
+        return self._customer_stats[key]
+
+    def applicable_auto_discounts(self, customer: str, services: list, services_total: float) -> List[Dict[str, Any]]:
+        """Evaluate compiled auto discounts against stats loaded once per context."""
+        if not self.has_promo_feature:
+            return []
+        if not self.auto_discounts:
+            return []
+        return _get_applicable_auto_discounts(
+            car_wash=self.car_wash,
+            customer=customer,
+            services=services,
+            services_total=services_total,
+            compiled_discounts=self.auto_discounts,
+            customer_stats=self.customer_stats(customer),
+        )
@@ -0,0 +1,107 @@
+# car_wash/quote_memo.py
+"""
+Request-scoped memoization of quotes.
+
+One document save calls get_booking_price_and_duration from several hooks
+(validate, after_insert) and through workflow_helpers. A quote is identified
+by a fingerprint of everything it depends on: car wash, car, resolved client,
+tariff, the multiset of services (with custom prices), promocode, flags,
+disabled discounts and the versions of the price catalog, auto discount
+set, promo code index and client stats.
+Equal fingerprints within one request reuse the first result.
+
+The QuoteContext of a car wash is kept for the whole request as well, so
+hooks share the `Car wash` feature check, catalog and compiled auto discounts.
+"""
+
+import copy
+import hashlib
+import json
+from typing import Any, Callable, Dict, Optional
+
+import frappe
+
+from .auto_discount_rules import get_discount_set_version
+from .promo_index import VERSION_NAMESPACE as PROMO_CODE_NAMESPACE
+from .quote_context import QuoteContext, CUSTOMER_STATS_NAMESPACE
+from .validation import build_service_counter
+from .versioning import get_version, bump_version_now_and_after_commit
+
+MAX_MEMO_ENTRIES = 256
+
+
+def _request_state() -> Dict[str, Any]:
+    state = getattr(frappe.local, "booking_quote_memo", None)
+    if state is None:
+        state = {"contexts": {}, "quotes": {}}
+        frappe.local.booking_quote_memo = state
+    return state
+
+
+def get_request_quote_context(car_wash: str) -> QuoteContext:
+    """QuoteContext shared by all quotes of this car wash in the current request."""
+    contexts = _request_state()["contexts"]
+    context = contexts.get(car_wash)
+    if context is None or context.is_stale():
+        context = QuoteContext(car_wash)
+        contexts[car_wash] = context
+    return context
+
+
+def get_customer_stats_version(customer: Optional[str]) -> str:
+    return get_version(CUSTOMER_STATS_NAMESPACE, customer) if customer else ""
+
+
+def bump_customer_stats_version(customer: Optional[str]) -> None:
+    """Call when appointments of a client change: their statistics (and quotes) are stale."""
+    if customer:
+        bump_version_now_and_after_commit(CUSTOMER_STATS_NAMESPACE, customer)
+
+
+def _services_multiset(services: list) -> list:
+    custom_prices = {}
+    for svc in services or []:
+        if isinstance(svc, dict):
+            svc_id, custom = svc.get("service"), svc.get("custom_price")
+        else:
+            svc_id, custom = getattr(svc, "service", None), getattr(svc, "custom_price", None)
+        if custom:
+            custom_prices[svc_id] = custom
+    counter = build_service_counter(services)
+    return sorted((svc_id, qty, custom_prices.get(svc_id)) for svc_id, qty in counter.items())
+
+
+def quote_fingerprint(context: QuoteContext, car: str, services: list, customer: Optional[str], **params) -> str:
+    """Stable hash of all quote inputs plus catalog, promo code and client stats versions."""
+    disabled = params.pop("disabled_auto_discounts", None) or []
+    payload = {
+        "car_wash": context.car_wash,
+        "car": car,
+        "customer": customer,
+        "services": _services_multiset(services),
+        "disabled_auto_discounts": sorted(disabled),
+        "catalog_version": context.catalog.version,
+        "auto_discounts_version": get_discount_set_version(context.car_wash),
+        "promo_codes_version": get_version(PROMO_CODE_NAMESPACE, context.car_wash),
+        "customer_stats_version": get_customer_stats_version(customer),
+        **{k: (getattr(v, "name", v) if k == "tariff" else v) for k, v in params.items()},
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def memoize_quote(fingerprint: str, compute: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Return the quote remembered for this fingerprint or compute it; only successes are kept."""
+    if frappe.flags.get("skip_quote_memo"):
+        return compute()
+
+    quotes = _request_state()["quotes"]
+    if fingerprint not in quotes:
+        result = compute()
+        if result.get("status") != "success":
+            return result
+        if len(quotes) >= MAX_MEMO_ENTRIES:
+            quotes.clear()
+        quotes[fingerprint] = result
+    # callers may modify the response; never hand out the remembered object itself
+    return copy.deepcopy(quotes[fingerprint])
@@ -0,0 +1,269 @@
+# car_wash/quote_session.py
+"""
+Incremental quote sessions for a cart being built at the cashier.
+
+open_quote_session resolves once everything that does not depend on the cart
+contents: customer of the car, tariff, the `promo` feature of the car wash and
+customer statistics. The session is kept in Redis for SESSION_TTL_SEC (every
+update extends it). update_quote_session applies deltas (add/remove service,
+promocode, enable/disable an auto discount, tariff) and re-runs only
+calculate_totals, discount selection and the promocode on top of the kept state.
+
+Kept state is tagged with the versions it came from: an auto-picked tariff is
+re-picked when the price catalog changes, customer stats are reloaded when the
+stats version changes. Compiled auto discounts are shared per version anyway
+(see auto_discount_rules).
+
+Every delta is timed and pushed to the trace samples as "session_delta"
+(opening as "session_open"); compare=1 also runs a full recompute and records
+it as "session_full_recompute" (see tracing.get_quote_stage_percentiles).
+"""
+
+import copy
+import time
+from typing import Any, Dict, Optional
+
+import frappe
+from frappe import _
+
+from .booking import _quote_cart
+from .quote_context import QuoteContext
+from .quote_memo import get_customer_stats_version, get_request_quote_context
+from .tracing import record_stage_samples
+
+SESSION_TTL_SEC = 15 * 60
+KEY_PREFIX = "booking_quote_session"
+
+
+def _key(session_id: str) -> str:
+    return f"{KEY_PREFIX}:{session_id}"
+
+
+def _load_session(session_id: str) -> Dict[str, Any]:
+    state = frappe.cache().get_value(_key(session_id)) if session_id else None
+    # Сессия принадлежит пользователю, который её открыл
+    if not state or state.get("owner") != frappe.session.user:
+        frappe.throw(_("Quote session not found or expired."), frappe.DoesNotExistError)
+    return state
+
+
+def _save_session(state: Dict[str, Any]) -> None:
+    frappe.cache().set_value(_key(state["session_id"]), state, expires_in_sec=SESSION_TTL_SEC)
+
+
+def _needs_customer_stats(state: Dict[str, Any]) -> bool:
+    return bool(state["customer"] and state["has_promo_feature"] and state["flags"]["apply_auto_discounts"])
+
+
+def _session_context(state: Dict[str, Any]) -> QuoteContext:
+    """Request QuoteContext seeded with the session state; refreshes parts whose version changed."""
+    context = get_request_quote_context(state["car_wash"])
+    context.preload(has_promo_feature=state["has_promo_feature"])
+
+    if state["catalog_version"] != context.catalog.version:
+        # Авто-тариф подбирается заново, явный — проверяется по новому каталогу
+        state["tariff"] = context.resolve_tariff(None if state["tariff_auto"] else state["tariff"], state["car"])
+        state["catalog_version"] = context.catalog.version
+
+    if _needs_customer_stats(state):
+        customer = state["customer"]
+        version = get_customer_stats_version(customer)
+        if state["stats_version"] == version:
+            context.preload(customer=customer, customer_stats=state["customer_stats"], stats_version=version)
+        else:
+            state["customer_stats"] = context.customer_stats(customer)
+            state["stats_version"] = version
+    return context
+
+
+def _quote(context: QuoteContext, state: Dict[str, Any], tariff: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not state["services"]:
+        return None
+    return _quote_cart(
+        context,
+        car=state["car"],
+        services=state["services"],
+        tariff=tariff,
+        promocode=state["promocode"],
+        user=state["customer"],
+        disabled_auto_discounts=state["disabled_auto_discounts"],
+        **state["flags"],
+    )
+
+
+def _full_recompute(state: Dict[str, Any]) -> Dict[str, Any]:
+    """The same cart priced from scratch, as a plain get_booking_price_and_duration would do."""
+    started = time.perf_counter()
+    context = QuoteContext(state["car_wash"])
+    customer = context.resolve_customer(state["car"], state["user"])
+    _quote_cart(
+        context,
+        car=state["car"],
+        services=state["services"],
+        tariff=None if state["tariff_auto"] else state["tariff"],
+        promocode=state["promocode"],
+        user=customer,
+        disabled_auto_discounts=state["disabled_auto_discounts"],
+        **state["flags"],
+    )
+    return {"full_ms": round((time.perf_counter() - started) * 1000.0, 3)}
+
+
+def _response(state: Dict[str, Any], quote: Optional[Dict[str, Any]], timing: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "status": "success",
+        "session_id": state["session_id"],
+        "services": state["services"],
+        "tariff": state["tariff"],
+        "promocode": state["promocode"],
+        "disabled_auto_discounts": state["disabled_auto_discounts"],
+        "quote": quote,
+        "timing": timing,
+    }
+
+
+def _apply_op(state: Dict[str, Any], op: Dict[str, Any]) -> None:
+    kind = op.get("op")
+    if kind == "add_service":
+        if not op.get("service"):
+            frappe.throw(_("'add_service' requires 'service'."))
+        entry = {"service": op["service"]}
+        if op.get("custom_price"):
+            entry["custom_price"] = op["custom_price"]
+        state["services"].extend(dict(entry) for _unit in range(int(op.get("qty") or 1)))
+    elif kind == "remove_service":
+        # Убираем последние добавленные вхождения услуги
+        left = int(op.get("qty") or 1)
+        for idx in range(len(state["services"]) - 1, -1, -1):
+            if left and state["services"][idx].get("service") == op.get("service"):
+                del state["services"][idx]
+                left -= 1
+    elif kind == "set_services":
+        services = op.get("services") or []
+        state["services"] = [s if isinstance(s, dict) else {"service": s} for s in services]
+    elif kind == "set_promocode":
+        state["promocode"] = op.get("promocode") or None
+    elif kind == "toggle_discount":
+        disabled = [d for d in state["disabled_auto_discounts"] if d != op.get("discount_id")]
+        if not op.get("enabled") and op.get("discount_id"):
+            disabled.append(op["discount_id"])
+        state["disabled_auto_discounts"] = disabled
+    elif kind == "set_tariff":
+        state["tariff_auto"] = not op.get("tariff")
+        state["tariff"] = op.get("tariff") or None
+        state["catalog_version"] = None  # тариф будет проверен или подобран заново в _session_context
+    else:
+        frappe.throw(_("Unknown quote session operation: {0}").format(kind))
+
+
+def _run(state: Dict[str, Any], stage: str, compare: bool) -> Dict[str, Any]:
+    started = time.perf_counter()
+    context = _session_context(state)
+    quote = _quote(context, state, state["tariff"])
+    elapsed_ms = (time.perf_counter() - started) * 1000.0
+
+    timing = {"ms": round(elapsed_ms, 3)}
+    samples = {stage: (elapsed_ms, 0)}
+    if compare and state["services"]:
+        timing.update(_full_recompute(state))
+        samples["session_full_recompute"] = (timing["full_ms"], 0)
+    record_stage_samples(samples)
+
+    _save_session(state)
+    return _response(state, quote, timing)
+
+
+@frappe.whitelist()
+def open_quote_session(
+    car_wash: str,
+    car: str,
+    tariff: Any = None,
+    user: str = None,
+    services: list = None,
+    promocode: str = None,
+    disabled_auto_discounts: list = None,
+    is_time_booking: bool = False,
+    commission_amount: float = 100.0,
+    created_by_admin: bool = True,
+    apply_auto_discounts: bool = True,
+) -> Dict[str, Any]:
+    """
+    Open a quote session for (car wash, car, tariff, client) and price the initial cart.
+    Returns {"status", "session_id", "services", "tariff", "promocode", "disabled_auto_discounts", "quote", "timing"};
+    "quote" has the format of get_booking_price_and_duration (None while the cart is empty).
+    """
+    try:
+        if not car_wash or not car:
+            frappe.throw(_("Provide 'car_wash' and 'car'."))
+        services = frappe.parse_json(services) if isinstance(services, str) else (services or [])
+        disabled = frappe.parse_json(disabled_auto_discounts) if isinstance(disabled_auto_discounts, str) else disabled_auto_discounts
+
+        context = get_request_quote_context(car_wash)
+        state = {
+            "session_id": frappe.generate_hash(length=20),
+            "owner": frappe.session.user,
+            "car_wash": car_wash,
+            "car": car,
+            "user": user,
+            "customer": context.resolve_customer(car, user),
+            "tariff": getattr(tariff, "name", tariff) or None,
+            "tariff_auto": not tariff,
+            "catalog_version": None,  # тариф подбирается/проверяется в _session_context
+            "has_promo_feature": context.has_promo_feature,
+            "customer_stats": None,
+            "stats_version": None,
+            "services": [s if isinstance(s, dict) else {"service": s} for s in services],
+            "promocode": promocode or None,
+            "disabled_auto_discounts": list(disabled or []),
+            "flags": {
+                "is_time_booking": is_time_booking,
+                "commission_amount": commission_amount,
+                "created_by_admin": created_by_admin,
+                "apply_auto_discounts": apply_auto_discounts,
+            },
+        }
+        return _run(state, "session_open", compare=False)
+
+    except frappe.ValidationError as ve:
+        return {"status": "error", "message": ve.message}
+
+    except Exception as e:
+        frappe.log_error(str(e), "Quote Session Error")
+        return {"status": "error", "message": str(e)}
+
+
+@frappe.whitelist()
+def update_quote_session(session_id: str, ops: list, compare: bool = False) -> Dict[str, Any]:
+    """
+    Apply deltas to a session cart and re-price it.
+
+    ops: [{"op": "add_service", "service", "qty"?, "custom_price"?}, {"op": "remove_service", "service", "qty"?},
+          {"op": "set_services", "services"}, {"op": "set_promocode", "promocode"},
+          {"op": "toggle_discount", "discount_id", "enabled"}, {"op": "set_tariff", "tariff"}]
+    A failed update (e.g. inactive service) leaves the session as it was.
+    compare=1 adds "full_ms": the same cart priced from scratch.
+    """
+    try:
+        ops = frappe.parse_json(ops) if isinstance(ops, str) else ops
+        if isinstance(ops, dict):
+            ops = [ops]
+        compare = frappe.parse_json(compare) if isinstance(compare, str) else compare
+
+        state = copy.deepcopy(_load_session(session_id))
+        for op in ops or []:
+            _apply_op(state, op)
+        return _run(state, "session_delta", compare=bool(compare))
+
+    except frappe.ValidationError as ve:
+        return {"status": "error", "message": ve.message}
+
+    except Exception as e:
+        frappe.log_error(str(e), "Quote Session Error")
+        return {"status": "error", "message": str(e)}
+
+
+@frappe.whitelist()
+def close_quote_session(session_id: str) -> Dict[str, Any]:
+    _load_session(session_id)
+    frappe.cache().delete_value(_key(session_id))
+    return {"status": "success"}
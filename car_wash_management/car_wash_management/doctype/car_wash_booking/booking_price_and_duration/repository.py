@@ -5,25 +5,12 @@ from frappe import _
 from typing import List, Dict, Any
 
 
-def get_valid_service_ids(service_ids: List[str]) -> List[str]:
-    if not service_ids:
-        return []
-
-    cache = frappe.cache()
-    key = f"valid_services:{','.join(sorted(service_ids))}"
-    valid = cache.get_value(key)
-
-    if valid is None:
-        valid = frappe.get_all(
-            "Car wash service",
-            filters={"name": ["in", service_ids], "is_disabled": False, "is_deleted": False},
-            pluck="name",
-        )
-        cache.set_value(key, valid, expires_in_sec=3600)
-    missing = set(service_ids) - set(valid)
-    if missing:
-        frappe.throw(_("Invalid/inactive services: {0}").format(", ".join(missing)))
-    return valid
+SERVICE_CATALOG_FIELDS = [
+    "name", "title", "price", "duration",
+    "price_modifier", "price_modifier_type", "price_modifier_value",
+    "apply_price_modifier_to_order_total", "is_price_modifier_active",
+    "is_disabled", "is_deleted",
+]
 
 
 def get_car_body_type_fresh(car_id: str) -> str:
@@ -36,81 +23,51 @@ def get_car_body_type_fresh(car_id: str) -> str:
     return doc.body_type
 
 
-def get_service_docs(service_ids: List[str]) -> Dict[str, Any]:
-    if not service_ids:
-        return {}
-    rows = frappe.get_all(
+def get_car_wash_services(car_wash: str) -> List[Dict[str, Any]]:
+    """All services of a car wash, including disabled ones (validation needs them)."""
+    return frappe.get_all(
         "Car wash service",
-        filters={"name": ["in", service_ids]},
-        fields=[
-            "name", "title", "price", "duration",
-            "price_modifier", "price_modifier_type", "price_modifier_value",
-            "apply_price_modifier_to_order_total", "is_price_modifier_active"
-        ],
+        filters={"car_wash": car_wash},
+        fields=SERVICE_CATALOG_FIELDS,
+        limit_page_length=0,
     )
-    return {r.name: r for r in rows}
-
-
-def get_service_prices(service_ids: List[str], body_type: str) -> Dict[str, float]:
-    if not service_ids:
-        return {}
-
-    cache = frappe.cache()
-    key = f"service_prices:{','.join(sorted(service_ids))}:{body_type}"
-    prices = cache.get_value(key)
 
-    if prices is None:
-        recs = frappe.get_all(
-            "Car wash service price",
-            filters={
-                "base_service": ["in", service_ids],
-                "body_type": body_type,
-                "is_disabled": False,
-                "is_deleted": False,
-            },
-            fields=["base_service", "price", "staff_reward"],
-        )
-        # map each service → { price: ..., staff_reward: ... }
-        prices = {
-            r.base_service: {
-                "price":        r.price,
-                # if r.staff_reward is None, use 0.0
-                "staff_reward": (r.staff_reward or 0.0),
-            }
-            for r in recs
-        }
-        cache.set_value(key, prices, expires_in_sec=3600)
 
-    return prices
+def get_car_wash_tariffs(car_wash: str) -> List[Dict[str, Any]]:
+    """All tariffs of a car wash ordered the way auto-selection picks them."""
+    return frappe.get_all(
+        "Car wash tariff",
+        filters={"car_wash": car_wash},
+        fields=["name", "car_wash", "is_active", "priority", "modified"],
+        order_by="priority desc, modified desc",
+        limit_page_length=0,
+    )
 
-def get_service_prices_by_tariff(service_ids: list[str], tariff_id: str) -> dict[str, dict]:
-    if not service_ids:
-        return {}
 
-    cache = frappe.cache()
-    key = f"service_prices:tariff:{tariff_id}:{','.join(sorted(service_ids))}"
-    prices = cache.get_value(key)
+def get_tariff_filter_rows(tariff_ids: List[str]) -> List[Dict[str, Any]]:
+    """`Car wash tariff filter` rows of the given tariffs."""
+    if not tariff_ids:
+        return []
+    return frappe.get_all(
+        "Car wash tariff filter",
+        filters={"parenttype": "Car wash tariff", "parent": ["in", tariff_ids]},
+        fields=["parent", "attribute", "operator", "value_from", "value_to", "value_exact"],
+        order_by="idx asc",
+        limit_page_length=0,
+    )
 
-    if prices is None:
-        recs = frappe.get_all(
-            "Car wash service price",
-            filters={
-                "base_service": ["in", service_ids],
-                "tariff": tariff_id,
-                "is_disabled": False,
-                "is_deleted": False,
-            },
-            fields=["base_service", "price", "staff_reward", "duration"],
-        )
-        prices = {
-            r.base_service: {
-                "price": r.price,
-                "staff_reward": (r.staff_reward or 0.0),
-                # duration из прайс-строки (если задана) переопределяет duration сервиса
-                "duration": r.duration if "duration" in r and r.duration is not None else None,
-            }
-            for r in recs
-        }
-        cache.set_value(key, prices, expires_in_sec=3600)
 
-    return prices
+def get_service_price_rows(tariff_ids: List[str]) -> List[Dict[str, Any]]:
+    """Active `Car wash service price` rows of the given tariffs."""
+    if not tariff_ids:
+        return []
+    return frappe.get_all(
+        "Car wash service price",
+        filters={
+            "tariff": ["in", tariff_ids],
+            "is_disabled": False,
+            "is_deleted": False,
+        },
+        fields=["base_service", "tariff", "price", "staff_reward", "duration"],
+        limit_page_length=0,
+    )
@@ -0,0 +1,106 @@
+# car_wash/single_flight.py
+"""
+Single-flight coalescing of identical computations across workers via Redis.
+
+The first caller for a key takes a short lock and computes; callers that arrive
+while the flight is running wait (bounded) for its result and return it instead
+of recomputing. The result lives only for the waiters of that flight: a caller
+arriving after the flight has landed starts a new one, so nothing is served
+staler than the request it overlapped with.
+
+If the leader fails, or the wait runs out, a waiter computes on its own: the
+layer never turns a slow or broken computation into an error by itself. The wait
+is capped near the expected compute time of the call, so a waiter never holds a
+worker much longer than computing itself would.
+
+Callers of a user-independent computation (slots, prices) share one flight
+whoever they are. Endpoints whose result depends on the caller's permissions pass
+per_user=True, and the key then includes the session user.
+"""
+
+import hashlib
+import pickle
+import time
+from typing import Any, Callable
+
+import frappe
+
+NAMESPACE = "single_flight"
+DEFAULT_WAIT_SEC = 1.0
+POLL_SEC = 0.02
+# The lock outlives the waiters' patience, so a slow leader is not joined by a second one
+LOCK_TTL_SEC = 60
+
+# Delete the lock only if it still belongs to this flight (it could have expired and been retaken)
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def flight_key(name: str, *parts: Any, per_user: bool = False) -> str:
+    """
+    Stable key for a call: endpoint name plus a digest of its arguments
+    (and of the session user with per_user, for results that depend on permissions).
+    """
+    user = frappe.session.user if per_user and getattr(frappe.local, "session", None) else None
+    digest = hashlib.sha1(frappe.as_json([user, parts], indent=None).encode()).hexdigest()[:16]
+    return f"{name}:{digest}"
+
+
+def _lock_key(cache, key: str) -> str:
+    return cache.make_key(f"{NAMESPACE}:{key}")
+
+
+def _result_key(cache, key: str, token: str) -> str:
+    return cache.make_key(f"{NAMESPACE}:{key}:{token}")
+
+
+def _release(cache, lock_key: str, token: str) -> None:
+    script = _scripts.get(id(cache))
+    if script is None:
+        script = _scripts[id(cache)] = cache.register_script(RELEASE_SCRIPT)
+    script(keys=[lock_key], args=[token], client=cache)
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def single_flight(key: str, compute: Callable[[], Any], timeout: float = DEFAULT_WAIT_SEC) -> Any:
+    """
+    compute() once for all concurrent callers of key; waiters block at most timeout seconds
+    (about the expected compute time) and then compute locally. The result must be picklable.
+    """
+    cache = frappe.cache()
+    lock_key = _lock_key(cache, key)
+    token = frappe.generate_hash(length=12)
+
+    if cache.set(lock_key, token, nx=True, ex=LOCK_TTL_SEC):
+        try:
+            result = compute()
+            cache.set(_result_key(cache, key, token), pickle.dumps(result), ex=max(int(timeout), 1) + 1)
+            return result
+        finally:
+            _release(cache, lock_key, token)
+
+    leader = cache.get(lock_key)
+    if leader is not None:
+        result_key = _result_key(cache, key, _text(leader))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(POLL_SEC)
+            payload = cache.get(result_key)
+            if payload is not None:
+                return pickle.loads(payload)
+            if cache.get(lock_key) != leader:
+                # The flight landed without a result (the leader failed) — one last look, then compute
+                payload = cache.get(result_key)
+                if payload is not None:
+                    return pickle.loads(payload)
+                break
+    return compute()
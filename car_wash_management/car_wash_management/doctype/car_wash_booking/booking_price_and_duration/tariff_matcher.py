@@ -0,0 +1,220 @@
+# car_wash/tariff_matcher.py
+"""
+Tariff auto-selection by `Car wash tariff filter` rows.
+
+A tariff applies to a car when all of its filters match (a tariff without
+filters applies to any car); the first applicable tariff in priority order
+(priority desc, modified desc) wins.
+
+Filters are compiled once per price catalog version into TariffMatcher:
+- every filter becomes a predicate over a CarProfile (make, model, body type, year);
+- tariffs constrained by make (`markId` with `=` / `in`) are indexed by make, so a
+  lookup only evaluates tariffs of the car's make plus the make-agnostic ones;
+- results are memoized per profile inside the matcher (it is rebuilt on any tariff change).
+
+Attributes without a source field on `Car wash car` (engineType, volume) cannot
+be checked: such filters never match, so the tariff is not auto-selected.
+"""
+
+import operator
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+# Поля `Car wash car`, которые нужны для фильтров тарифа
+CAR_PROFILE_FIELDS = ["make", "model", "body_type", "year"]
+
+# attribute фильтра -> поле CarProfile
+ATTRIBUTE_SOURCES = {
+    "markId": "make",
+    "modelId": "model",
+    "bodyType": "body_type",
+    "modelYearFrom": "year",
+    "modelYearTo": "year",
+}
+
+MEMO_LIMIT = 4096
+
+_COMPARATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+}
+
+
+@dataclass(frozen=True)
+class CarProfile:
+    make: Optional[str] = None
+    model: Optional[str] = None
+    body_type: Optional[str] = None
+    year: Optional[int] = None
+
+    @classmethod
+    def from_row(cls, row: Optional[Mapping[str, Any]]) -> "CarProfile":
+        if not row:
+            return EMPTY_PROFILE
+        year = row.get("year")
+        return cls(
+            make=row.get("make") or None,
+            model=row.get("model") or None,
+            body_type=row.get("body_type") or None,
+            year=int(year) if year else None,
+        )
+
+
+EMPTY_PROFILE = CarProfile()
+
+
+def _normalize(value: Any) -> Any:
+    """Numbers compare as numbers, everything else case-insensitively as text."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return text.casefold()
+
+
+def _split_values(raw: Any) -> frozenset:
+    return frozenset(
+        v for v in (_normalize(part) for part in str(raw or "").replace(";", ",").split(",")) if v is not None
+    )
+
+
+@dataclass(frozen=True)
+class TariffFilter:
+    """One compiled filter row."""
+    source: Optional[str]  # поле CarProfile; None — атрибут нечем проверить
+    op: str
+    value: Any = None
+    values: frozenset = frozenset()
+    low: Any = None
+    high: Any = None
+
+    def matches(self, values: Mapping[str, Any]) -> bool:
+        """values: normalized CarProfile fields (see _profile_values)."""
+        if self.source is None:
+            return False
+        actual = values[self.source]
+        if actual is None:
+            # Неизвестное значение у машины не подходит ни под какой фильтр
+            return False
+        if self.op == "in":
+            return actual in self.values
+        if self.op == "between":
+            return _compare(operator.ge, actual, self.low) and _compare(operator.le, actual, self.high)
+        return _compare(_COMPARATORS[self.op], actual, self.value)
+
+
+def _compare(fn: Callable[[Any, Any], bool], actual: Any, expected: Any) -> bool:
+    if expected is None:
+        # Незаданная граница between не ограничивает
+        return True
+    if type(actual) is not type(expected):
+        # Число против текста: совпасть может только "!="
+        return fn is operator.ne
+    return fn(actual, expected)
+
+
+def _profile_values(profile: CarProfile) -> Dict[str, Any]:
+    return {name: _normalize(getattr(profile, name)) for name in ("make", "model", "body_type", "year")}
+
+
+def compile_tariff_filter(row: Mapping[str, Any]) -> TariffFilter:
+    op = row.get("operator") or "="
+    source = ATTRIBUTE_SOURCES.get(row.get("attribute"))
+    exact = row.get("value_exact")
+    if exact in (None, ""):
+        exact = row.get("value_from")
+
+    if op == "in":
+        return TariffFilter(source=source, op=op, values=_split_values(exact))
+    if op == "between":
+        return TariffFilter(source=source, op=op, low=_normalize(row.get("value_from")), high=_normalize(row.get("value_to")))
+    if op not in _COMPARATORS:
+        return TariffFilter(source=None, op=op)
+    return TariffFilter(source=source, op=op, value=_normalize(exact))
+
+
+@dataclass(frozen=True)
+class CompiledTariff:
+    name: str
+    position: int  # место в порядке авто-подбора
+    filters: Tuple[TariffFilter, ...]
+
+    def matches(self, values: Mapping[str, Any]) -> bool:
+        return all(f.matches(values) for f in self.filters)
+
+
+def _make_keys(tariff: CompiledTariff) -> Optional[frozenset]:
+    """Makes the tariff is limited to, or None if it accepts any make."""
+    keys: Optional[frozenset] = None
+    for f in tariff.filters:
+        if f.source != "make" or f.op not in ("=", "in"):
+            continue
+        values = f.values if f.op == "in" else frozenset([f.value])
+        keys = values if keys is None else keys & values
+    return keys
+
+
+@dataclass(frozen=True, eq=False)
+class TariffMatcher:
+    """Auto-selection over the active tariffs of one catalog version."""
+    tariffs: Tuple[CompiledTariff, ...]
+    by_make: Mapping[Any, Tuple[CompiledTariff, ...]]  # тарифы марки + тарифы без ограничения по марке
+    any_make: Tuple[CompiledTariff, ...]
+    _memo: Dict[CarProfile, Optional[str]] = field(default_factory=dict, repr=False)
+
+    @property
+    def has_filters(self) -> bool:
+        return any(t.filters for t in self.tariffs)
+
+
+    def resolve(self, profile: Optional[CarProfile] = None) -> Optional[str]:
+        """Name of the first applicable tariff, or None if no active tariff applies."""
+        profile = profile or EMPTY_PROFILE
+        if profile in self._memo:
+            return self._memo[profile]
+        values = _profile_values(profile)
+        candidates = self.by_make.get(values["make"], self.any_make)
+        found = next((t.name for t in candidates if t.matches(values)), None)
+        if len(self._memo) >= MEMO_LIMIT:
+            self._memo.clear()
+        self._memo[profile] = found
+        return found
+
+
+def compile_tariff_matcher(active_tariffs: Sequence[str], filter_rows: Iterable[Mapping[str, Any]]) -> TariffMatcher:
+    """Compile filters of active tariffs (given in auto-selection order)."""
+    filters_by_tariff: Dict[str, List[TariffFilter]] = {}
+    for row in filter_rows:
+        filters_by_tariff.setdefault(row["parent"], []).append(compile_tariff_filter(row))
+
+    tariffs = tuple(
+        CompiledTariff(name=name, position=pos, filters=tuple(filters_by_tariff.get(name, ())))
+        for pos, name in enumerate(active_tariffs)
+    )
+
+    by_make: Dict[Any, List[CompiledTariff]] = {}
+    any_make: List[CompiledTariff] = []
+    for tariff in tariffs:
+        keys = _make_keys(tariff)
+        if keys is None:
+            any_make.append(tariff)
+            continue
+        for key in keys:
+            by_make.setdefault(key, []).append(tariff)
+
+    return TariffMatcher(
+        tariffs=tariffs,
+        # Списки кандидатов сливаются заранее, в порядке авто-подбора
+        by_make={k: tuple(sorted(v + any_make, key=lambda t: t.position)) for k, v in by_make.items()},
+        any_make=tuple(any_make),
+    )
@@ -1,17 +1,24 @@
 # car_wash/tariffs.py
 import frappe
 
-def ensure_tariff_valid_for_car_wash(tariff_id: str, car_wash: str) -> str:
+from .price_catalog import get_price_catalog
+from .tariff_matcher import CAR_PROFILE_FIELDS, CarProfile
+
+
+def ensure_tariff_valid_for_car_wash(tariff_id: str, car_wash: str, catalog=None) -> str:
     """
     Проверяем, что тариф существует, активен и принадлежит указанной мойке.
     Возвращаем name (тот же tariff_id), либо бросаем frappe.throw.
+    Если передан catalog (PriceCatalog мойки) — тарифы этой мойки проверяются без запроса к БД.
     """
-    row = frappe.db.get_value(
-        "Car wash tariff",
-        tariff_id,
-        ["name", "car_wash", "is_active"],
-        as_dict=True,
-    )
+    row = catalog.tariffs.get(tariff_id) if catalog is not None else None
+    if row is None:
+        row = frappe.db.get_value(
+            "Car wash tariff",
+            tariff_id,
+            ["name", "car_wash", "is_active"],
+            as_dict=True,
+        )
     if not row:
         frappe.throw(f"Tariff '{tariff_id}' not found.")
     if row.car_wash != car_wash:
@@ -21,18 +28,31 @@ def ensure_tariff_valid_for_car_wash(tariff_id: str, car_wash: str) -> str:
     return row.name
 
 
-def resolve_applicable_tariff(car_wash: str, car: str | None = None, services: list | None = None) -> str:
+def resolve_applicable_tariff(
+    car_wash: str,
+    car: str | None = None,
+    services: list | None = None,
+    catalog=None,
+    car_profile: CarProfile | None = None,
+) -> str:
     """
-    Базовый авто-подбор тарифа: берём активный с максимальным priority.
-    Сюда позже можно добавить проверку child-таблицы `Car wash tariff filter`.
+    Авто-подбор тарифа: первый активный (priority desc, modified desc), у которого
+    выполнены все строки `Car wash tariff filter`; тариф без фильтров подходит любой машине.
+    Фильтры скомпилированы в catalog.tariff_matcher (см. tariff_matcher.py).
+    Если переданы catalog и car_profile — подбор без запросов к БД.
     """
-    rows = frappe.get_all(
-        "Car wash tariff",
-        filters={"car_wash": car_wash, "is_active": 1},
-        fields=["name", "priority"],
-        order_by="priority desc, modified desc",
-        limit_page_length=50,
-    )
-    if not rows:
+    if catalog is None:
+        catalog = get_price_catalog(car_wash)
+    if not catalog.active_tariffs:
         frappe.throw("No active tariff found for this car wash.")
-    return rows[0].name
+
+    matcher = catalog.tariff_matcher
+    if car_profile is None and car and matcher.has_filters:
+        car_profile = CarProfile.from_row(
+            frappe.db.get_value("Car wash car", car, CAR_PROFILE_FIELDS, as_dict=True)
+        )
+
+    tariff = matcher.resolve(car_profile)
+    if not tariff:
+        frappe.throw("No tariff of this car wash applies to this car.")
+    return tariff
@@ -0,0 +1,21 @@
+# Copyright (c) 2024, Rifat Dzhumagulov and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from .discount_simulator import _compile_proposed
+
+
+def make_config(**values):
+	return {"name_title": "Weekend", "discount_type": "Percentage", "discount_value": 10, "priority": 1, **values}
+
+
+class TestDiscountSimulator(FrappeTestCase):
+	def test_unnamed_configs_get_unique_names(self):
+		compiled = _compile_proposed("CW-1", [make_config(), make_config(), make_config(name="SIM-1")])
+		self.assertEqual(sorted(d.name for d in compiled), ["SIM-1", "proposed-1", "proposed-2"])
+
+	def test_duplicate_names_are_rejected(self):
+		with self.assertRaises(frappe.ValidationError):
+			_compile_proposed("CW-1", [make_config(name="SIM-1"), make_config(name="SIM-1")])
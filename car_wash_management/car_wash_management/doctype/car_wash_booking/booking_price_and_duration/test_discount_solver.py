@@ -0,0 +1,109 @@
+# Copyright (c) 2024, Rifat Dzhumagulov and Contributors
+# See license.txt
+
+import random
+
+from frappe.tests.utils import FrappeTestCase
+
+from .auto_discounts import apply_best_auto_discounts
+from .discount_solver import (
+	POLICY_PRIORITY,
+	brute_force_auto_discounts,
+	choose_auto_discounts,
+	is_feasible,
+	set_value_cents,
+)
+
+
+def make_discount(idx, service_discount, combinable=1, waive=0):
+	return {
+		"discount_id": f"AD-{idx}",
+		"service_discount": service_discount,
+		"waive_queue_commission": waive,
+		"priority": idx,
+		"can_combine_with_other_auto_discounts": combinable,
+	}
+
+
+def random_discounts(rng, count, services_total):
+	discounts = []
+	for idx in range(count):
+		if rng.random() < 0.5:
+			amount = services_total * rng.choice([5, 10, 15, 20, 50]) / 100
+		else:
+			amount = min(rng.choice([100, 250, 500, 1000, 3000]), services_total)
+		discounts.append(make_discount(idx, amount, int(rng.random() < 0.7), int(rng.random() < 0.3)))
+	return discounts
+
+
+def ids(discounts):
+	return [d["discount_id"] for d in discounts]
+
+
+class TestDiscountSolver(FrappeTestCase):
+	def test_matches_brute_force_on_small_sets(self):
+		rng = random.Random(20240501)
+		for _ in range(2000):
+			services_total = rng.choice([0, 500, 1500, 4000, 10000])
+			commission = rng.choice([0, 100])
+			allow = rng.random() < 0.9
+			candidates = random_discounts(rng, rng.randint(1, 10), services_total)
+
+			chosen = choose_auto_discounts(candidates, services_total, commission, allow)
+			expected = brute_force_auto_discounts(candidates, services_total, commission, allow)
+
+			self.assertEqual(ids(chosen), ids(expected), candidates)
+
+	def test_result_is_feasible_and_never_worse_than_old_strategy(self):
+		rng = random.Random(7)
+		for _ in range(500):
+			services_total = rng.choice([1500, 4000, 10000])
+			candidates = random_discounts(rng, rng.randint(1, 30), services_total)
+
+			chosen = choose_auto_discounts(candidates, services_total, 100)
+			self.assertTrue(is_feasible(chosen))
+
+			# Old strategy: first by priority vs stacking every combinable discount
+			old = [candidates[0]]
+			stack = [d for d in candidates if d["can_combine_with_other_auto_discounts"]]
+			if len(stack) > 1 and set_value_cents(stack, services_total, 100) > set_value_cents(old, services_total, 100):
+				old = stack
+			self.assertGreaterEqual(
+				set_value_cents(chosen, services_total, 100),
+				set_value_cents(old, services_total, 100),
+			)
+
+	def test_exclusive_discount_beats_stack(self):
+		candidates = [
+			make_discount(0, 100),
+			make_discount(1, 900, combinable=0),
+			make_discount(2, 200),
+		]
+		self.assertEqual(ids(choose_auto_discounts(candidates, 1000)), ["AD-1"])
+
+	def test_smallest_set_reaching_cap(self):
+		candidates = [make_discount(0, 300), make_discount(1, 800), make_discount(2, 400), make_discount(3, 200)]
+		# Two discounts already cover the 1000 total; of such pairs the higher priority one wins
+		self.assertEqual(ids(choose_auto_discounts(candidates, 1000)), ["AD-0", "AD-1"])
+
+	def test_waiver_is_kept_in_stack(self):
+		candidates = [make_discount(0, 1000), make_discount(1, 0, waive=1)]
+		self.assertEqual(ids(choose_auto_discounts(candidates, 1000, 100)), ["AD-0", "AD-1"])
+
+	def test_many_equal_combinable_discounts(self):
+		# 32 interchangeable discounts: the first ten by priority reach the cap, without a search over ties
+		candidates = [make_discount(idx, 100) for idx in range(32)]
+		self.assertEqual(ids(choose_auto_discounts(candidates, 1000)), [f"AD-{idx}" for idx in range(10)])
+
+	def test_priority_policy(self):
+		candidates = [make_discount(0, 100), make_discount(1, 900, combinable=0), make_discount(2, 200)]
+		self.assertEqual(ids(choose_auto_discounts(candidates, 1000, policy=POLICY_PRIORITY)), ["AD-0", "AD-2"])
+
+	def test_apply_best_auto_discounts_totals(self):
+		candidates = [make_discount(0, 300, waive=1), make_discount(1, 800), make_discount(2, 400)]
+		result = apply_best_auto_discounts(candidates, services_total=1000, commission_amount=100)
+
+		self.assertEqual(ids(result["applied_discounts"]), ["AD-0", "AD-1"])
+		self.assertEqual(result["total_service_discount"], 1000)
+		self.assertEqual(result["commission_waived"], 100)
+		self.assertEqual(result["final_services_total"], 0)
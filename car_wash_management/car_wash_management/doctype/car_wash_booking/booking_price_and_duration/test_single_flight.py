@@ -0,0 +1,130 @@
+# Copyright (c) 2024, Rifat Dzhumagulov and Contributors
+# See license.txt
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from .single_flight import flight_key, single_flight
+
+
+def in_site(fn):
+	"""Run fn in a worker thread with the test site initialised (frappe.local is per thread)."""
+	site, sites_path = frappe.local.site, frappe.local.sites_path
+
+	def run(*args):
+		frappe.init(site=site, sites_path=sites_path)
+		try:
+			return fn(*args)
+		finally:
+			frappe.destroy()
+
+	return run
+
+
+class TestSingleFlight(FrappeTestCase):
+	CALLERS = 20
+
+	def setUp(self):
+		self.key = flight_key("test_single_flight", frappe.generate_hash(length=8))
+		self.calls = 0
+		self.lock = threading.Lock()
+
+	def _compute(self, value, seconds=0.3):
+		def compute():
+			with self.lock:
+				self.calls += 1
+			time.sleep(seconds)
+			return value
+		return compute
+
+	def _call_concurrently(self, compute):
+		barrier = threading.Barrier(self.CALLERS)
+
+		def call(_):
+			barrier.wait()
+			return single_flight(self.key, compute)
+
+		with ThreadPoolExecutor(max_workers=self.CALLERS) as pool:
+			return list(pool.map(in_site(call), range(self.CALLERS)))
+
+	def test_concurrent_callers_compute_once(self):
+		results = self._call_concurrently(self._compute({"slots": [1, 2, 3]}))
+		self.assertEqual(self.calls, 1)
+		self.assertEqual(results, [{"slots": [1, 2, 3]}] * self.CALLERS)
+
+	def test_landed_flight_is_not_reused(self):
+		self.assertEqual(single_flight(self.key, self._compute("first", 0)), "first")
+		self.assertEqual(single_flight(self.key, self._compute("second", 0)), "second")
+		self.assertEqual(self.calls, 2)
+
+	def test_failed_leader_lets_waiters_compute(self):
+		def compute():
+			with self.lock:
+				self.calls += 1
+				first = self.calls == 1
+			time.sleep(0.2)
+			if first:
+				raise ValueError("leader failed")
+			return "ok"
+
+		barrier = threading.Barrier(self.CALLERS)
+
+		def call(_):
+			barrier.wait()
+			try:
+				return single_flight(self.key, compute)
+			except ValueError:
+				return "failed"
+
+		with ThreadPoolExecutor(max_workers=self.CALLERS) as pool:
+			results = list(pool.map(in_site(call), range(self.CALLERS)))
+		self.assertEqual(results.count("failed"), 1)
+		self.assertEqual(results.count("ok"), self.CALLERS - 1)
+
+	def test_key_depends_on_arguments(self):
+		self.assertEqual(flight_key("get_free_slots", "CW-1", "2030-01-01"), flight_key("get_free_slots", "CW-1", "2030-01-01"))
+		self.assertNotEqual(flight_key("get_free_slots", "CW-1", "2030-01-01"), flight_key("get_free_slots", "CW-2", "2030-01-01"))
+
+	def test_key_depends_on_session_user_only_per_user(self):
+		shared = flight_key("get_services_with_prices", "CW-1")
+		own = flight_key("get_weekly_owner_report", "CW-1", per_user=True)
+		frappe.set_user("Guest")
+		try:
+			self.assertEqual(flight_key("get_services_with_prices", "CW-1"), shared)
+			self.assertNotEqual(flight_key("get_weekly_owner_report", "CW-1", per_user=True), own)
+		finally:
+			frappe.set_user("Administrator")
+
+	def test_different_users_share_one_computation(self):
+		barrier = threading.Barrier(2)
+		compute = self._compute("slots")
+
+		def call(user):
+			frappe.set_user(user)
+			barrier.wait()
+			return single_flight(flight_key("get_free_slots", self.key), compute)
+
+		with ThreadPoolExecutor(max_workers=2) as pool:
+			results = list(pool.map(in_site(call), ["Administrator", "Guest"]))
+		self.assertEqual(results, ["slots", "slots"])
+		self.assertEqual(self.calls, 1)
+
+	def test_waiter_computes_locally_after_timeout(self):
+		barrier = threading.Barrier(2)
+		compute = self._compute("slow", seconds=1.0)
+
+		def call(_):
+			barrier.wait()
+			started = time.monotonic()
+			single_flight(self.key, compute, timeout=0.2)
+			return time.monotonic() - started
+
+		with ThreadPoolExecutor(max_workers=2) as pool:
+			elapsed = list(pool.map(in_site(call), range(2)))
+		# The waiter gave up on the leader and computed itself instead of waiting it out
+		self.assertEqual(self.calls, 2)
+		self.assertTrue(all(seconds < 1.5 for seconds in elapsed))
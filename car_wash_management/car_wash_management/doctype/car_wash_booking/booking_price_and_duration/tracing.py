@@ -0,0 +1,186 @@
+# car_wash/tracing.py
+"""
+Opt-in stage tracing of the pricing pipeline.
+
+A trace records wall time and number of SQL queries per stage (validation,
+customer, tariff, service_docs, prices, calculate_totals, auto_discounts,
+promocode). It is started by the endpoint when a logged-in System Manager
+asks for `debug` (the flag is ignored for anyone else, guests included) or the
+request is sampled (site config `booking_quote_trace_sample_rate`,
+0..1, off by default).
+
+- debug: the trace is returned in the response under "debug";
+- every finished trace is pushed to Redis: one capped list of recent samples
+  per stage, read by get_quote_stage_percentiles (p50/p90/p99).
+
+Without an active trace trace_stage is a shared no-op context manager, so the
+hot path pays one attribute lookup per stage.
+"""
+
+import random
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import frappe
+
+TRACE_KEY_PREFIX = "booking_quote_trace"
+SAMPLE_RATE_CONF_KEY = "booking_quote_trace_sample_rate"
+MAX_SAMPLES = 2000
+TOTAL_STAGE = "total"
+
+_NOOP = nullcontext()
+
+
+class QuoteTrace:
+    """Stage timings of one request; stages with the same name are summed."""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.queries = 0
+        self.started = time.perf_counter()
+        self.total_ms = 0.0
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        queries_before = self.queries
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {"ms": 0.0, "queries": 0, "calls": 0})
+            entry["ms"] += (time.perf_counter() - started) * 1000.0
+            entry["queries"] += self.queries - queries_before
+            entry["calls"] += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "total_ms": round(self.total_ms, 3),
+            "queries": self.queries,
+            # Пустой список стадий — ответ взят из quote_memo
+            "stages": [
+                {"stage": name, "ms": round(s["ms"], 3), "queries": s["queries"], "calls": s["calls"]}
+                for name, s in self.stages.items()
+            ],
+        }
+
+
+def current_trace() -> Optional[QuoteTrace]:
+    return getattr(frappe.local, "booking_quote_trace", None)
+
+
+def trace_stage(name: str):
+    """`with trace_stage("tariff"): ...` — records the block if a trace is active."""
+    trace = getattr(frappe.local, "booking_quote_trace", None)
+    return trace.stage(name) if trace is not None else _NOOP
+
+
+def _is_sampled() -> bool:
+    rate = frappe.conf.get(SAMPLE_RATE_CONF_KEY) or 0
+    try:
+        return random.random() < float(rate)
+    except (TypeError, ValueError):
+        return False
+
+
+def debug_requested(debug: Any) -> bool:
+    """
+    Endpoint `debug` argument: honoured only for logged-in System Managers, so guests
+    of the allow_guest quote endpoints cannot switch tracing on or read stage timings.
+    """
+    if isinstance(debug, str):
+        debug = frappe.parse_json(debug)
+    if not debug or frappe.session.user == "Guest":
+        return False
+    return "System Manager" in frappe.get_roles()
+
+
+@contextmanager
+def quote_trace(debug: bool = False) -> Iterator[Optional[QuoteTrace]]:
+    """
+    Trace the block if debug is requested or the request is sampled.
+    Yields the trace (None when not traced or when an outer trace is already active).
+    """
+    if current_trace() is not None or not (debug or _is_sampled()):
+        yield None
+        return
+
+    trace = QuoteTrace()
+    original_sql = frappe.db.sql
+
+    def counting_sql(*args, **kwargs):
+        trace.queries += 1
+        return original_sql(*args, **kwargs)
+
+    frappe.db.sql = counting_sql
+    frappe.local.booking_quote_trace = trace
+    try:
+        yield trace
+    finally:
+        trace.total_ms = (time.perf_counter() - trace.started) * 1000.0
+        frappe.local.booking_quote_trace = None
+        frappe.db.sql = original_sql
+        _store_samples(trace)
+
+
+def _stage_key(stage: str) -> str:
+    return f"{TRACE_KEY_PREFIX}:{stage}"
+
+
+def _store_samples(trace: QuoteTrace) -> None:
+    samples = {name: (s["ms"], s["queries"]) for name, s in trace.stages.items()}
+    samples[TOTAL_STAGE] = (trace.total_ms, trace.queries)
+    record_stage_samples(samples)
+
+
+def record_stage_samples(samples: Dict[str, Tuple[float, int]]) -> None:
+    """Push {stage: (ms, queries)} samples with one pipeline round trip."""
+    try:
+        cache = frappe.cache()
+        pipe = cache.pipeline()
+        for name, (ms, queries) in samples.items():
+            key = cache.make_key(_stage_key(name))
+            pipe.lpush(key, f"{ms:.3f}:{queries}")
+            pipe.ltrim(key, 0, MAX_SAMPLES - 1)
+        pipe.sadd(cache.make_key(f"{TRACE_KEY_PREFIX}:stages"), *samples.keys())
+        pipe.execute()
+    except Exception:
+        # Трейсинг не должен ломать расчёт цены
+        frappe.log_error(frappe.get_traceback(), "Booking quote trace store failed")
+
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+@frappe.whitelist()
+def get_quote_stage_percentiles() -> Dict[str, Any]:
+    """Per-stage latency percentiles over the last MAX_SAMPLES traced quotes."""
+    frappe.only_for("System Manager")
+    cache = frappe.cache()
+    stages = sorted(
+        s.decode() if isinstance(s, bytes) else s
+        for s in (cache.smembers(f"{TRACE_KEY_PREFIX}:stages") or ())
+    )
+
+    result = {}
+    for stage in stages:
+        timings, queries = [], []
+        for raw in cache.lrange(_stage_key(stage), 0, -1) or ():
+            ms, _, count = (raw.decode() if isinstance(raw, bytes) else raw).partition(":")
+            timings.append(float(ms))
+            queries.append(int(count or 0))
+        if not timings:
+            continue
+        timings.sort()
+        result[stage] = {
+            "samples": len(timings),
+            "p50_ms": round(_percentile(timings, 50), 3),
+            "p90_ms": round(_percentile(timings, 90), 3),
+            "p99_ms": round(_percentile(timings, 99), 3),
+            "max_ms": round(timings[-1], 3),
+            "avg_queries": round(sum(queries) / len(queries), 2),
+        }
+    return result
@@ -0,0 +1,149 @@
+# car_wash/usage_ledger.py
+"""
+Bulk writes of `Car wash auto discount usage` rows.
+
+Usage rows are a ledger without controller logic, so they are written with
+plain SQL instead of one document lifecycle per row:
+- insert_usage_rows: the doctype's format: autoname is expanded the way
+  insert() expands it (parse_naming_series per braced param), numbers for all rows
+  are taken from that tabSeries counter with one upsert + one select, then the
+  rows go in with one multi-row INSERT;
+- update_usage_rows: one UPDATE ... CASE for the rows whose values changed;
+  callers diff against the current values first and pass only the changes.
+
+Statement count does not depend on the number of rows.
+"""
+
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import frappe
+from frappe.model.naming import BRACED_PARAMS_PATTERN, parse_naming_series
+from frappe.utils import flt, now
+
+DOCTYPE = "Car wash auto discount usage"
+NUMBER_PLACEHOLDER = "\0"
+
+INSERT_FIELDS = (
+    "car_wash", "customer", "context_type", "context_id", "discount_id", "discount_name",
+    "rules_snapshot", "service_discount", "commission_waived", "total_discount", "is_disabled",
+)
+AMOUNT_FIELDS = ("service_discount", "commission_waived", "total_discount")
+UPDATABLE_FIELDS = frozenset(AMOUNT_FIELDS + ("is_disabled",))
+
+
+def _name_series(car_wash: str) -> Tuple[str, str, int]:
+    """
+    (name template with NUMBER_PLACEHOLDER, tabSeries key, digits) of the car wash:
+    the autoname is expanded like _format_autoname does, with the number left out.
+    """
+    autoname = frappe.get_meta(DOCTYPE).autoname
+    doc = frappe.get_doc({"doctype": DOCTYPE, "car_wash": car_wash})
+    series = {}
+
+    def take_number(key: str, digits: int) -> str:
+        series.update(key=key, digits=digits)
+        return NUMBER_PLACEHOLDER
+
+    template = BRACED_PARAMS_PATTERN.sub(
+        lambda match: parse_naming_series([match.group()[1:-1]], doc=doc, number_generator=take_number),
+        autoname.split(":", 1)[1],
+    )
+    return template, series["key"], series["digits"]
+
+
+def _reserve_names(car_wash: str, count: int) -> List[str]:
+    """Take `count` consecutive numbers of the autoname series (row stays locked until commit)."""
+    template, key, digits = _name_series(car_wash)
+    frappe.db.sql(
+        """
+        insert into `tabSeries` (`name`, `current`) values (%(key)s, %(count)s)
+        on duplicate key update `current` = `current` + %(count)s
+        """,
+        {"key": key, "count": count},
+    )
+    current = int(frappe.db.sql("select `current` from `tabSeries` where `name` = %s", key)[0][0])
+    return [
+        template.replace(NUMBER_PLACEHOLDER, f"{number:0{digits}d}")
+        for number in range(current - count + 1, current + 1)
+    ]
+
+
+def insert_usage_rows(car_wash: str, rows: List[Mapping[str, Any]]) -> List[str]:
+    """Insert usage rows of one car wash; returns their names in the given order."""
+    if not rows:
+        return []
+    names = _reserve_names(car_wash, len(rows))
+    timestamp = now()
+    user = frappe.session.user
+    values = [
+        (name, timestamp, timestamp, user, user, 0, idx)
+        + tuple(row.get(field, 0 if field == "is_disabled" else None) for field in INSERT_FIELDS)
+        for idx, (name, row) in enumerate(zip(names, rows), start=1)
+    ]
+    frappe.db.bulk_insert(
+        DOCTYPE,
+        fields=["name", "creation", "modified", "owner", "modified_by", "docstatus", "idx", *INSERT_FIELDS],
+        values=values,
+    )
+    return names
+
+
+def update_usage_rows(changes: Mapping[str, Mapping[str, Any]]) -> int:
+    """
+    Apply {name: {field: value}} with a single UPDATE; returns the number of rows touched.
+    Only UPDATABLE_FIELDS may be changed.
+    """
+    changes = {name: values for name, values in changes.items() if values}
+    if not changes:
+        return 0
+    fields = sorted({field for values in changes.values() for field in values})
+    unknown = set(fields) - UPDATABLE_FIELDS
+    if unknown:
+        raise ValueError(f"Fields can not be bulk-updated: {', '.join(sorted(unknown))}")
+
+    assignments = []
+    params: List[Any] = []
+    for field in fields:
+        cases = []
+        for name, values in changes.items():
+            if field in values:
+                cases.append("when %s then %s")
+                params.extend((name, values[field]))
+        assignments.append(f"`{field}` = case `name` {' '.join(cases)} else `{field}` end")
+    assignments.append("`modified` = %s")
+    assignments.append("`modified_by` = %s")
+    params.extend((now(), frappe.session.user))
+    params.extend(changes)
+
+    frappe.db.sql(
+        f"""
+        update `tab{DOCTYPE}`
+        set {', '.join(assignments)}
+        where `name` in ({', '.join(['%s'] * len(changes))})
+        """,
+        params,
+    )
+    return len(changes)
+
+
+def diff_usage_row(current: Mapping[str, Any], target: Mapping[str, Any]) -> Dict[str, Any]:
+    """Fields of target that differ from the current row (amounts compared in cents)."""
+    changed = {}
+    for field, value in target.items():
+        if field in AMOUNT_FIELDS:
+            if flt(current.get(field), 2) != flt(value, 2):
+                changed[field] = flt(value)
+        elif (current.get(field) or 0) != (value or 0):
+            changed[field] = value
+    return changed
+
+
+def get_usage_rows(context_type: str, context_id: str, fields: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+    """Usage rows of a context in recording order."""
+    return frappe.get_all(
+        DOCTYPE,
+        filters={"context_type": context_type, "context_id": context_id},
+        fields=["name", "discount_id", *(fields or ())],
+        order_by="creation asc, idx asc",
+        limit_page_length=0,
+    )
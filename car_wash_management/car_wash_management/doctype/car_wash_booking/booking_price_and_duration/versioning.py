@@ -0,0 +1,83 @@
+# car_wash/versioning.py
+"""
+Version tokens in Redis for caches compiled from database rows.
+
+A compiled structure (price catalog, discount rules, ...) is tagged with the
+version it was built from. Writers bump the version; readers compare tokens
+and rebuild on mismatch, so invalidation is immediate for every worker.
+"""
+
+import pickle
+from typing import Any, Callable, Dict, Optional
+
+import frappe
+
+# Move the token only if it is still the expected one and store the values built for the new token.
+# KEYS[1] — version key, KEYS[2..] — value keys; ARGV: expected, new, ttl, values...
+SWAP_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2])
+for i = 2, #KEYS do
+    redis.call('SET', KEYS[i], ARGV[i + 2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+_scripts = {}
+
+
+def _version_key(namespace: str, key: str) -> str:
+    return f"{namespace}:version:{key}"
+
+
+def get_version(namespace: str, key: str) -> str:
+    """Current version token; created on first use."""
+    cache = frappe.cache()
+    version = cache.get_value(_version_key(namespace, key))
+    if version is None:
+        version = bump_version(namespace, key)
+    return version
+
+
+def bump_version(namespace: str, key: str) -> str:
+    """Set a fresh random token so every cached build for this key becomes stale."""
+    version = frappe.generate_hash(length=12)
+    frappe.cache().set_value(_version_key(namespace, key), version)
+    return version
+
+
+def bump_version_now_and_after_commit(namespace: str, key: str) -> None:
+    """
+    Bump right away and once more after the transaction commits: a reader that
+    rebuilt between the two bumps could only see pre-commit rows.
+    """
+    bump_version(namespace, key)
+    frappe.db.after_commit(lambda: bump_version(namespace, key))
+
+
+def swap_version(
+    namespace: str,
+    key: str,
+    expected: str,
+    build: Callable[[str], Dict[str, Any]],
+    expires_in_sec: int,
+) -> Optional[str]:
+    """
+    Atomically replace the token `expected` with a fresh one and store build(new token)
+    ({cache key: value}, e.g. entries updated in place and tagged with it).
+    None — the version moved on meanwhile and nothing was written.
+    """
+    cache = frappe.cache()
+    version = frappe.generate_hash(length=12)
+    values = build(version)
+    script = _scripts.get(id(cache))
+    if script is None:
+        script = _scripts[id(cache)] = cache.register_script(SWAP_SCRIPT)
+    swapped = script(
+        keys=[cache.make_key(_version_key(namespace, key)), *(cache.make_key(k) for k in values)],
+        args=[pickle.dumps(expected), pickle.dumps(version), int(expires_in_sec), *(pickle.dumps(v) for v in values.values())],
+        client=cache,
+    )
+    return version if int(swapped) else None
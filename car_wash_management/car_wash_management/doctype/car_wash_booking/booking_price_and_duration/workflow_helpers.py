@@ -5,6 +5,7 @@ from .auto_discounts import (
 	apply_recorded_auto_discounts_to_base,
 	refresh_recorded_auto_discount_usage,
 )
+from .usage_ledger import diff_usage_row, get_usage_rows, update_usage_rows
 
 
 def compute_base_price_and_duration(car_wash, car, services, tariff, **kwargs):
@@ -38,33 +39,20 @@ def get_disabled_auto_discount_ids_from_request_or_doc(doc):
 def set_auto_discount_usage_flags(context_type: str, context_id: str, disabled_ids: set, enable_others: bool = False):
 	"""
 	Mark usage rows disabled for given ids. Optionally enable others.
+	One read and at most one UPDATE: only rows whose flag changes are written.
 	"""
 	if not disabled_ids:
 		return
-	names = frappe.get_all(
-		"Car wash auto discount usage",
-		filters={
-			"context_type": context_type,
-			"context_id": context_id,
-			"discount_id": ["in", list(disabled_ids)],
-		},
-		pluck="name",
-	)
-	for n in names:
-		frappe.db.set_value("Car wash auto discount usage", n, "is_disabled", 1)
-
-	if enable_others:
-		names_other = frappe.get_all(
-			"Car wash auto discount usage",
-			filters={
-				"context_type": context_type,
-				"context_id": context_id,
-				"discount_id": ["not in", list(disabled_ids)],
-			},
-			pluck="name",
-		)
-		for n in names_other:
-			frappe.db.set_value("Car wash auto discount usage", n, "is_disabled", 0)
+	changes = {}
+	for row in get_usage_rows(context_type, context_id, fields=["is_disabled"]):
+		if row.discount_id in disabled_ids:
+			target = 1
+		elif enable_others and row.discount_id:
+			target = 0
+		else:
+			continue
+		changes[row.name] = diff_usage_row(row, {"is_disabled": target})
+	update_usage_rows(changes)
 
 
 def refresh_usage(context_type: str, context_id: str, base_services_total: float, base_commission: float):
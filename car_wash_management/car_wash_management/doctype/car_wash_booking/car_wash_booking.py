@@ -12,15 +12,24 @@ from .booking_price_and_duration.workflow_helpers import (
 	apply_usage,
 )
 from .availiability import update_cars_in_queue
+from ..car_wash_appointment.availability_bitmap import on_booking_change
+from . import queue_model
+from .slot_holds import claim_slot_hold, consume_slot_hold
 from ...inventory import recalc_products_totals, reserve_products, unreserve_products
 
 class Carwashbooking(Document):
     """Workflow:
+    - before_insert: claim the slot hold of desired_time (a taken slot fails fast, before pricing).
     - validate: compute base totals without auto-discounts via helpers, refresh/apply
       recorded auto-discount usage, update totals and product rows, set payment ts,
-      and update queue flags.
+      and set has_appointment.
     - creation: record a snapshot of auto-discounts for current conditions.
-    - on_update: on soft-delete unreserve products and delete recorded usage.
+    - on_update: refresh availability bitmaps when queue fields change; on soft-delete
+      unreserve products and delete recorded usage.
+    - on_trash: refresh availability bitmaps.
+    - on_update/on_trash: move the booking in/out of the live queue model (after commit) and
+      apply the ±1 delta of `cars_in_queue` on queue transitions; on insert release the
+      slot hold after commit.
     - on_submit: reserve products.
     - on_cancel: unreserve products and delete recorded usage.
     Rationale: central helpers keep pricing/discount logic consistent across doctypes.
@@ -43,6 +52,9 @@ class Carwashbooking(Document):
         if not self.car_wash:
             frappe.throw(_("Car Wash is required"))
 
+        # Удержание слота до тяжёлой валидации и расчёта цены: занятый слот отклоняется сразу
+        claim_slot_hold(self)
+
         max_num = frappe.db.sql(
             """
             SELECT MAX(CAST(num AS UNSIGNED)) FROM `tabCar wash appointment`
@@ -161,11 +173,18 @@ class Carwashbooking(Document):
         else:
             self.has_appointment = False
 
-        update_cars_in_queue(self)
-
         # История применения автоскидок на создании уже записана выше
 
     def on_update(self):
+        # Очередь занимает слоты во всех днях мойки
+        before = self.get_doc_before_save()
+        on_booking_change(before, self)
+        queue_model.on_booking_change(before, self)
+        # Счётчик очереди меняется только по переходу брони
+        update_cars_in_queue(before, self)
+        # После сброса версий битовых карт: удержание снимается, когда бронь уже в карте
+        consume_slot_hold(self)
+
         # Снятие резерва при soft-delete (только если есть фича shop)
         try:
             if self.has_value_changed("is_deleted") and getattr(self, "is_deleted", 0):
@@ -176,6 +195,11 @@ class Carwashbooking(Document):
         except Exception:
             frappe.log_error(frappe.get_traceback(), "Booking on_update soft-delete unreserve failed")
 
+    def on_trash(self):
+        on_booking_change(self, None)
+        queue_model.on_booking_change(self, None)
+        update_cars_in_queue(self, None)
+
     def on_submit(self):
         try:
             # Резервировать товары только если есть фича shop
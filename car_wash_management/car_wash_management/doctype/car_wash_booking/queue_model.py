@@ -0,0 +1,413 @@
+# car_wash/queue_model.py
+"""
+Живая очередь мойки в Redis: позиция и ожидаемое время без обращений к БД.
+
+Ключи (на мойку):
+  car_wash_queue:{car_wash}          — ZSET броней в очереди, score = desired_time или creation;
+  car_wash_queue:{car_wash}:boxes    — HASH box -> время освобождения (unix ts, 0 — свободен);
+  car_wash_queue:{car_wash}:avg      — HASH box -> скользящее среднее длительности работы, сек
+                                       ("*" — среднее по мойке);
+  car_wash_queue:{car_wash}:built    — модель собрана из БД;
+  car_wash_queue:index               — HASH booking -> car_wash (для опроса по имени брони).
+
+Модель ведут переходы документов (после коммита): бронь входит в очередь / выходит
+из неё (has_appointment, is_cancelled, is_deleted), запись занимает бокс при начале
+работ и освобождает при завершении (длительность идёт в среднее бокса), боксы
+добавляются и удаляются (в HASH боксов попадают только включённые боксы).
+get_queue_position читает всё одним pipeline: ZRANK — O(log n); ETA — момент, когда
+освободится бокс для машины после cars_ahead: бинарный поиск по времени, на каждом шаге
+число машин, успевающих начать к этому моменту, считается по боксам, — O(boxes · log n)
+без перебора машин впереди.
+
+Холодная модель собирается из БД один раз (rebuild_queue_model), ежечасная сверка
+(reconcile_queue_models) пересобирает модели, уже собранные ранее.
+"""
+
+import time
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt, get_datetime, now_datetime
+
+from .availiability import is_in_queue
+
+KEY_PREFIX = "car_wash_queue"
+INDEX_KEY = f"{KEY_PREFIX}:index"
+ALL_BOXES = "*"
+DEFAULT_SERVICE_SECONDS = 30 * 60
+EWMA_ALPHA = 0.2  # вес последней работы в скользящем среднем
+HISTORY_DAYS = 14
+HISTORY_LIMIT = 500
+ETA_PRECISION_SEC = 1e-3
+
+
+def _key(car_wash: str, suffix: str = "") -> str:
+    return f"{KEY_PREFIX}:{car_wash}{':' + suffix if suffix else ''}"
+
+
+def _raw(command: str, *args):
+    """
+    Одна команда Redis без обёрток RedisWrapper (его hget/hdel/exists сами добавляют
+    префикс и распаковывают pickle) — ключи передаются уже через make_key.
+    """
+    pipe = frappe.cache().pipeline(transaction=False)
+    getattr(pipe, command)(*args)
+    return pipe.execute()[0]
+
+
+def _ts(value) -> float:
+    return time.mktime(get_datetime(value).timetuple())
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _queue_score(doc) -> float:
+    return _ts(doc.get("desired_time") or doc.get("creation") or now_datetime())
+
+
+def _planned_seconds(duration_total, avg_seconds: Optional[float]) -> float:
+    return flt(duration_total) or flt(avg_seconds) or DEFAULT_SERVICE_SECONDS
+
+
+# ---- сборка из БД ----
+
+def _box_averages(car_wash: str) -> Dict[str, float]:
+    """Средняя длительность работ по боксам за HISTORY_DAYS (последние HISTORY_LIMIT записей)."""
+    rows = frappe.get_all(
+        "Car wash appointment",
+        filters=[
+            ["car_wash", "=", car_wash],
+            ["is_deleted", "=", 0],
+            ["work_started_on", "is", "set"],
+            ["work_ended_on", "is", "set"],
+            ["work_ended_on", ">=", now_datetime() - timedelta(days=HISTORY_DAYS)],
+        ],
+        fields=["box", "work_started_on", "work_ended_on"],
+        order_by="work_ended_on desc",
+        limit_page_length=HISTORY_LIMIT,
+    )
+    sums: Dict[str, List[float]] = {}
+    for row in rows:
+        seconds = (get_datetime(row.work_ended_on) - get_datetime(row.work_started_on)).total_seconds()
+        if seconds <= 0:
+            continue
+        for box in filter(None, (row.box, ALL_BOXES)):
+            sums.setdefault(box, []).append(seconds)
+    return {box: sum(values) / len(values) for box, values in sums.items()}
+
+
+def rebuild_queue_model(car_wash: str) -> Dict[str, Any]:
+    """Собрать модель мойки из БД: очередь, боксы, занятость, средние длительности."""
+    bookings = frappe.get_all(
+        "Car wash booking",
+        filters={
+            "car_wash": car_wash,
+            "is_deleted": ["in", [0, False]],
+            "is_cancelled": ["in", [0, False]],
+            "has_appointment": ["in", [0, False]],
+        },
+        fields=["name", "desired_time", "creation"],
+        limit_page_length=0,
+    )
+    boxes = frappe.get_all(
+        "Car wash box",
+        filters={"car_wash": car_wash, "is_deleted": ["in", [0, False]], "is_disabled": ["in", [0, False]]},
+        pluck="name",
+    )
+    in_progress = frappe.get_all(
+        "Car wash appointment",
+        filters=[
+            ["car_wash", "=", car_wash],
+            ["is_deleted", "=", 0],
+            ["work_started_on", ">=", now_datetime() - timedelta(days=1)],
+            ["work_ended_on", "is", "not set"],
+            ["box", "is", "set"],
+        ],
+        fields=["box", "work_started_on", "duration_total"],
+    )
+    averages = _box_averages(car_wash)
+
+    busy_until = {box: 0.0 for box in boxes}
+    for row in in_progress:
+        if row.box in busy_until:
+            until = _ts(row.work_started_on) + _planned_seconds(row.duration_total, averages.get(row.box))
+            busy_until[row.box] = max(busy_until[row.box], until)
+
+    cache = frappe.cache()
+    pipe = cache.pipeline()
+    # Старые члены очереди убираются и из индекса
+    for member in _raw("zrange", cache.make_key(_key(car_wash)), 0, -1) or ():
+        pipe.hdel(cache.make_key(INDEX_KEY), member)
+    pipe.delete(*(cache.make_key(_key(car_wash, suffix)) for suffix in ("", "boxes", "avg")))
+    if bookings:
+        pipe.zadd(cache.make_key(_key(car_wash)), {b.name: _queue_score(b) for b in bookings})
+        pipe.hset(cache.make_key(INDEX_KEY), mapping={b.name: car_wash for b in bookings})
+    if busy_until:
+        pipe.hset(cache.make_key(_key(car_wash, "boxes")), mapping=busy_until)
+    if averages:
+        pipe.hset(cache.make_key(_key(car_wash, "avg")), mapping=averages)
+    pipe.set(cache.make_key(_key(car_wash, "built")), 1)
+    pipe.execute()
+    return {"queue": len(bookings), "boxes": len(boxes), "in_progress": len(in_progress)}
+
+
+def reconcile_queue_models():
+    """Ежечасно: пересобрать уже собранные модели из БД (исправляет пропущенные переходы)."""
+    cache = frappe.cache()
+    for car_wash in frappe.get_all("Car wash", pluck="name"):
+        if not _raw("exists", cache.make_key(_key(car_wash, "built"))):
+            continue
+        try:
+            rebuild_queue_model(car_wash)
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), f"Queue model reconcile failed: {car_wash}")
+
+
+# ---- переходы документов ----
+
+def _after_commit(fn) -> None:
+    # Redis меняется только для закоммиченных изменений
+    def run():
+        try:
+            fn()
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "Queue model update failed")
+    frappe.db.after_commit(run)
+
+
+def on_booking_change(before, doc) -> None:
+    """Бронь сохранена (before — прежнее состояние) или удалена (doc=None)."""
+    was, now_in = is_in_queue(before), is_in_queue(doc)
+    moved = was and now_in and (before.get("car_wash") != doc.get("car_wash") or _queue_score(before) != _queue_score(doc))
+    if not (was or now_in):
+        return
+    if was == now_in and not moved:
+        return
+
+    name = (doc or before).name
+    old_car_wash = before.get("car_wash") if was else None
+    new_car_wash = doc.get("car_wash") if now_in else None
+    score = _queue_score(doc) if now_in else None
+
+    def apply():
+        cache = frappe.cache()
+        pipe = cache.pipeline()
+        if old_car_wash:
+            pipe.zrem(cache.make_key(_key(old_car_wash)), name)
+            pipe.hdel(cache.make_key(INDEX_KEY), name)
+        if new_car_wash:
+            pipe.zadd(cache.make_key(_key(new_car_wash)), {name: score})
+            pipe.hset(cache.make_key(INDEX_KEY), name, new_car_wash)
+        pipe.execute()
+
+    _after_commit(apply)
+
+
+def _enabled_boxes(boxes: Iterable[str]) -> Set[str]:
+    """Боксы из boxes, которые не удалены и не отключены: только они есть в HASH боксов модели."""
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return set()
+    return set(frappe.get_all(
+        "Car wash box",
+        filters={"name": ["in", boxes], "is_deleted": ["in", [0, False]], "is_disabled": ["in", [0, False]]},
+        pluck="name",
+    ))
+
+
+def on_appointment_change(before, doc) -> None:
+    """
+    Начало работ занимает бокс до плановой длительности, завершение освобождает его
+    и добавляет фактическую длительность в скользящее среднее бокса и мойки.
+    Отключённые и удалённые боксы в модель не возвращаются.
+    """
+    state = doc or before
+    car_wash, box = state.get("car_wash"), state.get("box")
+    if not car_wash or not box:
+        return
+    started = state.get("work_started_on")
+    ended = state.get("work_ended_on")
+    removed = doc is None or cint(state.get("is_deleted"))
+    was_ended = bool(before and before.get("work_ended_on"))
+    was_started = bool(before and before.get("work_started_on"))
+
+    if removed or (ended and not was_ended):
+        duration = None
+        if not removed and started and ended:
+            duration = (get_datetime(ended) - get_datetime(started)).total_seconds()
+
+        def apply():
+            cache = frappe.cache()
+            pipe = cache.pipeline()
+            if box in _enabled_boxes([box]):
+                pipe.hset(cache.make_key(_key(car_wash, "boxes")), box, 0)
+            if duration and duration > 0:
+                avg_key = cache.make_key(_key(car_wash, "avg"))
+                current = _raw("hmget", avg_key, [box, ALL_BOXES])
+                for field, value in zip((box, ALL_BOXES), current):
+                    previous = flt(_text(value)) if value else 0.0
+                    pipe.hset(avg_key, field, duration if not previous else previous + EWMA_ALPHA * (duration - previous))
+            pipe.execute()
+
+        _after_commit(apply)
+    elif started and not ended and (not was_started or before.get("box") != box):
+        started_ts, duration_total = _ts(started), state.get("duration_total")
+        previous_box = before.get("box") if before else None
+
+        def apply():
+            cache = frappe.cache()
+            enabled = _enabled_boxes([box, previous_box])
+            avg = _raw("hget", cache.make_key(_key(car_wash, "avg")), box)
+            pipe = cache.pipeline()
+            if previous_box and previous_box != box and previous_box in enabled:
+                pipe.hset(cache.make_key(_key(car_wash, "boxes")), previous_box, 0)
+            if box in enabled:
+                until = started_ts + _planned_seconds(duration_total, flt(_text(avg)) if avg else None)
+                pipe.hset(cache.make_key(_key(car_wash, "boxes")), box, until)
+            pipe.execute()
+
+        _after_commit(apply)
+
+
+def on_box_change(doc, removed: bool = False) -> None:
+    """Бокс добавлен, отключён или удалён."""
+    if not doc.get("car_wash"):
+        return
+    active = not removed and not cint(doc.get("is_deleted")) and not cint(doc.get("is_disabled"))
+    car_wash, box = doc.get("car_wash"), doc.name
+
+    def apply():
+        cache = frappe.cache()
+        key = cache.make_key(_key(car_wash, "boxes"))
+        if active:
+            _raw("hsetnx", key, box, 0)
+        else:
+            _raw("hdel", key, box)
+
+    _after_commit(apply)
+
+
+# ---- чтение ----
+
+def estimate_wait_seconds(cars_ahead: int, box_free_at: Iterable[float], averages: Dict[str, float], now_ts: float,
+                          boxes: Iterable[str]) -> float:
+    """
+    Через сколько освободится бокс для машины, перед которой cars_ahead машин:
+    каждая машина впереди занимает первый освобождающийся бокс на его среднюю длительность.
+
+    Бокс, свободный с момента start, принимает машины в start, start + d, start + 2d, ...;
+    ответ — (cars_ahead + 1)-й по времени из этих моментов по всем боксам. Он ищется
+    бинарным поиском по времени, а не раздачей машин по одной.
+    """
+    fallback = averages.get(ALL_BOXES) or DEFAULT_SERVICE_SECONDS
+    lanes = [(max(now_ts, free_at), averages.get(box) or fallback) for box, free_at in zip(boxes, box_free_at)]
+    if not lanes:
+        lanes = [(now_ts, fallback)]  # боксы не заведены — как один бокс
+
+    def started_by(moment: float) -> int:
+        return sum(int((moment - start) // duration) + 1 for start, duration in lanes if start <= moment)
+
+    low = min(start for start, _duration in lanes)
+    if started_by(low) > cars_ahead:
+        return max(0.0, low - now_ts)
+    high = min(start + cars_ahead * duration for start, duration in lanes)
+    # started_by(low) <= cars_ahead < started_by(high)
+    while high - low > ETA_PRECISION_SEC:
+        middle = (low + high) / 2
+        if started_by(middle) > cars_ahead:
+            high = middle
+        else:
+            low = middle
+    # Искомый момент — последний старт не позже high (с допуском на округление)
+    free_at = max(
+        start + (high - start + ETA_PRECISION_SEC) // duration * duration for start, duration in lanes if start <= high)
+    return max(0.0, free_at - now_ts)
+
+
+def _read_model(car_wash: str, booking: Optional[str]) -> List[Any]:
+    cache = frappe.cache()
+    pipe = cache.pipeline()
+    pipe.exists(cache.make_key(_key(car_wash, "built")))
+    pipe.zcard(cache.make_key(_key(car_wash)))
+    pipe.hgetall(cache.make_key(_key(car_wash, "boxes")))
+    pipe.hgetall(cache.make_key(_key(car_wash, "avg")))
+    if booking:
+        pipe.zrank(cache.make_key(_key(car_wash)), booking)
+        pipe.zscore(cache.make_key(_key(car_wash)), booking)
+    return pipe.execute()
+
+
+def _queue_state(car_wash: str, booking: Optional[str] = None) -> Dict[str, Any]:
+    result = _read_model(car_wash, booking)
+    if not result[0]:
+        rebuild_queue_model(car_wash)  # холодный старт — единственное обращение к БД
+        result = _read_model(car_wash, booking)
+    boxes = {_text(box): flt(_text(until)) for box, until in (result[2] or {}).items()}
+    averages = {_text(box): flt(_text(avg)) for box, avg in (result[3] or {}).items()}
+    state = {"queue_length": int(result[1] or 0), "boxes": boxes, "averages": averages, "rank": None, "score": None}
+    if booking:
+        state["rank"], state["score"] = result[4], result[5]
+    return state
+
+
+def _eta(state: Dict[str, Any], cars_ahead: int, not_before: Optional[float] = None) -> Dict[str, Any]:
+    now_dt = now_datetime()
+    now_ts = _ts(now_dt)
+    wait = estimate_wait_seconds(
+        cars_ahead, state["boxes"].values(), state["averages"], now_ts, state["boxes"].keys())
+    if not_before and not_before > now_ts + wait:
+        wait = not_before - now_ts  # желаемое время позже, чем освободится бокс
+    return {
+        "eta_seconds": int(wait),
+        "eta": (now_dt + timedelta(seconds=int(wait))).strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@frappe.whitelist()
+def get_queue_position(booking: str, car_wash: str = None) -> Dict[str, Any]:
+    """
+    Позиция брони в очереди мойки и ожидаемое время начала.
+    Returns {"in_queue", "car_wash", "position", "cars_ahead", "queue_length", "eta_seconds", "eta"}.
+    """
+    if not booking:
+        frappe.throw(_("Booking is required"))
+    cache = frappe.cache()
+    if not car_wash:
+        car_wash = _raw("hget", cache.make_key(INDEX_KEY), booking)
+        car_wash = _text(car_wash) if car_wash else None
+    if not car_wash:
+        return {"in_queue": False, "booking": booking}
+
+    state = _queue_state(car_wash, booking)
+    if state["rank"] is None:
+        return {"in_queue": False, "booking": booking, "car_wash": car_wash, "queue_length": state["queue_length"]}
+    cars_ahead = int(state["rank"])
+    return {
+        "in_queue": True,
+        "booking": booking,
+        "car_wash": car_wash,
+        "position": cars_ahead + 1,
+        "cars_ahead": cars_ahead,
+        "queue_length": state["queue_length"],
+        **_eta(state, cars_ahead, not_before=flt(state["score"])),
+    }
+
+
+@frappe.whitelist()
+def get_queue_overview(car_wash: str) -> Dict[str, Any]:
+    """Длина очереди мойки и ожидание для машины, вставшей в конец."""
+    if not car_wash:
+        frappe.throw(_("Car wash is required"))
+    state = _queue_state(car_wash)
+    busy = sum(1 for until in state["boxes"].values() if until > _ts(now_datetime()))
+    return {
+        "car_wash": car_wash,
+        "queue_length": state["queue_length"],
+        "boxes": len(state["boxes"]),
+        "boxes_busy": busy,
+        **_eta(state, state["queue_length"]),
+    }
@@ -0,0 +1,139 @@
+# car_wash/slot_holds.py
+"""
+Короткие удержания слотов: между показом свободных слотов и созданием брони
+вместимость слота резервируется в Redis, чтобы два клиента не заняли последний слот.
+
+Ключ car_wash_slot_hold:{car_wash}:{date}:{HHMM} — ZSET hold -> время истечения (unix ts).
+Слот — desired_time, округлённое вниз до шага битовых карт (DEFAULT_STEP_MINUTES).
+Взятие удержания — один Lua-скрипт: истёкшие удержания удаляются, удержание берётся,
+только если их меньше свободной вместимости слота (битовая карта дня, см. availability_bitmap).
+Повторное взятие тем же hold продлевает его и не занимает вместимость ещё раз.
+
+Бронь с desired_time в будущем при создании (before_insert, до расчёта цены) берёт
+или продлевает своё удержание (поле запроса slot_hold); нет вместимости — бронь
+отклоняется сразу. После коммита удержание снимается: бронь уже учтена в битовой карте.
+Незавершённые удержания освобождают вместимость сами по истечении HOLD_TTL_SEC.
+В БД удержания не ходят — ни запросов, ни блокировок строк.
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_datetime, now_datetime
+
+from ..car_wash_appointment.availability_bitmap import DEFAULT_STEP_MINUTES, get_slot_capacity
+
+KEY_PREFIX = "car_wash_slot_hold"
+HOLD_TTL_SEC = 5 * 60
+
+# KEYS[1] — ZSET удержаний слота; ARGV: now, capacity, hold, expires_at, key_ttl.
+# Возвращает остаток вместимости после взятия или -1, если слот занят.
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local capacity = tonumber(ARGV[2])
+if not redis.call('ZSCORE', KEYS[1], ARGV[3]) and redis.call('ZCARD', KEYS[1]) >= capacity then
+    return -1
+end
+redis.call('ZADD', KEYS[1], ARGV[4], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return capacity - redis.call('ZCARD', KEYS[1])
+"""
+
+_scripts: Dict[int, Any] = {}
+
+
+def slot_start(value) -> datetime:
+    """Начало слота, в который попадает value."""
+    value = get_datetime(value)
+    minutes = (value.hour * 60 + value.minute) // DEFAULT_STEP_MINUTES * DEFAULT_STEP_MINUTES
+    return datetime.combine(value.date(), datetime.min.time()) + timedelta(minutes=minutes)
+
+
+def _key(car_wash: str, start: datetime) -> str:
+    return f"{KEY_PREFIX}:{car_wash}:{start.date()}:{start.strftime('%H%M')}"
+
+
+def _script(cache):
+    # Script держит sha скрипта: дальше EVALSHA, EVAL только при первом вызове
+    script = _scripts.get(id(cache))
+    if script is None:
+        script = _scripts[id(cache)] = cache.register_script(ACQUIRE_SCRIPT)
+    return script
+
+
+def acquire(cache, key: str, hold: str, capacity: int, now_ts: float, ttl: int = HOLD_TTL_SEC) -> int:
+    """Атомарно взять (или продлить) удержание; -1 — вместимость слота исчерпана."""
+    return int(_script(cache)(
+        keys=[cache.make_key(key)],
+        args=[now_ts, int(capacity), hold, now_ts + ttl, int(ttl)],
+        client=cache,
+    ))
+
+
+def hold_slot(car_wash: str, desired_time, hold: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Взять удержание слота desired_time. None — слот уже нельзя предложить (прошёл),
+    удержание не нужно; нет свободной вместимости — ValidationError.
+    """
+    start = slot_start(desired_time)
+    capacity = get_slot_capacity(car_wash, start)
+    if capacity is None:
+        return None
+    hold = hold or frappe.generate_hash(length=16)
+    left = acquire(frappe.cache(), _key(car_wash, start), hold, capacity, time.time())
+    if left < 0:
+        frappe.throw(
+            _("The selected time {0} is no longer available, please choose another slot.").format(
+                start.strftime("%Y-%m-%d %H:%M")),
+            title=_("Slot is taken"),
+        )
+    return {
+        "hold": hold,
+        "slot": start.strftime("%Y-%m-%d %H:%M:%S"),
+        "expires_at": (now_datetime() + timedelta(seconds=HOLD_TTL_SEC)).strftime("%Y-%m-%d %H:%M:%S"),
+        "capacity_left": left,
+    }
+
+
+def release_slot_hold(car_wash: str, desired_time, hold: str) -> None:
+    if car_wash and desired_time and hold:
+        cache = frappe.cache()
+        cache.zrem(cache.make_key(_key(car_wash, slot_start(desired_time))), hold)
+
+
+# ---- бронь ----
+
+def claim_slot_hold(doc) -> None:
+    """
+    before_insert брони: взять или продлить удержание слота desired_time.
+    Брони без времени (живая очередь) и вне очереди (out_of_turn) не удерживают слот.
+    """
+    if not doc.get("desired_time") or cint(doc.get("out_of_turn")):
+        return
+    held = hold_slot(doc.car_wash, doc.desired_time, doc.get("slot_hold") or frappe.form_dict.get("slot_hold"))
+    if held:
+        doc.slot_hold = held["hold"]
+        doc.flags.slot_hold_claimed = True
+
+
+def consume_slot_hold(doc) -> None:
+    """
+    on_update брони: снять удержание после коммита. Регистрируется после сброса
+    версий битовых карт, так что вместимость слота уже без этой брони не читается.
+    """
+    if not doc.flags.get("slot_hold_claimed"):
+        return
+    doc.flags.slot_hold_claimed = False
+    car_wash, desired_time, hold = doc.car_wash, doc.desired_time, doc.slot_hold
+
+    def release():
+        try:
+            release_slot_hold(car_wash, desired_time, hold)
+        except Exception:
+            # Не критично: удержание истечёт само
+            frappe.log_error(frappe.get_traceback(), "Slot hold release failed")
+
+    frappe.db.after_commit(release)
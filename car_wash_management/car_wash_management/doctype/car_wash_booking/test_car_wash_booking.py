@@ -1,9 +1,188 @@
 # Copyright (c) 2024, Rifat and Contributors
 # See license.txt
 
-# import frappe
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+
+from . import slot_holds
+from .queue_model import estimate_wait_seconds
+from .availiability import create_availability, reconcile_availability_counters, update_cars_in_queue
+from .booking_price_and_duration.benchmarks import count_queries
 
 
 class TestCarwashbooking(FrappeTestCase):
-	pass
+	def setUp(self):
+		self.car_wash = frappe.db.get_value("Car wash", {}, "name")
+		if not self.car_wash:
+			self.skipTest("No Car wash to count the queue for")
+		if not frappe.db.exists("Car wash availability", self.car_wash):
+			create_availability(frappe._dict(car_wash=self.car_wash))
+		frappe.db.set_value("Car wash availability", self.car_wash, "cars_in_queue", 5)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def _booking(self, **values):
+		return frappe._dict(
+			{"car_wash": self.car_wash, "is_deleted": 0, "is_cancelled": 0, "has_appointment": 0, **values})
+
+	def _cars_in_queue(self):
+		return frappe.db.get_value("Car wash availability", self.car_wash, "cars_in_queue")
+
+	def test_save_without_transition_does_not_query(self):
+		with count_queries() as counter:
+			update_cars_in_queue(self._booking(), self._booking(desired_time="2030-01-01 10:00:00"))
+			update_cars_in_queue(self._booking(has_appointment=1), self._booking(has_appointment=1, is_cancelled=1))
+		self.assertEqual(counter["count"], 0)
+		self.assertEqual(self._cars_in_queue(), 5)
+
+	def test_transitions_write_one_delta(self):
+		with count_queries() as counter:
+			update_cars_in_queue(None, self._booking())
+		self.assertEqual(counter["count"], 1)  # один UPDATE, без count и save
+		self.assertEqual(self._cars_in_queue(), 6)
+
+		with count_queries() as counter:
+			update_cars_in_queue(self._booking(), self._booking(has_appointment=1))
+		self.assertEqual(counter["count"], 1)
+		self.assertEqual(self._cars_in_queue(), 5)
+
+		update_cars_in_queue(self._booking(), None)
+		self.assertEqual(self._cars_in_queue(), 4)
+
+	def test_reconcile_corrects_drift(self):
+		frappe.db.set_value("Car wash availability", self.car_wash, "cars_in_queue", 999)
+		reconcile_availability_counters(commit=False)
+		expected = frappe.db.count(
+			"Car wash booking",
+			{"car_wash": self.car_wash, "has_appointment": 0, "is_cancelled": 0, "is_deleted": 0},
+		)
+		self.assertEqual(self._cars_in_queue(), expected)
+
+
+class TestSlotHolds(FrappeTestCase):
+	BOOKERS = 100
+	CAPACITY = 3
+
+	def setUp(self):
+		self.cache = frappe.cache()
+		self.key = f"{slot_holds.KEY_PREFIX}:_Test Car Wash:{frappe.generate_hash(length=8)}"
+
+	def tearDown(self):
+		self.cache.delete(self.cache.make_key(self.key))
+
+	def _held(self):
+		return self.cache.zcard(self.cache.make_key(self.key))
+
+	def test_concurrent_bookers_never_oversell(self):
+		# 100 клиентов одновременно берут последний слот: удержаний ровно по вместимости
+		now = time.time()
+		site, sites_path = frappe.local.site, frappe.local.sites_path
+
+		def book(i):
+			# frappe.local у каждого потока свой (make_key читает конфиг сайта)
+			frappe.init(site=site, sites_path=sites_path)
+			try:
+				return slot_holds.acquire(frappe.cache(), self.key, f"hold-{i}", self.CAPACITY, now)
+			finally:
+				frappe.destroy()
+
+		with ThreadPoolExecutor(max_workers=self.BOOKERS) as pool:
+			results = list(pool.map(book, range(self.BOOKERS)))
+		self.assertEqual(sum(1 for left in results if left >= 0), self.CAPACITY)
+		self.assertEqual(sorted(left for left in results if left >= 0), list(range(self.CAPACITY)))
+		self.assertEqual(self._held(), self.CAPACITY)
+
+	def test_repeated_hold_does_not_take_more_capacity(self):
+		now = time.time()
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "a", 1, now), 0)
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "a", 1, now + 10), 0)
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "b", 1, now + 10), -1)
+
+	def test_expired_hold_frees_capacity(self):
+		now = time.time()
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "a", 1, now, ttl=5), 0)
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "b", 1, now + 1), -1)
+		self.assertEqual(slot_holds.acquire(self.cache, self.key, "b", 1, now + 6), 0)
+		self.assertEqual(self._held(), 1)
+
+	def test_slot_start_rounds_down_to_step(self):
+		self.assertEqual(str(slot_holds.slot_start("2030-01-01 10:44:59")), "2030-01-01 10:30:00")
+
+
+class TestSlotHoldBookings(FrappeTestCase):
+	def setUp(self):
+		self.car_wash = frappe.db.get_value("Car wash", {}, "name")
+		self.car, self.customer = frappe.db.get_value("Car wash car", {}, ["name", "customer"]) or (None, None)
+		if not self.car_wash or not self.car:
+			self.skipTest("No Car wash and Car wash car to book")
+		self.slot = slot_holds.slot_start(now_datetime() + timedelta(days=1))
+		self.capacity = slot_holds.get_slot_capacity(self.car_wash, self.slot)
+		if not self.capacity:
+			self.skipTest("No free capacity at the test slot")
+		self.cache = frappe.cache()
+		self.key = slot_holds._key(self.car_wash, self.slot)
+		# Вся вместимость слота, кроме одного места, уже удержана другими клиентами
+		for idx in range(self.capacity - 1):
+			slot_holds.acquire(self.cache, self.key, f"other-{idx}", self.capacity, time.time())
+
+	def tearDown(self):
+		frappe.db.rollback()
+		self.cache.delete(self.cache.make_key(self.key))
+
+	def _held(self):
+		return {
+			hold.decode() if isinstance(hold, bytes) else hold
+			for hold in self.cache.zrange(self.cache.make_key(self.key), 0, -1)
+		}
+
+	def _booking(self):
+		return frappe.get_doc({
+			"doctype": "Car wash booking",
+			"car_wash": self.car_wash,
+			"customer": self.customer,
+			"car": self.car,
+			"payment_status": "Not paid",
+			"desired_time": self.slot,
+		})
+
+	def test_over_capacity_booking_is_rejected_and_hold_consumed_after_commit(self):
+		others = {f"other-{idx}" for idx in range(self.capacity - 1)}
+		booking = self._booking().insert(ignore_permissions=True)
+		self.assertEqual(self._held(), others | {booking.slot_hold})
+
+		# Последнее место удержано первой бронью: вторая отклоняется до расчёта цены
+		with self.assertRaises(frappe.ValidationError):
+			self._booking().insert(ignore_permissions=True)
+		self.assertEqual(self._held(), others | {booking.slot_hold})
+
+		# Удержание снимается только после коммита — бронь к этому моменту уже в битовой карте
+		frappe.db.after_commit.run()
+		self.assertEqual(self._held(), others)
+
+
+class TestQueueEta(FrappeTestCase):
+	NOW = 1_900_000_000.0
+
+	def test_free_box_takes_the_first_car(self):
+		self.assertEqual(estimate_wait_seconds(0, [0, self.NOW + 600], {}, self.NOW, ["B1", "B2"]), 0)
+
+	def test_cars_ahead_go_to_the_earliest_free_box(self):
+		# B1 frees now and takes a car every 10 min, B2 frees in 5 min and takes one every 30 min:
+		# starts at 0, 5, 10, 20, 30, 35, 40, ... minutes
+		averages = {"B1": 600, "B2": 1800}
+		waits = [
+			estimate_wait_seconds(ahead, [self.NOW, self.NOW + 300], averages, self.NOW, ["B1", "B2"]) / 60
+			for ahead in range(7)
+		]
+		self.assertEqual(waits, [0, 5, 10, 20, 30, 35, 40])
+
+	def test_long_queue_matches_box_throughput(self):
+		averages = {"B1": 1000.5, "B2": 1000.5}
+		wait = estimate_wait_seconds(10_001, [self.NOW, self.NOW], averages, self.NOW, ["B1", "B2"])
+		self.assertAlmostEqual(wait, 5000 * 1000.5, places=2)
@@ -9,6 +9,9 @@ from frappe import _
 import frappe
 
 from ..car_wash_booking.availiability import update_or_create_availability
+from ..car_wash_appointment.availability_bitmap import invalidate_car_wash
+from ..car_wash_booking.queue_model import on_box_change
+from ..car_wash_appointment.reports.section_cache import invalidate_boxes
 
 
 class Carwashbox(Document):
@@ -16,6 +19,17 @@ class Carwashbox(Document):
 	def validate(self):
 		update_or_create_availability(self)
 
+	def on_update(self):
+		# Число боксов = вместимость слотов
+		invalidate_car_wash(self.car_wash)
+		on_box_change(self)
+		invalidate_boxes(self.car_wash)
+
+	def on_trash(self):
+		invalidate_car_wash(self.car_wash)
+		on_box_change(self, removed=True)
+		invalidate_boxes(self.car_wash)
+
 	def get_working_hours(self):
 		car_wash = frappe.get_doc('Car wash', self.car_wash)
 		# Initialize an empty list to store the mapped working hours
@@ -0,0 +1,548 @@
+# car_wash_client/client_stats.py
+"""
+Материализованная статистика клиента по мойке (`Car wash client stats`).
+
+Одна строка на (клиент, мойка, период), где период — all_time, year:YYYY или month:YYYY-MM
+(по starts_on записи). Строки обновляются дельтой при сохранении/удалении `Car wash appointment`
+(apply_appointment_stats_delta), а get_client_stats читает их без агрегатов по таблице
+записей. Строки month/year хранят весь календарный период, а статистика, как и
+прежний get_statistics, считает month/year с начала периода по текущий момент: записи периода
+позже now (предварительные брони) вычитаются при чтении — отдельный запрос по индексу клиента,
+экстремумы пересчитываются, только если такие записи есть. rebuild_client_stats
+пересчитывает строки с нуля; ежедневная сверка (reconcile_client_stats) использует его,
+чтобы найти и исправить расхождения.
+"""
+
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import frappe
+from frappe.utils import cint, flt, get_datetime, now_datetime
+
+STATS_DOCTYPE = "Car wash client stats"
+ALL_TIME = "all_time"
+
+ROW_FIELDS = [
+	"name", "client", "car_wash", "period_key",
+	"total_appointments", "paid_appointments", "spent_total",
+	"first_visit_on", "last_visit_on", "last_payment_on",
+	"cars_json", "services_json", "statuses_json",
+]
+
+APPOINTMENT_FIELDS = [
+	"name", "customer", "car_wash", "starts_on", "payment_status", "services_total",
+	"car", "workflow_state", "payment_received_on", "is_deleted",
+]
+
+
+# ---- periods ----
+def period_keys(starts_on) -> List[str]:
+	if not starts_on:
+		return [ALL_TIME]
+	dt = get_datetime(starts_on)
+	return [ALL_TIME, f"year:{dt:%Y}", f"month:{dt:%Y-%m}"]
+
+
+def _period_bounds(period_key: str) -> Tuple[Optional[datetime], Optional[datetime]]:
+	if period_key == ALL_TIME:
+		return None, None
+	kind, value = period_key.split(":", 1)
+	if kind == "year":
+		start = datetime(int(value), 1, 1)
+		return start, start.replace(year=start.year + 1)
+	year, month = (int(p) for p in value.split("-"))
+	start = datetime(year, month, 1)
+	return start, (datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1))
+
+
+def _row_name(client: str, car_wash: str, period_key: str) -> str:
+	return f"{car_wash}:{client}:{period_key}"
+
+
+# ---- contribution of one appointment ----
+def _get(obj, key):
+	return obj.get(key) if isinstance(obj, dict) else getattr(obj, key, None)
+
+
+def appointment_contribution(doc, services: Optional[Iterable[str]] = None) -> Optional[Dict[str, Any]]:
+	"""What an appointment adds to its client's stats; None if it is not counted (deleted, no client)."""
+	if not doc or cint(_get(doc, "is_deleted")) or not _get(doc, "customer") or not _get(doc, "car_wash"):
+		return None
+	if services is None:
+		services = [_get(row, "service") for row in (_get(doc, "services") or [])]
+	paid = _get(doc, "payment_status") == "Paid"
+	return {
+		"name": _get(doc, "name"),
+		"client": _get(doc, "customer"),
+		"car_wash": _get(doc, "car_wash"),
+		"starts_on": get_datetime(_get(doc, "starts_on")) if _get(doc, "starts_on") else None,
+		"paid": paid,
+		"spent": flt(_get(doc, "services_total")) if paid else 0.0,
+		"car": _get(doc, "car"),
+		"services": tuple(sorted(s for s in services if s)),
+		"status": _get(doc, "workflow_state") or "",
+		"payment_received_on": get_datetime(_get(doc, "payment_received_on")) if _get(doc, "payment_received_on") else None,
+	}
+
+
+# ---- row state ----
+def _empty_state() -> Dict[str, Any]:
+	return {
+		"total_appointments": 0,
+		"paid_appointments": 0,
+		"spent_total": 0.0,
+		"first_visit_on": None,
+		"last_visit_on": None,
+		"last_payment_on": None,
+		"cars": {},
+		"services": {},
+		"statuses": {},
+	}
+
+
+def _state_from_row(row) -> Dict[str, Any]:
+	return {
+		"total_appointments": cint(row.get("total_appointments")),
+		"paid_appointments": cint(row.get("paid_appointments")),
+		"spent_total": flt(row.get("spent_total")),
+		"first_visit_on": get_datetime(row["first_visit_on"]) if row.get("first_visit_on") else None,
+		"last_visit_on": get_datetime(row["last_visit_on"]) if row.get("last_visit_on") else None,
+		"last_payment_on": get_datetime(row["last_payment_on"]) if row.get("last_payment_on") else None,
+		"cars": json.loads(row.get("cars_json") or "{}"),
+		"services": json.loads(row.get("services_json") or "{}"),
+		"statuses": json.loads(row.get("statuses_json") or "{}"),
+	}
+
+
+def _bump(counter: Dict[str, int], key: str, sign: int) -> None:
+	count = counter.get(key, 0) + sign
+	if count > 0:
+		counter[key] = count
+	else:
+		counter.pop(key, None)
+
+
+def _accumulate(state: Dict[str, Any], contribution: Dict[str, Any], sign: int) -> None:
+	"""Add (sign=1) or remove (sign=-1) an appointment; extremes are only widened here."""
+	state["total_appointments"] += sign
+	if contribution["paid"]:
+		state["paid_appointments"] += sign
+		state["spent_total"] += sign * contribution["spent"]
+	if contribution["car"]:
+		_bump(state["cars"], contribution["car"], sign)
+	for service in contribution["services"]:
+		_bump(state["services"], service, sign)
+	_bump(state["statuses"], contribution["status"], sign)
+
+	if sign > 0:
+		starts_on, paid_on = contribution["starts_on"], contribution["payment_received_on"]
+		if starts_on and (state["first_visit_on"] is None or starts_on < state["first_visit_on"]):
+			state["first_visit_on"] = starts_on
+		if starts_on and (state["last_visit_on"] is None or starts_on > state["last_visit_on"]):
+			state["last_visit_on"] = starts_on
+		if paid_on and (state["last_payment_on"] is None or paid_on > state["last_payment_on"]):
+			state["last_payment_on"] = paid_on
+
+
+def _removes_extreme(state: Dict[str, Any], contribution: Dict[str, Any]) -> bool:
+	return (
+		(contribution["starts_on"] is not None and contribution["starts_on"] in (state["first_visit_on"], state["last_visit_on"]))
+		or (contribution["payment_received_on"] is not None and contribution["payment_received_on"] == state["last_payment_on"])
+	)
+
+
+def _recompute_extremes(
+	state: Dict[str, Any],
+	client: str,
+	car_wash: Optional[str],
+	period_key: str,
+	exclude: Optional[str] = None,
+	until: Optional[datetime] = None,
+) -> None:
+	"""MIN/MAX after removing the appointment holding an extreme (one indexed query, rare); until — upper bound of starts_on."""
+	params: Dict[str, Any] = {"customer": client, "exclude": exclude or ""}
+	clauses = ""
+	if car_wash:
+		clauses += " AND car_wash = %(car_wash)s"
+		params["car_wash"] = car_wash
+	start, end = _period_bounds(period_key)
+	if start:
+		clauses += " AND starts_on >= %(start)s AND starts_on < %(end)s"
+		params.update(start=start, end=end)
+	if until:
+		clauses += " AND starts_on <= %(until)s"
+		params["until"] = until
+	row = frappe.db.sql(
+		f"""
+			SELECT MIN(starts_on) AS first_visit_on,
+			       MAX(starts_on) AS last_visit_on,
+			       MAX(payment_received_on) AS last_payment_on
+			FROM `tabCar wash appointment`
+			WHERE customer = %(customer)s
+			  AND is_deleted = 0 AND name != %(exclude)s{clauses}
+		""",
+		params,
+		as_dict=1,
+	)[0]
+	for field in ("first_visit_on", "last_visit_on", "last_payment_on"):
+		state[field] = get_datetime(row[field]) if row.get(field) else None
+
+
+# ---- storage ----
+def _select_states(client: str, car_wash: str, keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+	"""Existing rows for the periods, locked for the rest of the transaction."""
+	rows = frappe.db.sql(
+		f"""
+			SELECT {", ".join(ROW_FIELDS)}
+			FROM `tabCar wash client stats`
+			WHERE name IN %(names)s
+			FOR UPDATE
+		""",
+		{"names": tuple(_row_name(client, car_wash, k) for k in keys)},
+		as_dict=1,
+	)
+	return {row.period_key: _state_from_row(row) for row in rows}
+
+
+def _lock_states(client: str, car_wash: str, keys: Iterable[str], locked: Optional[Dict[str, Dict[str, Any]]] = None) -> Dict[str, Dict[str, Any]]:
+	"""Create missing rows and lock all of them for the rest of the transaction (locked — rows already selected)."""
+	keys = sorted(set(keys))
+	states = dict(locked) if locked is not None else _select_states(client, car_wash, keys)
+	missing = [key for key in keys if key not in states]
+	if not missing:
+		return states
+
+	now = now_datetime()
+	user = frappe.session.user if getattr(frappe.local, "session", None) else "Administrator"
+	values = []
+	params: Dict[str, Any] = {"client": client, "car_wash": car_wash, "now": now, "user": user}
+	for idx, key in enumerate(missing):
+		params[f"name{idx}"] = _row_name(client, car_wash, key)
+		params[f"key{idx}"] = key
+		values.append(f"(%(name{idx})s, %(client)s, %(car_wash)s, %(key{idx})s, %(now)s, %(now)s, %(user)s, %(user)s)")
+	frappe.db.sql(
+		f"""
+			INSERT IGNORE INTO `tabCar wash client stats`
+				(name, client, car_wash, period_key, creation, modified, owner, modified_by)
+			VALUES {", ".join(values)}
+		""",
+		params,
+	)
+	states.update(_select_states(client, car_wash, missing))
+	return states
+
+
+def _save_state(client: str, car_wash: str, period_key: str, state: Dict[str, Any]) -> None:
+	frappe.db.sql(
+		"""
+			UPDATE `tabCar wash client stats`
+			SET total_appointments = %(total_appointments)s,
+			    paid_appointments = %(paid_appointments)s,
+			    spent_total = %(spent_total)s,
+			    first_visit_on = %(first_visit_on)s,
+			    last_visit_on = %(last_visit_on)s,
+			    last_payment_on = %(last_payment_on)s,
+			    cars_json = %(cars_json)s,
+			    services_json = %(services_json)s,
+			    statuses_json = %(statuses_json)s,
+			    modified = %(modified)s
+			WHERE name = %(name)s
+		""",
+		{
+			"name": _row_name(client, car_wash, period_key),
+			"total_appointments": max(0, state["total_appointments"]),
+			"paid_appointments": max(0, state["paid_appointments"]),
+			"spent_total": max(0.0, flt(state["spent_total"])),
+			"first_visit_on": state["first_visit_on"],
+			"last_visit_on": state["last_visit_on"],
+			"last_payment_on": state["last_payment_on"],
+			"cars_json": json.dumps(state["cars"], sort_keys=True),
+			"services_json": json.dumps(state["services"], sort_keys=True),
+			"statuses_json": json.dumps(state["statuses"], sort_keys=True),
+			"modified": now_datetime(),
+		},
+	)
+
+
+def _apply_deltas(client: str, car_wash: str, removed: Optional[Dict[str, Any]], added: Optional[Dict[str, Any]]) -> None:
+	keys = set(period_keys(removed["starts_on"]) if removed else [])
+	keys.update(period_keys(added["starts_on"]) if added else [])
+	states = _select_states(client, car_wash, keys)
+	if ALL_TIME not in states:
+		# Первая запись клиента на мойке после появления таблицы: дельта к пустой строке дала бы
+		# неполную all_time, которую get_client_stats считает построенной — строим из истории
+		# (запись уже сохранена; удаляемую исключаем — она ещё в таблице)
+		rebuild_client_stats(customer=client, car_wash=car_wash, exclude=None if added else removed["name"])
+		return
+	states = _lock_states(client, car_wash, keys, states)
+
+	# Та же запись с теми же датами возвращает свои экстремумы сама — пересчёт не нужен
+	same_dates = bool(removed and added) and (
+		(removed["starts_on"], removed["payment_received_on"]) == (added["starts_on"], added["payment_received_on"])
+	)
+	if removed:
+		for key in period_keys(removed["starts_on"]):
+			state = states[key]
+			stale_extremes = not same_dates and _removes_extreme(state, removed)
+			_accumulate(state, removed, -1)
+			if stale_extremes:
+				_recompute_extremes(state, client, car_wash, key, exclude=removed["name"])
+	if added:
+		for key in period_keys(added["starts_on"]):
+			_accumulate(states[key], added, +1)
+
+	for key in keys:
+		_save_state(client, car_wash, key, states[key])
+
+
+def apply_appointment_stats_delta(before, after) -> None:
+	"""
+	Move an appointment's contribution from its previous state to the new one.
+	before=None for a new appointment, after=None for a deleted one. No queries when nothing relevant changed.
+	"""
+	removed = appointment_contribution(before)
+	added = appointment_contribution(after)
+	if removed == added:
+		return
+
+	if removed and added and (removed["client"], removed["car_wash"]) == (added["client"], added["car_wash"]):
+		_apply_deltas(added["client"], added["car_wash"], removed, added)
+		return
+	if removed:
+		_apply_deltas(removed["client"], removed["car_wash"], removed, None)
+	if added:
+		_apply_deltas(added["client"], added["car_wash"], None, added)
+
+
+# ---- read ----
+def _merge_states(states: List[Dict[str, Any]]) -> Dict[str, Any]:
+	if len(states) == 1:
+		return states[0]
+	merged = _empty_state()
+	for state in states:
+		for field in ("total_appointments", "paid_appointments", "spent_total"):
+			merged[field] += state[field]
+		for field in ("cars", "services", "statuses"):
+			for key, count in state[field].items():
+				merged[field][key] = merged[field].get(key, 0) + count
+		for field, pick in (("first_visit_on", min), ("last_visit_on", max), ("last_payment_on", max)):
+			values = [v for v in (merged[field], state[field]) if v is not None]
+			merged[field] = pick(values) if values else None
+	return merged
+
+
+def _period_stats(state: Dict[str, Any], limit: Optional[int], titles: Dict[str, str]) -> Dict[str, Any]:
+	top = sorted(state["services"].items(), key=lambda item: (-item[1], item[0]))
+	if limit:
+		top = top[: int(limit)]
+	paid = state["paid_appointments"]
+	spent = flt(state["spent_total"])
+	return {
+		"total_appointments": state["total_appointments"],
+		"paid_appointments": paid,
+		"spent_total": spent,
+		"avg_ticket": (spent / paid) if paid else 0.0,
+		"last_visit_on": state["last_visit_on"],
+		"first_visit_on": state["first_visit_on"],
+		"last_payment_on": state["last_payment_on"],
+		"unique_cars": len(state["cars"]),
+		"top_services": [
+			{"service": service, "service_title": titles.get(service), "count": count}
+			for service, count in top
+		],
+		"by_status": dict(state["statuses"]),
+	}
+
+
+def _read_rows(customer: str, car_wash: Optional[str], keys: List[str]) -> List[Dict[str, Any]]:
+	filters = {"client": customer, "period_key": ["in", keys]}
+	if car_wash:
+		filters = {"name": ["in", [_row_name(customer, car_wash, k) for k in keys]]}
+	return frappe.get_all(STATS_DOCTYPE, filters=filters, fields=ROW_FIELDS, limit_page_length=0)
+
+
+def _upcoming_contributions(customer: str, car_wash: Optional[str], now: datetime, until: datetime) -> List[Dict[str, Any]]:
+	"""Contributions of the client's appointments in (now, until): in the period rows, but not yet in the window."""
+	filters = [["customer", "=", customer], ["is_deleted", "=", 0], ["starts_on", ">", now], ["starts_on", "<", until]]
+	if car_wash:
+		filters.append(["car_wash", "=", car_wash])
+	appointments = frappe.get_all("Car wash appointment", filters=filters, fields=APPOINTMENT_FIELDS, limit_page_length=0)
+	if not appointments:
+		return []
+	services = _load_appointment_services([a.name for a in appointments])
+	return [
+		contribution
+		for contribution in (appointment_contribution(a, services.get(a.name, [])) for a in appointments)
+		if contribution
+	]
+
+
+def _bound_to_now(state: Dict[str, Any], upcoming: List[Dict[str, Any]], customer: str, car_wash: Optional[str],
+                  period_key: str, now: datetime) -> None:
+	"""Period row -> window from the period start to now (as get_statistics counted month and year)."""
+	for contribution in upcoming:
+		_accumulate(state, contribution, -1)
+	_recompute_extremes(state, customer, car_wash, period_key, until=now)
+
+
+def get_client_stats(customer: Optional[str], car_wash: Optional[str] = None, limit: Optional[int] = 5, with_titles: bool = True) -> Dict[str, Any]:
+	"""
+	Статистика клиента в формате Carwashclient.get_statistics из материализованных строк.
+	limit=None — все услуги в top_services (так считаются правила автоскидок).
+	"""
+	now = now_datetime()
+	keys = period_keys(now)
+	periods = {"all_time": ALL_TIME, "year": keys[1], "month": keys[2]}
+
+	rows = _read_rows(customer, car_wash, keys) if customer else []
+	if customer and not any(r.period_key == ALL_TIME for r in rows):
+		# Строк ещё нет (клиент до появления таблицы) — строим один раз
+		rebuild_client_stats(customer=customer, car_wash=car_wash)
+		rows = _read_rows(customer, car_wash, keys)
+
+	by_period: Dict[str, List[Dict[str, Any]]] = {}
+	for row in rows:
+		by_period.setdefault(row.period_key, []).append(_state_from_row(row))
+	states = {label: _merge_states(by_period.get(key) or [_empty_state()]) for label, key in periods.items()}
+	if customer:
+		upcoming = _upcoming_contributions(customer, car_wash, now, _period_bounds(periods["year"])[1])
+		for label in ("month", "year"):
+			in_period = [c for c in upcoming if periods[label] in period_keys(c["starts_on"])]
+			if in_period:
+				_bound_to_now(states[label], in_period, customer, car_wash, periods[label], now)
+
+	titles: Dict[str, str] = {}
+	if with_titles:
+		service_ids = {s for state in states.values() for s in state["services"]}
+		if service_ids:
+			titles = dict(frappe.get_all(
+				"Car wash service",
+				filters={"name": ["in", list(service_ids)]},
+				fields=["name", "title"],
+				as_list=True,
+			))
+
+	return {
+		"customer": customer,
+		"periods": {
+			label: _period_stats(states[label], limit, titles)
+			for label in ("month", "year", "all_time")
+		},
+	}
+
+
+# ---- rebuild / reconcile ----
+def _load_appointment_services(names: List[str]) -> Dict[str, List[str]]:
+	services: Dict[str, List[str]] = {}
+	for start in range(0, len(names), 1000):
+		for row in frappe.get_all(
+			"Car wash appointment service",
+			filters={"parenttype": "Car wash appointment", "parent": ["in", names[start:start + 1000]]},
+			fields=["parent", "service"],
+			limit_page_length=0,
+		):
+			services.setdefault(row.parent, []).append(row.service)
+	return services
+
+
+def _comparable(state: Dict[str, Any]) -> Tuple:
+	return (
+		state["total_appointments"],
+		state["paid_appointments"],
+		round(flt(state["spent_total"]), 2),
+		state["first_visit_on"],
+		state["last_visit_on"],
+		state["last_payment_on"],
+		json.dumps(state["cars"], sort_keys=True),
+		json.dumps(state["services"], sort_keys=True),
+		json.dumps(state["statuses"], sort_keys=True),
+	)
+
+
+def rebuild_client_stats(customer: Optional[str] = None, car_wash: Optional[str] = None, exclude: Optional[str] = None) -> Dict[str, Any]:
+	"""
+	Пересчитать строки статистики с нуля по записям (для клиента, мойки или обоих; exclude — без этой записи).
+	Возвращает, сколько строк пришлось создать, исправить и удалить, и список клиентов с расхождениями.
+	"""
+	filters: Dict[str, Any] = {"is_deleted": 0, "customer": ["is", "set"]}
+	stats_filters: Dict[str, Any] = {}
+	if customer:
+		filters["customer"] = customer
+		stats_filters["client"] = customer
+	if car_wash:
+		filters["car_wash"] = car_wash
+		stats_filters["car_wash"] = car_wash
+	if exclude:
+		filters["name"] = ["!=", exclude]
+
+	appointments = frappe.get_all("Car wash appointment", filters=filters, fields=APPOINTMENT_FIELDS, limit_page_length=0)
+	services = _load_appointment_services([a.name for a in appointments])
+
+	expected: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+	for appointment in appointments:
+		contribution = appointment_contribution(appointment, services.get(appointment.name, []))
+		if not contribution:
+			continue
+		for key in period_keys(contribution["starts_on"]):
+			state = expected.setdefault((contribution["client"], contribution["car_wash"], key), _empty_state())
+			_accumulate(state, contribution, +1)
+	if customer and car_wash:
+		# Пустая all_time строка отмечает, что статистика клиента уже построена
+		expected.setdefault((customer, car_wash, ALL_TIME), _empty_state())
+
+	existing = {
+		(row.client, row.car_wash, row.period_key): _state_from_row(row)
+		for row in frappe.get_all(STATS_DOCTYPE, filters=stats_filters, fields=ROW_FIELDS, limit_page_length=0)
+	}
+
+	created = updated = deleted = 0
+	drifted_clients = set()
+	for (client, wash, key), state in expected.items():
+		current = existing.get((client, wash, key))
+		if current is not None and _comparable(current) == _comparable(state):
+			continue
+		_lock_states(client, wash, [key])
+		_save_state(client, wash, key, state)
+		if current is None:
+			created += 1
+		else:
+			updated += 1
+			drifted_clients.add(client)
+
+	stale = [k for k in existing if k not in expected]
+	for client, wash, key in stale:
+		frappe.db.delete(STATS_DOCTYPE, {"name": _row_name(client, wash, key)})
+		deleted += 1
+		drifted_clients.add(client)
+
+	if drifted_clients:
+		from ..car_wash_booking.booking_price_and_duration.quote_memo import bump_customer_stats_version
+
+		for client in drifted_clients:
+			bump_customer_stats_version(client)
+
+	return {
+		"created": created,
+		"updated": updated,
+		"deleted": deleted,
+		"drifted_clients": sorted(drifted_clients),
+	}
+
+
+def reconcile_client_stats():
+	"""
+	Ежедневная сверка: пересобирает статистику каждой мойки и логирует расхождения с дельтами.
+	"""
+	for car_wash in frappe.get_all("Car wash", pluck="name"):
+		try:
+			result = rebuild_client_stats(car_wash=car_wash)
+			frappe.db.commit()
+			if result["updated"] or result["deleted"]:
+				frappe.logger().warning(
+					f"[Client stats] drift at {car_wash}: updated={result['updated']} deleted={result['deleted']} "
+					f"clients={len(result['drifted_clients'])}"
+				)
+		except Exception:
+			frappe.db.rollback()
+			frappe.log_error(frappe.get_traceback(), f"Client stats reconcile failed: {car_wash}")
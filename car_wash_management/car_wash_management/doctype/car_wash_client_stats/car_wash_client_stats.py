@@ -0,0 +1,11 @@
+# Copyright (c) 2024, Rifat Dzhumagulov and contributors
+# For license information, please see license.txt
+
+# Строки поддерживаются car_wash_client/client_stats.py (дельты из Car wash appointment
+# и ежедневная сверка), вручную не редактируются.
+
+from frappe.model.document import Document
+
+
+class Carwashclientstats(Document):
+    pass
@@ -0,0 +1,95 @@
+# Copyright (c) 2024, Rifat Dzhumagulov and Contributors
+# See license.txt
+
+from datetime import timedelta
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+
+from ..car_wash_client.client_stats import get_client_stats, rebuild_client_stats
+
+
+class TestCarwashclientstats(FrappeTestCase):
+	def setUp(self):
+		self.car_wash = frappe.db.get_value("Car wash", {}, "name")
+		self.car, self.customer = frappe.db.get_value("Car wash car", {}, ["name", "customer"]) or (None, None)
+		self.services = frappe.get_all(
+			"Car wash service", filters={"car_wash": self.car_wash}, pluck="name", limit_page_length=2)
+		if not self.car_wash or not self.car or len(self.services) < 2:
+			self.skipTest("No Car wash with a car and two services to book")
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def _appointment(self, **values):
+		return frappe.get_doc({
+			"doctype": "Car wash appointment",
+			"car_wash": self.car_wash,
+			"customer": self.customer,
+			"car": self.car,
+			"payment_status": "Not paid",
+			"starts_on": now_datetime() - timedelta(minutes=1),
+			"services": [{"service": self.services[0]}],
+			**values,
+		}).insert(ignore_permissions=True)
+
+	def _stats(self, customer=None):
+		return get_client_stats(customer or self.customer, self.car_wash, limit=None, with_titles=False)
+
+	def assertStatsMatchRebuild(self, customer=None):
+		"""Rows kept by deltas give the same stats as rows rebuilt from the appointments."""
+		stats = self._stats(customer)
+		rebuild_client_stats(customer=customer or self.customer, car_wash=self.car_wash)
+		self.assertEqual(stats, self._stats(customer))
+
+	def test_insert_and_pay(self):
+		appointment = self._appointment()
+		self.assertStatsMatchRebuild()
+
+		appointment.payment_status = "Paid"
+		appointment.save(ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+
+	def test_change_services(self):
+		appointment = self._appointment()
+		appointment.set("services", [{"service": self.services[1]}])
+		appointment.save(ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+
+	def test_move_date(self):
+		appointment = self._appointment()
+		# В прошлый год: уходит из строк месяца и года, экстремумы пересчитываются
+		appointment.starts_on = now_datetime() - timedelta(days=400)
+		appointment.save(ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+
+	def test_move_customer(self):
+		other_car, other_customer = frappe.db.get_value(
+			"Car wash car", {"customer": ["not in", [self.customer, ""]]}, ["name", "customer"]) or (None, None)
+		if not other_car:
+			self.skipTest("No second Car wash client with a car")
+		appointment = self._appointment()
+		appointment.update({"customer": other_customer, "car": other_car})
+		appointment.save(ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+		self.assertStatsMatchRebuild(other_customer)
+
+	def test_soft_delete_and_trash(self):
+		soft_deleted, trashed = self._appointment(), self._appointment()
+		soft_deleted.is_deleted = 1
+		soft_deleted.save(ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+
+		frappe.delete_doc("Car wash appointment", trashed.name, force=True, ignore_permissions=True)
+		self.assertStatsMatchRebuild()
+
+	def test_month_and_year_end_at_now(self):
+		before = self._stats()["periods"]
+		self._appointment(starts_on=now_datetime() + timedelta(minutes=5))
+		after = self._stats()["periods"]
+		# Предварительная бронь — только в all_time, как в прежнем get_statistics
+		self.assertEqual(after["all_time"]["total_appointments"], before["all_time"]["total_appointments"] + 1)
+		self.assertEqual(after["month"], before["month"])
+		self.assertEqual(after["year"], before["year"])
+		self.assertStatsMatchRebuild()
@@ -4,12 +4,13 @@
 import frappe
 from frappe.model.document import Document
 from ..car_wash_booking.booking_price_and_duration.auto_discounts import (
-    get_applicable_auto_discounts_cached,
     apply_best_auto_discounts,
     record_auto_discount_usage,
     delete_recorded_auto_discount_usage,
 )
 from ..car_wash_booking.booking_price_and_duration.booking import get_booking_price_and_duration
+from ..car_wash_booking.booking_price_and_duration.promocode import release_promocode_usages_for_attempt
+from ..car_wash_booking.booking_price_and_duration.quote_memo import get_request_quote_context
 from ..car_wash_booking.booking_price_and_duration.workflow_helpers import (
 	compute_base_price_and_duration,
 	get_disabled_auto_discount_ids_from_request_or_doc,
@@ -25,7 +26,7 @@ class Carwashmobilebookingattempt(Document):
 	  usage, refresh/apply recorded usage; write final `services_total`, `commission_user`,
 	  and `total`.
 	- after_insert: determine best applicable auto-discounts and record usage snapshot.
-	- on_trash: delete recorded usage for this attempt.
+	- on_trash: delete recorded usage for this attempt and release its promocode uses.
 	Rationale: aligns mobile attempt calculations and toggles with booking/appointment via helpers.
 	"""
 	
@@ -92,18 +93,15 @@ class Carwashmobilebookingattempt(Document):
 			if getattr(self, "is_deleted", 0):
 				return
 			
-			# Проверяем наличие фичи promo у мойки
-			car_wash_doc = frappe.get_doc("Car wash", self.car_wash)
-			has_promo_feature = car_wash_doc.has_journal_feature("promo")
-			if not has_promo_feature:
+			# Фича promo, скидки и статистика клиента — из QuoteContext запроса (уже загружены расчётом цены)
+			context = get_request_quote_context(self.car_wash)
+			if not context.has_promo_feature:
 				return
-				
-			applicable = get_applicable_auto_discounts_cached(
-				car_wash=self.car_wash,
-				customer=getattr(self, "user", None),
-				services=getattr(self, "services", []) or [],
-				services_total=float(getattr(self, "services_total", 0.0) or 0.0),
-				cache_ttl_sec=60,
+
+			applicable = context.applicable_auto_discounts(
+				getattr(self, "user", None),
+				getattr(self, "services", []) or [],
+				float(getattr(self, "services_total", 0.0) or 0.0),
 			)
 			best = apply_best_auto_discounts(
 				applicable_discounts=applicable,
@@ -126,3 +124,5 @@ class Carwashmobilebookingattempt(Document):
 			delete_recorded_auto_discount_usage("MobileAttempt", self.name)
 		except Exception:
 			frappe.log_error(frappe.get_traceback(), "Mobile attempt delete usage failed")
+		# Вернуть занятые использования промокода (счётчик used_count)
+		release_promocode_usages_for_attempt(self.name)
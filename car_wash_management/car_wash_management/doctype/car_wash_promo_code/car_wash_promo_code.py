@@ -10,6 +10,16 @@ from typing import Dict, List, Any
 # import frappe
 from frappe.model.document import Document
 
+from ..car_wash_booking.booking_price_and_duration.promo_index import bump_promo_code_index_version
+
 
 class Carwashpromocode(Document):
-	pass
\ No newline at end of file
+	def on_update(self):
+		# Индекс активных промокодов мойки устарел
+		bump_promo_code_index_version(self.car_wash)
+		previous = self.get_doc_before_save()
+		if previous and previous.car_wash != self.car_wash:
+			bump_promo_code_index_version(previous.car_wash)
+
+	def on_trash(self):
+		bump_promo_code_index_version(self.car_wash)
@@ -0,0 +1,82 @@
+# Copyright (c) 2025, Rifat and Contributors
+# See license.txt
+
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, today
+
+from ..car_wash_booking.booking_price_and_duration.promo_index import get_promo_code
+from ..car_wash_booking.booking_price_and_duration.promocode import (
+	release_promo_code_use,
+	try_reserve_promo_code_use,
+)
+
+USAGE_LIMIT = 50
+REDEMPTIONS = 300
+WORKERS = 32
+
+
+def _redeem_in_own_connection(site, promo_code_name):
+	"""One redemption per request: own connection, own transaction, commit at the end."""
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		ok = try_reserve_promo_code_use(promo_code_name)
+		frappe.db.commit()
+		return ok
+	finally:
+		frappe.destroy()
+
+
+class TestCarwashpromocode(FrappeTestCase):
+	def setUp(self):
+		car_wash = frappe.db.get_value("Car wash", {}, "name")
+		if not car_wash:
+			self.skipTest("No Car wash to attach a promo code to")
+
+		self.promo = frappe.get_doc({
+			"doctype": "Car wash promo code",
+			"code": f"TEST-{frappe.generate_hash(length=8)}",
+			"title": "Concurrency test",
+			"car_wash": car_wash,
+			"promo_type": "Service Discount",
+			"discount_type": "Percentage",
+			"discount_value": 10,
+			"valid_from": add_days(today(), -1),
+			"valid_to": add_days(today(), 1),
+			"usage_limit": USAGE_LIMIT,
+			"used_count": 0,
+			"is_active": 1,
+		}).insert(ignore_permissions=True)
+		# Потоки работают в своих соединениях и должны видеть промокод
+		frappe.db.commit()
+
+	def tearDown(self):
+		if getattr(self, "promo", None):
+			frappe.delete_doc("Car wash promo code", self.promo.name, force=True, ignore_permissions=True)
+			frappe.db.commit()
+
+	def test_parallel_redemptions_never_exceed_limit(self):
+		site = frappe.local.site
+		with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+			results = list(pool.map(lambda _: _redeem_in_own_connection(site, self.promo.name), range(REDEMPTIONS)))
+
+		self.assertEqual(sum(results), USAGE_LIMIT)
+		self.assertEqual(frappe.db.get_value("Car wash promo code", self.promo.name, "used_count"), USAGE_LIMIT)
+
+	def test_release_returns_use(self):
+		for _ in range(USAGE_LIMIT):
+			self.assertTrue(try_reserve_promo_code_use(self.promo.name))
+		self.assertFalse(try_reserve_promo_code_use(self.promo.name))
+
+		release_promo_code_use(self.promo.name)
+		self.assertTrue(try_reserve_promo_code_use(self.promo.name))
+
+	def test_index_sees_new_code_and_drops_deactivated(self):
+		self.assertEqual(get_promo_code(self.promo.code, self.promo.car_wash).name, self.promo.name)
+
+		self.promo.is_active = 0
+		self.promo.save(ignore_permissions=True)
+		self.assertIsNone(get_promo_code(self.promo.code, self.promo.car_wash))
@@ -5,9 +5,19 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import today, getdate
 from datetime import datetime, timedelta
+from ..car_wash_booking.booking_price_and_duration.price_catalog import bump_price_catalog_version
+from ..car_wash_booking.booking_price_and_duration.single_flight import flight_key, single_flight
 
 class Carwashservice(Document):
-	pass
+	def on_update(self):
+		# Сбросить прайс-каталог мойки (услуги, длительности, модификаторы)
+		bump_price_catalog_version(self.car_wash)
+		before = self.get_doc_before_save()
+		if before and before.car_wash != self.car_wash:
+			bump_price_catalog_version(before.car_wash)
+
+	def on_trash(self):
+		bump_price_catalog_version(self.car_wash)
 
 # http://localhost:8000/api/method/car_wash_management.car_wash_management.doctype.car_wash_service.car_wash_service.get_services_with_prices
 # http://localhost:8000/api/method/car_wash_management.api.get_car_wash_services_with_prices
@@ -15,10 +25,14 @@ class Carwashservice(Document):
 def get_services_with_prices():
     """
     Fetch Car wash services with their prices, optionally filtered by car_wash.
+    Identical concurrent calls (booking screens opening at once) are computed once.
     """
     # Fetch the optional query parameter 'car_wash'
     car_wash = frappe.form_dict.get("car_wash")
+    return single_flight(flight_key("get_services_with_prices", car_wash), lambda: _load_services_with_prices(car_wash))
+
 
+def _load_services_with_prices(car_wash=None):
     # Set up the base filters
     filters = {"is_deleted": 0}
 
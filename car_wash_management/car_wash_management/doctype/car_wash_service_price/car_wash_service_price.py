@@ -4,12 +4,23 @@
 # import frappe
 from frappe.model.document import Document
 import frappe
+from ..car_wash_booking.booking_price_and_duration.price_catalog import bump_price_catalog_version
 
 class Carwashserviceprice(Document):
 	def on_update(self):
-		cache = frappe.cache()
-		# Сбросить ключи вида service_prices:tariff:{tariff_id}:*
-		if self.doctype == "Car wash service price":
-			cache.delete_keys(f"service_prices:tariff:{self.tariff}:")
-		elif self.doctype == "Car wash tariff":
-			cache.delete_keys(f"service_prices:tariff:{self.name}:")
+		# Сбросить прайс-каталог мойки, которой принадлежит тариф
+		self._bump_catalog()
+
+	def on_trash(self):
+		self._bump_catalog()
+
+	def _bump_catalog(self):
+		tariffs = {self.tariff}
+		before = self.get_doc_before_save()
+		if before:
+			tariffs.add(before.tariff)
+		tariffs.discard(None)
+		if not tariffs:
+			return
+		for car_wash in set(frappe.get_all("Car wash tariff", filters={"name": ["in", list(tariffs)]}, pluck="car_wash")):
+			bump_price_catalog_version(car_wash)
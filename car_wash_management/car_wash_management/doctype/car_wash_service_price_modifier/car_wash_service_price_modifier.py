@@ -3,7 +3,12 @@
 
 # import frappe
 from frappe.model.document import Document
+from ..car_wash_booking.booking_price_and_duration.price_catalog import bump_price_catalog_version
 
 
 class Carwashservicepricemodifier(Document):
-	pass
+	def on_update(self):
+		bump_price_catalog_version(self.car_wash)
+
+	def on_trash(self):
+		bump_price_catalog_version(self.car_wash)
@@ -3,13 +3,15 @@
 
 # import frappe
 from frappe.model.document import Document
-import frappe
+from ..car_wash_booking.booking_price_and_duration.price_catalog import bump_price_catalog_version
 
 class Carwashtariff(Document):
 	def on_update(self):
-		cache = frappe.cache()
-		# Сбросить ключи вида service_prices:tariff:{tariff_id}:*
-		if self.doctype == "Car wash service price":
-			cache.delete_keys(f"service_prices:tariff:{self.tariff}:")
-		elif self.doctype == "Car wash tariff":
-			cache.delete_keys(f"service_prices:tariff:{self.name}:")
+		# Сбросить прайс-каталог мойки (список тарифов и их цены)
+		bump_price_catalog_version(self.car_wash)
+		before = self.get_doc_before_save()
+		if before and before.car_wash != self.car_wash:
+			bump_price_catalog_version(before.car_wash)
+
+	def on_trash(self):
+		bump_price_catalog_version(self.car_wash)
@@ -0,0 +1,168 @@
+# car_wash/staffing.py
+"""
+Сколько мойщиков на смене: сегменты дня (start, end, workers) из Work Shift Schedule
+и отметок Worker Check In. CarWashScheduler ограничивает вместимость слота
+min(боксы, мойщики) внутри этих сегментов.
+
+Правила:
+  - смена без отметок не ограничивает (нет данных о составе);
+  - у смены с отметками мойщик на месте от IN до OUT, без OUT — до конца смены
+    (открытая смена без end_time — до конца суток, закрытая — до последней отметки);
+  - до первой отметки и после ухода всех на смене — 0 мойщиков;
+  - одновременные смены складываются; вне смен ограничения нет.
+
+День компилируется один раз (два запроса) и лежит в Redis под версией мойки;
+версию сбрасывают изменения смен и отметок (см. контроллеры).
+"""
+
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import frappe
+from frappe.utils import get_datetime, getdate
+
+from ..car_wash_booking.booking_price_and_duration.versioning import bump_version_now_and_after_commit, get_version
+
+VERSION_NAMESPACE = "car_wash_staffing"
+ENTRY_TTL_SEC = 6 * 60 * 60
+# Смены, начатые раньше суток, могут ещё идти (ночная смена)
+SHIFT_LOOKBACK = timedelta(days=1)
+
+Segment = Tuple[datetime, datetime, int]
+
+
+def _entry_key(car_wash: str, day) -> str:
+	return f"{VERSION_NAMESPACE}:{car_wash}:{day}"
+
+
+def _shift_segments(shift, check_ins, day_end: datetime) -> List[Segment]:
+	"""Сегменты одной смены по её отметкам (отсортированы по времени)."""
+	start = get_datetime(shift.start_time)
+	if shift.end_time:
+		end = get_datetime(shift.end_time)
+	elif shift.workflow_state == "Closed":
+		end = max(start, get_datetime(check_ins[-1].time))
+	else:
+		end = day_end
+	if end <= start:
+		return []
+
+	present = set()
+	segments: List[Segment] = []
+	cursor = start
+	for row in check_ins:
+		at = min(max(get_datetime(row.time), start), end)
+		if at > cursor:
+			segments.append((cursor, at, len(present)))
+			cursor = at
+		if row.type == "IN":
+			present.add(row.worker)
+		else:
+			present.discard(row.worker)
+	if end > cursor:
+		segments.append((cursor, end, len(present)))
+	return segments
+
+
+def _combine(shift_segments: List[List[Segment]], day_start: datetime, day_end: datetime) -> List[Segment]:
+	"""Разностный проход по сегментам смен: число мойщиков там, где есть хоть одна смена с отметками."""
+	deltas: Dict[datetime, List[int]] = {}
+	for segments in shift_segments:
+		for start, end, workers in segments:
+			start, end = max(start, day_start), min(end, day_end)
+			if start >= end:
+				continue
+			deltas.setdefault(start, [0, 0])
+			deltas.setdefault(end, [0, 0])
+			deltas[start][0] += workers
+			deltas[start][1] += 1
+			deltas[end][0] -= workers
+			deltas[end][1] -= 1
+
+	combined: List[Segment] = []
+	workers = covered = 0
+	points = sorted(deltas)
+	for at, nxt in zip(points, points[1:]):
+		workers += deltas[at][0]
+		covered += deltas[at][1]
+		if covered:
+			if combined and combined[-1][1] == at and combined[-1][2] == workers:
+				combined[-1] = (combined[-1][0], nxt, workers)
+			else:
+				combined.append((at, nxt, workers))
+	return combined
+
+
+def compile_staffing(car_washes: List[str], day) -> Dict[str, List[Segment]]:
+	"""Сегменты дня для нескольких моек — два запроса на все мойки."""
+	day = getdate(day)
+	day_start = datetime.combine(day, time(0, 0, 0))
+	day_end = day_start + timedelta(days=1)
+	result: Dict[str, List[Segment]] = {car_wash: [] for car_wash in car_washes}
+	shifts = [
+		s for s in frappe.get_all(
+			"Work Shift Schedule",
+			filters=[
+				["car_wash", "in", car_washes],
+				["start_time", ">=", day_start - SHIFT_LOOKBACK],
+				["start_time", "<", day_end],
+			],
+			fields=["name", "car_wash", "start_time", "end_time", "workflow_state"],
+			limit_page_length=0,
+		)
+		if not s.end_time or get_datetime(s.end_time) > day_start
+	]
+	if not shifts:
+		return result
+
+	check_ins: Dict[str, list] = {}
+	for row in frappe.get_all(
+		"Worker Check In",
+		filters={"shift_schedule": ["in", [s.name for s in shifts]], "docstatus": 1},
+		fields=["shift_schedule", "worker", "type", "time"],
+		order_by="time asc",
+		limit_page_length=0,
+	):
+		if row.time:
+			check_ins.setdefault(row.shift_schedule, []).append(row)
+
+	by_car_wash: Dict[str, List[List[Segment]]] = {}
+	for shift in shifts:
+		if check_ins.get(shift.name):
+			by_car_wash.setdefault(shift.car_wash, []).append(_shift_segments(shift, check_ins[shift.name], day_end))
+	for car_wash, shift_segments in by_car_wash.items():
+		result[car_wash] = _combine(shift_segments, day_start, day_end)
+	return result
+
+
+def get_staffing_many(car_washes: List[str], day) -> Dict[str, List[Segment]]:
+	"""Сегменты дня из кэша; мойки с устаревшей записью пересобираются вместе."""
+	day = getdate(day)
+	cache = frappe.cache()
+	result: Dict[str, List[Segment]] = {}
+	missing: Dict[str, str] = {}
+	for car_wash in car_washes:
+		version = get_version(VERSION_NAMESPACE, car_wash)
+		entry = cache.get_value(_entry_key(car_wash, day))
+		if entry and entry["version"] == version:
+			result[car_wash] = entry["segments"]
+		else:
+			missing[car_wash] = version
+	if missing:
+		# Версии прочитаны до пересборки: сброс во время неё сделает запись устаревшей
+		for car_wash, segments in compile_staffing(list(missing), day).items():
+			cache.set_value(
+				_entry_key(car_wash, day), {"version": missing[car_wash], "segments": segments},
+				expires_in_sec=ENTRY_TTL_SEC,
+			)
+			result[car_wash] = segments
+	return result
+
+
+def get_staffing(car_wash: str, day) -> List[Segment]:
+	return get_staffing_many([car_wash], day)[car_wash]
+
+
+def invalidate_staffing(car_wash: Optional[str]) -> None:
+	if car_wash:
+		bump_version_now_and_after_commit(VERSION_NAMESPACE, car_wash)
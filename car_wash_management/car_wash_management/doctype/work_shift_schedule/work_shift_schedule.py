@@ -5,8 +5,20 @@
 from frappe.model.document import Document
 from frappe.utils import now
 
+from ..car_wash_appointment.availability_bitmap import invalidate_car_wash
+from .staffing import invalidate_staffing
+
 
 class WorkShiftSchedule(Document):
 	def on_update(self):
 		if self.workflow_state == 'Closed':
 			self.end_time = now()
+		self.invalidate_capacity()
+
+	def on_trash(self):
+		self.invalidate_capacity()
+
+	def invalidate_capacity(self):
+		# Мойщики на смене ограничивают вместимость слотов
+		invalidate_staffing(self.car_wash)
+		invalidate_car_wash(self.car_wash)
@@ -1,9 +1,29 @@
 # Copyright (c) 2024, Rifat and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from ..car_wash_appointment.availability_bitmap import invalidate_car_wash
+from ..work_shift_schedule.staffing import invalidate_staffing
+
 
 class WorkerCheckIn(Document):
-	pass
+	# Учитываются только проведённые отметки — состав смены меняется на submit/cancel
+	def on_submit(self):
+		self.invalidate_capacity()
+
+	def on_update_after_submit(self):
+		self.invalidate_capacity()
+
+	def on_cancel(self):
+		self.invalidate_capacity()
+
+	def on_trash(self):
+		if self.docstatus == 1:
+			self.invalidate_capacity()
+
+	def invalidate_capacity(self):
+		car_wash = self.car_wash or frappe.db.get_value("Work Shift Schedule", self.shift_schedule, "car_wash")
+		invalidate_staffing(car_wash)
+		invalidate_car_wash(car_wash)
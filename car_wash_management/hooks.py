@@ -156,7 +156,13 @@ doc_events = {
 
 scheduler_events = {
 	"hourly": [
-		"car_wash_management.tasks.daily_reports.send_daily_telegram_reports"
+		"car_wash_management.tasks.daily_reports.send_daily_telegram_reports",
+		"car_wash_management.car_wash_management.doctype.car_wash_appointment.availability_bitmap.reconcile_availability_bitmaps",
+		"car_wash_management.car_wash_management.doctype.car_wash_booking.queue_model.reconcile_queue_models",
+		"car_wash_management.car_wash_management.doctype.car_wash_booking.availiability.reconcile_availability_counters",
+	],
+	"daily": [
+		"car_wash_management.car_wash_management.doctype.car_wash_client.client_stats.reconcile_client_stats"
 	],
 }
 
@@ -0,0 +1,11 @@
+import frappe
+
+from car_wash_management.car_wash_management.doctype.car_wash_client.client_stats import rebuild_client_stats
+
+
+def execute():
+    # Build `Car wash client stats` from existing appointments, one car wash per transaction,
+    # so the first save after deploy updates a complete all_time row instead of creating a partial one
+    for car_wash in frappe.get_all("Car wash", pluck="name"):
+        rebuild_client_stats(car_wash=car_wash)
+        frappe.db.commit()